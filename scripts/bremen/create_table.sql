@@ -2,24 +2,40 @@ USE DATABASE syte;
 
 USE SCHEMA bremen;
 
+-- Partitioned by district, one partition per district is created before each load:
+-- CREATE TABLE IF NOT EXISTS buildings_p_<md5>_<district> PARTITION OF buildings FOR VALUES IN ('<district>');
+
 CREATE TABLE IF NOT EXISTS buildings (
-    identifier VARCHAR PRIMARY KEY,
+    identifier VARCHAR NOT NULL,
     geometry GEOMETRY(MULTIPOLYGON, 4326),
     area FLOAT,
     num_floors INTEGER,
     on_parcel VARCHAR,
     type VARCHAR,
     building_date date,
-    fast_api_sync timestamp without time zone default (now() at time zone 'utc')
-);
+    district VARCHAR NOT NULL,
+    fast_api_sync timestamp without time zone default (now() at time zone 'utc'),
+    PRIMARY KEY (identifier, district)
+) PARTITION BY LIST (district);
+
+CREATE TABLE IF NOT EXISTS buildings_default PARTITION OF buildings DEFAULT;
 
 CREATE TABLE IF NOT EXISTS parcels (
-    identifier VARCHAR PRIMARY KEY,
+    identifier VARCHAR NOT NULL,
     geometry GEOMETRY(MULTIPOLYGON, 4326),
     area FLOAT,
     location_text VARCHAR,
     cadastral_identifier VARCHAR,
     municipal VARCHAR,
-    district VARCHAR,
-    fast_api_sync timestamp without time zone default (now() at time zone 'utc')
-);
+    district VARCHAR NOT NULL,
+    fast_api_sync timestamp without time zone default (now() at time zone 'utc'),
+    PRIMARY KEY (identifier, district)
+) PARTITION BY LIST (district);
+
+CREATE TABLE IF NOT EXISTS parcels_default PARTITION OF parcels DEFAULT;
+
+-- Secondary indexes, dropped before a full reload and rebuilt concurrently afterwards.
+CREATE INDEX IF NOT EXISTS buildings_geometry_idx ON buildings USING gist (geometry);
+CREATE INDEX IF NOT EXISTS buildings_on_parcel_idx ON buildings USING btree (on_parcel);
+CREATE INDEX IF NOT EXISTS parcels_geometry_idx ON parcels USING gist (geometry);
+CREATE INDEX IF NOT EXISTS parcels_cadastral_identifier_idx ON parcels USING btree (cadastral_identifier);
@@ -9,7 +9,10 @@ from starlette.responses import JSONResponse
 
 import syte_pipeline
 from syte_pipeline.examples import v0_router
-from syte_pipeline.s1.analytic import v1
+from syte_pipeline.middleware import CacheCompressionMiddleware
+from syte_pipeline.s1.analytic import settings, v1
+from syte_pipeline.src import snapshots
+from syte_pipeline.src.resources import get_budget
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +25,7 @@ async def lifespan(app: FastAPI) -> AsyncIterator:
         "Application started. You can check the documentation \
         in https://localhost:8000/docs/"
     )
+    logger.info(f"Resource budget: {get_budget().to_dict()}")
     yield
     # Shut Down
     logger.warning("Application shutdown")
@@ -30,11 +34,21 @@ async def lifespan(app: FastAPI) -> AsyncIterator:
 app = FastAPI(
     title=syte_pipeline.__name__,
     version=syte_pipeline.__version__,
+    lifespan=lifespan,
 )
 
 
 app.include_router(v0_router)
 app.include_router(v1)
+# Every GET below /cadastral/ only depends on the prepared dataset and the query.
+app.add_middleware(
+    CacheCompressionMiddleware,
+    generation=lambda: snapshots.generation(settings.prepared_dir),
+    cached_prefixes=(f"{v1.prefix}/cadastral/",),
+    excluded_prefixes=(f"{v1.prefix}/cadastral/queue/",),
+    max_age=settings.http_cache_max_age,
+    minimum_size=settings.compression_min_size,
+)
 
 
 @app.get("/health", status_code=200)
@@ -0,0 +1,304 @@
+"""
+Load test of the read endpoints.
+
+Concurrent clients hit the endpoints for a fixed duration and the latency
+percentiles, throughput and error rate of every endpoint are written as JSON.
+By default the app runs in-process on a synthetic prepared snapshot, so two
+runs with the same arguments are comparable:
+
+    python -m syte_pipeline.loadtest --clients 50 --duration 30 --output loadtest.json
+
+Use --url to load an already running deployment instead. Needs httpx, a dev dependency.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# name: path, query string included.
+ENDPOINTS = {
+    "cadastral": "/api/v1/cadastral/?num_results=100",
+    "land_use": "/api/v1/cadastral/land_use",
+    "district_parcel_areas": "/api/v1/cadastral/district_parcel_areas",
+    "potential": "/api/v1/cadastral/potential?level=parcel",
+}
+
+# Centre of Bremen, the synthetic parcels are laid out around it.
+ORIGIN = (8.80, 53.07)
+PARCEL_SIZE = 0.0005
+
+
+@dataclass
+class Sample:
+    endpoint: str
+    latency: float
+    status: Optional[int]
+    error: Optional[str] = None
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None or self.status is None or self.status >= 400
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of ``values``, ``q`` in [0, 100]."""
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples: list[Sample], elapsed: float) -> dict:
+    """
+    Per endpoint statistics of a run.
+    Parameters
+    ----------
+    samples : list[Sample]
+        Every request of the run.
+    elapsed : float
+        Duration of the run in seconds.
+
+    Returns
+    -------
+    dict
+        endpoint: requests, errors, error_rate, throughput (requests/s) and
+        latency percentiles in milliseconds.
+
+    """
+    by_endpoint: dict[str, list[Sample]] = {}
+    for sample in samples:
+        by_endpoint.setdefault(sample.endpoint, []).append(sample)
+
+    report = {}
+    for endpoint, endpoint_samples in sorted(by_endpoint.items()):
+        latencies = [s.latency * 1000 for s in endpoint_samples]
+        errors = [s for s in endpoint_samples if s.failed]
+        statuses: dict[str, int] = {}
+        for s in endpoint_samples:
+            key = str(s.status) if s.error is None else type_of(s.error)
+            statuses[key] = statuses.get(key, 0) + 1
+        report[endpoint] = {
+            "requests": len(endpoint_samples),
+            "errors": len(errors),
+            "error_rate": len(errors) / len(endpoint_samples),
+            "throughput": len(endpoint_samples) / elapsed if elapsed > 0 else math.nan,
+            "statuses": statuses,
+            "latency_ms": {
+                "mean": statistics.fmean(latencies),
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies),
+            },
+        }
+    return report
+
+
+def type_of(error: str) -> str:
+    """Exception class name of an error recorded as ``<class>: <message>``."""
+    return error.split(":", 1)[0]
+
+
+async def run_load(
+    client,
+    endpoints: dict[str, str],
+    clients: int,
+    duration: float,
+    warmup: int = 1,
+) -> tuple[list[Sample], float]:
+    """
+    Run ``clients`` concurrent clients for ``duration`` seconds. Each client
+    requests the endpoints in turn, starting at a different one.
+    Parameters
+    ----------
+    client : httpx.AsyncClient
+        Client bound to the app or to a deployment.
+    endpoints : dict[str, str]
+        Endpoint name to path.
+    clients : int
+        Number of concurrent clients.
+    duration : float
+        Duration of the measured run in seconds.
+    warmup : int, optional
+        Unmeasured requests per endpoint before the run. The default is 1.
+
+    Returns
+    -------
+    tuple[list[Sample], float]
+        The measured requests and the elapsed time.
+
+    """
+    names = list(endpoints)
+    for name in names:
+        for _ in range(warmup):
+            await client.get(endpoints[name])
+
+    samples: list[Sample] = []
+    deadline = time.perf_counter() + duration
+
+    async def user(offset: int) -> None:
+        i = offset
+        while time.perf_counter() < deadline:
+            name = names[i % len(names)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                response = await client.get(endpoints[name])
+                await response.aread()
+                samples.append(Sample(name, time.perf_counter() - start, response.status_code))
+            except Exception as e:
+                samples.append(Sample(name, time.perf_counter() - start, None, f"{type(e).__name__}: {e}"))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(offset) for offset in range(clients)))
+    return samples, time.perf_counter() - start
+
+
+def synthetic_frame(districts: int, parcels_per_district: int, seed: int = 0):
+    """
+    Buildings joined to their parcels, with the columns of Transformer.spatial_join.
+    Parcels are squares on a grid, each holding one to three buildings.
+    """
+    import geopandas as gpd
+    import shapely
+
+    rng = random.Random(seed)
+    side = math.ceil(math.sqrt(parcels_per_district))
+    types = ["Wohnhaus", "Garage", "Gebäude für Handel und Dienstleistungen", "Schuppen"]
+    rows = []
+    for d in range(districts):
+        district = f"Gemarkung {d:02d}"
+        for p in range(parcels_per_district):
+            x0 = ORIGIN[0] + (d * side + p % side) * PARCEL_SIZE
+            y0 = ORIGIN[1] + (p // side) * PARCEL_SIZE
+            parcel = shapely.box(x0, y0, x0 + PARCEL_SIZE, y0 + PARCEL_SIZE)
+            parcel_id = f"P{d:02d}{p:06d}"
+            for b in range(rng.randint(1, 3)):
+                size = PARCEL_SIZE * rng.uniform(0.1, 0.3)
+                bx = x0 + PARCEL_SIZE * (0.05 + 0.3 * b)
+                by = y0 + PARCEL_SIZE * rng.uniform(0.05, 0.6)
+                building = shapely.box(bx, by, bx + size, by + size)
+                rows.append(
+                    {
+                        "building_identifier": f"B{d:02d}{p:06d}{b}",
+                        "parcel_identifier": parcel_id,
+                        "geometry": building,
+                        "parcel_geometry": parcel,
+                        # Roughly m² at this latitude.
+                        "building_area": building.area * 7.4e9,
+                        "num_floors": rng.randint(1, 6),
+                        "on_parcel": parcel_id,
+                        "parcel_area": parcel.area * 7.4e9,
+                        "location_text": f"Synthetische Straße {p}",
+                        "cadastral_identifier": f"04{d:04d}-{p:05d}",
+                        "district": district,
+                        "municipal": "Bremen",
+                        "building_date": "2020-01-01",
+                        "type": rng.choice(types),
+                    }
+                )
+    df = gpd.GeoDataFrame(rows, geometry="geometry", crs="EPSG:4326")
+    df["parcel_geometry"] = gpd.GeoSeries(df["parcel_geometry"], crs="EPSG:4326")
+    return df
+
+
+def prepare_dataset(districts: int, parcels_per_district: int, seed: int = 0) -> str:
+    """
+    Write the synthetic snapshot with Transformer.to_parquet and compute its
+    metrics. settings must point at the data directory of the run.
+    Returns
+    -------
+    str
+        Day of the snapshot.
+
+    """
+    from syte_pipeline.settings import Settings
+    from syte_pipeline.src import snapshots
+    from syte_pipeline.src.catalog import build_catalog
+    from syte_pipeline.src.metrics import PotentialMetrics
+    from syte_pipeline.src.transformation import Transformer
+
+    settings = Settings()
+    day = snapshots.today()
+    output_dir = snapshots.partition_dir(settings.prepared_dir, day)
+    os.makedirs(output_dir, exist_ok=True)
+    Transformer().to_parquet(synthetic_frame(districts, parcels_per_district, seed), output_dir)
+    PotentialMetrics(settings.metrics_cell_size).compute(output_dir, snapshots.partition_dir(settings.metrics_dir, day))
+    snapshots.bump_generation(settings.prepared_dir, build_catalog(settings.prepared_dir, settings.catalog_dir))
+    return day
+
+
+async def run(args: argparse.Namespace) -> dict:
+    import httpx
+
+    endpoints = {name: ENDPOINTS[name] for name in args.endpoint} if args.endpoint else ENDPOINTS
+    limits = httpx.Limits(max_connections=args.clients)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits)
+    else:
+        # settings are read when the app is imported, point them at the synthetic data first.
+        data_dir = args.data_dir or tempfile.mkdtemp(prefix="syte_loadtest_")
+        os.environ.setdefault("SYTE_LOCAL_DIR", data_dir)
+        os.environ["SYTE_PIPELINE_LOCAL_DIR"] = data_dir
+        day = prepare_dataset(args.districts, args.parcels, args.seed)
+        logger.info(f"Synthetic snapshot {day} written to {data_dir}")
+
+        from syte_pipeline.app import app
+
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=args.timeout
+        )
+
+    async with client:
+        samples, elapsed = await run_load(client, endpoints, args.clients, args.duration, args.warmup)
+    return {
+        "target": args.url or "in-process",
+        "clients": args.clients,
+        "duration": elapsed,
+        "dataset": None if args.url else {"districts": args.districts, "parcels": args.parcels, "seed": args.seed},
+        "endpoints": summarize(samples, elapsed),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Base URL of a running deployment, default is the app in-process")
+    parser.add_argument("--endpoint", action="append", choices=ENDPOINTS, help="Endpoints to load, default all")
+    parser.add_argument("--clients", type=int, default=50, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of measured load")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured requests per endpoint")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Request timeout in seconds")
+    parser.add_argument("--districts", type=int, default=8, help="Districts of the synthetic snapshot")
+    parser.add_argument("--parcels", type=int, default=500, help="Parcels per synthetic district")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic snapshot")
+    parser.add_argument("--data-dir", help="Directory of the synthetic snapshot, default a temporary one")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+        logger.info(f"Report written to {args.output}")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
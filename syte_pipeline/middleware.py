@@ -0,0 +1,220 @@
+"""
+HTTP caching and compression of the dataset-backed endpoints.
+
+Responses below the cached prefixes get a strong ETag derived from the dataset
+generation, the path and the query string: a request whose ``If-None-Match``
+matches is answered 304 without running the endpoint. Responses are compressed
+with zstd (when ``zstandard`` is installed) or gzip, whichever the client
+prefers, once they reach ``minimum_size`` bytes.
+"""
+
+import gzip
+import hashlib
+import logging
+from functools import lru_cache
+from typing import Callable, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+ENCODINGS = ("zstd", "gzip")
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/vnd.mapbox-vector-tile",
+    "image/svg+xml",
+)
+
+
+@lru_cache
+def zstd_compressor():
+    """zstandard compressor, None when the optional package is missing."""
+    try:
+        import zstandard
+    except ImportError:
+        logger.debug("zstandard is not installed, only gzip is offered.")
+        return None
+    return zstandard.ZstdCompressor(level=3)
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """
+    Content coding to use for a request.
+    Parameters
+    ----------
+    accept_encoding : str
+        Accept-Encoding header of the request.
+
+    Returns
+    -------
+    str or None
+        zstd or gzip, by client preference (q values) then in that order; None
+        for identity.
+
+    """
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    candidates = [
+        encoding
+        for encoding in ENCODINGS
+        if weights.get(encoding, weights.get("*", 0.0)) > 0 and (encoding != "zstd" or zstd_compressor() is not None)
+    ]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda encoding: weights.get(encoding, weights.get("*", 0.0)))
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstd_compressor().compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+
+def entity_tag(generation: str, path: str, query_string: bytes) -> str:
+    """Opaque tag of a representation, without quotes or encoding suffix."""
+    params = "&".join(sorted(query_string.decode("latin-1").split("&")))
+    return hashlib.sha1(f"{generation}|{path}|{params}".encode()).hexdigest()[:32]
+
+
+def matching_tags(if_none_match: str) -> set[str]:
+    """Tags of an If-None-Match header, encoding suffixes removed."""
+    tags = set()
+    for item in if_none_match.split(","):
+        tag = item.strip().removeprefix("W/").strip('"')
+        for encoding in ENCODINGS:
+            tag = tag.removesuffix(f"-{encoding}")
+        if tag:
+            tags.add(tag)
+    return tags
+
+
+class CacheCompressionMiddleware:
+    """
+    ETags, 304 and Cache-Control for the dataset endpoints, content-coding
+    negotiation for every response.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        generation: Callable[[], str],
+        cached_prefixes: tuple[str, ...] = (),
+        excluded_prefixes: tuple[str, ...] = (),
+        max_age: int = 60,
+        minimum_size: int = 1024,
+    ):
+        """
+
+        Parameters
+        ----------
+        app : ASGIApp
+        generation : Callable[[], str]
+            Current dataset generation, part of the ETags.
+        cached_prefixes : tuple[str, ...], optional
+            Paths whose GET responses only depend on the dataset and the query.
+        excluded_prefixes : tuple[str, ...], optional
+            Paths below the cached prefixes that are not cacheable.
+        max_age : int, optional
+            Cache-Control max-age in seconds of the cached responses. The default is 60.
+        minimum_size : int, optional
+            Smaller bodies are sent uncompressed. The default is 1024.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.app = app
+        self.generation = generation
+        self.cached_prefixes = cached_prefixes
+        self.excluded_prefixes = excluded_prefixes
+        self.max_age = max_age
+        self.minimum_size = minimum_size
+
+    def cacheable(self, scope: Scope) -> bool:
+        path = scope["path"]
+        return (
+            scope["method"] in ("GET", "HEAD")
+            and path.startswith(self.cached_prefixes)
+            and not path.startswith(self.excluded_prefixes)
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoding = negotiate(request_headers.get("accept-encoding", ""))
+        tag = None
+        if self.cacheable(scope):
+            tag = entity_tag(self.generation(), scope["path"], scope["query_string"])
+            if tag in matching_tags(request_headers.get("if-none-match", "")):
+                await self.not_modified(send, tag, encoding)
+                return
+
+        start: Optional[Message] = None
+        chunks: list[bytes] = []
+
+        async def buffered_send(message: Message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                await self.send_response(send, start, b"".join(chunks), tag, encoding)
+
+        await self.app(scope, receive, buffered_send)
+
+    def cache_headers(self, headers: MutableHeaders, tag: str, encoding: Optional[str]) -> None:
+        headers["ETag"] = f'"{tag}-{encoding}"' if encoding else f'"{tag}"'
+        if "cache-control" not in headers:
+            headers["Cache-Control"] = f"public, max-age={self.max_age}, must-revalidate"
+
+    async def not_modified(self, send: Send, tag: str, encoding: Optional[str]) -> None:
+        headers = MutableHeaders()
+        self.cache_headers(headers, tag, encoding)
+        headers.add_vary_header("Accept-Encoding")
+        await send({"type": "http.response.start", "status": 304, "headers": headers.raw})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send_response(
+        self, send: Send, start: Message, body: bytes, tag: Optional[str], encoding: Optional[str]
+    ) -> None:
+        headers = MutableHeaders(raw=start["headers"])
+        content_type = headers.get("content-type", "")
+        compressible = (
+            encoding is not None
+            and len(body) >= self.minimum_size
+            and "content-encoding" not in headers
+            and content_type.startswith(COMPRESSIBLE_TYPES)
+        )
+        if compressible:
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+        cached = tag is not None and start["status"] == 200
+        if cached or content_type.startswith(COMPRESSIBLE_TYPES):
+            headers.add_vary_header("Accept-Encoding")
+        if cached:
+            # The tag follows the negotiated coding, so a 304 can be answered
+            # without knowing whether the body would have been compressed.
+            self.cache_headers(headers, tag, encoding)
+        await send({**start, "headers": headers.raw})
+        await send({"type": "http.response.body", "body": body})
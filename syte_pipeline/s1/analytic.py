@@ -6,20 +6,20 @@ Created on Fri Aug 02 15:15:30 2024
 @author: johnomole
 """
 
-from fastapi import APIRouter, status, HTTPException
+from fastapi import APIRouter, status, HTTPException, Response
 from fastapi.responses import HTMLResponse
 from concurrent.futures import ThreadPoolExecutor
 from syte_pipeline.settings import Settings, DBCredentials
-import plotly.express as px
-from plotly.io import to_html
 from os.path import join
-from syte_pipeline.src.ingestion import Extraction
-from syte_pipeline.src.transformation import Transformer
-from syte_pipeline.src.data_loader import DataLoader
+from syte_pipeline.src.profiling import Profiler, submit
+from syte_pipeline.src import snapshots
+from syte_pipeline.src.ledger import RunLedger, fingerprint
+from syte_pipeline.src.resources import get_budget
+from functools import lru_cache
+from typing import Literal
 import logging
 import os
 import glob
-import duckdb
 
 
 logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
@@ -27,116 +27,333 @@ LOG = logging.getLogger("bremen state")
 LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
 
 
-conn = duckdb.connect()
 settings = Settings()
 
 v1 = APIRouter(
     responses={
         status.HTTP_404_NOT_FOUND: {"description": "Not found"},
-        status.HTTP_422_UNPROCESSABLE_ENTITY: {
-            "description": "Something is wrong with the request"
-        },
+        status.HTTP_422_UNPROCESSABLE_ENTITY: {"description": "Something is wrong with the request"},
     },
     prefix="/api/v1",
     tags=["v1"],
 )
-extraction_handler = Extraction()
-transform_handler = Transformer()
-db_credentials = DBCredentials()
+profiler = Profiler(settings.profile_history, settings.profiler)
 
 
-default_db = f"user={db_credentials.user} host={db_credentials.host} password={db_credentials.password} port=5432"
-data_loader_handler = DataLoader(default_db)
+# The pipeline stack (geopandas, duckdb, psycopg, plotly...) is imported on first
+# use so that the application starts and answers /health without loading it.
+@lru_cache
+def get_extraction_handler():
+    from syte_pipeline.src.ingestion import Extraction
+
+    return Extraction()
+
+
+@lru_cache
+def get_transform_handler():
+    from syte_pipeline.src.transformation import Transformer
+
+    return Transformer()
+
+
+@lru_cache
+def get_data_loader_handler():
+    from syte_pipeline.src.data_loader import DataLoader
+
+    return DataLoader(DBCredentials().conninfo)
+
+
+@lru_cache
+def get_catalog():
+    from syte_pipeline.src.catalog import Catalog
+
+    return Catalog(settings.catalog_dir, settings.prepared_dir)
+
+
+@lru_cache
+def get_run_ledger() -> RunLedger:
+    return RunLedger(settings.ledger_path)
+
+
+@lru_cache
+def get_work_queue():
+    from syte_pipeline.worker import get_work_queue
+
+    return get_work_queue(settings)
+
+
+@lru_cache
+def get_metrics_handler():
+    from syte_pipeline.src.metrics import PotentialMetrics
+
+    return PotentialMetrics(settings.metrics_cell_size)
+
+
+@lru_cache
+def get_tile_renderer():
+    from syte_pipeline.worker import get_tile_renderer
+
+    return get_tile_renderer(settings, get_catalog())
 
 
 @v1.post("/cadastral/download")
-def download_bremen_state_data() -> str:
+def download_bremen_state_data(response: Response, resume: bool = True, profile: bool = False) -> str:
     """
     Downloads and extracts Bremen state data.
+    Parameters
+    ----------
+    resume : bool, optional
+        Skip the archives already extracted today. The default is True.
+    profile : bool, optional
+        Profile the run, its id is returned in the X-Profile-Run-Id header. The default is False.
+
     Returns
     -------
     str
         suuccess or error.
 
     """
-    download_dir = os.path.join(settings.raw_dir, "day=20240801")
+    day = snapshots.today()
+    download_dir = snapshots.partition_dir(settings.raw_dir, day)
     os.makedirs(download_dir, exist_ok=True)
     zip_url = [
         "https://gdi2.geo.bremen.de/inspire/download/ADV-Shape/data/ALKIS_AdV_SHP_2024_04_HB.zip",
         "https://gdi2.geo.bremen.de/inspire/download/ADV-Shape/data/ALKIS_AdV_SHP_2024_04_BHV.zip",
     ]
-    try:
-        with ThreadPoolExecutor(max_workers=12) as executor:
-            executor.map(extraction_handler.extract_specific_files, zip_url)
-    except Exception as e:
-        return f"Error: {str(e)}"
+    with profiler.run("download", profile or settings.profiling) as run:
+        if run is not None:
+            response.headers["X-Profile-Run-Id"] = run.run_id
+        try:
+            checkpoint = get_run_ledger().run(f"download/{day}", resume)
+            with ThreadPoolExecutor(max_workers=min(len(zip_url), get_budget().download_workers)) as executor:
+                for url in zip_url:
+                    submit(
+                        executor,
+                        checkpoint.execute,
+                        f"archive/{os.path.basename(url)}",
+                        fingerprint(url),
+                        get_extraction_handler().extract_specific_files,
+                        url,
+                        download_dir,
+                    )
+            checkpoint.raise_failures()
+        except Exception as e:
+            LOG.error(f"Error: {e}")
+            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            return f"Error: {str(e)}"
     return "OK"
 
 
+def snapshot_day(base: str, day: str | None, what: str, hint: str) -> str:
+    """
+    Snapshot ``day`` of ``base``, the latest one when ``day`` is None. An
+    explicit day never falls back to an older snapshot: a malformed day is
+    rejected with 422, a missing one with 404.
+    """
+    try:
+        found = snapshots.latest_day(base) if day is None else snapshots.normalize_day(day)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Invalid day {day}, use YYYYMMDD") from None
+    if found is None or found not in snapshots.list_days(base):
+        missing = f"No {what}" if found is None else f"No {what} {found}"
+        raise HTTPException(status_code=404, detail=f"{missing}, {hint}")
+    return found
+
+
+def raw_file_map(day: str) -> dict:
+    """Source directory name to the shapefiles it contains, for a raw snapshot."""
+    file_map = {}
+    for root, _, filenames in os.walk(snapshots.partition_dir(settings.raw_dir, day)):
+        sub_dir = os.path.basename(root)
+        shp_files = [os.path.join(root, name) for name in filenames if os.path.splitext(name)[1].lower() == ".shp"]
+
+        if shp_files:
+            file_map[sub_dir] = shp_files
+    return file_map
+
+
 @v1.post("/cadastral/prepare")
-def prepare_data() -> str:
+def prepare_data(response: Response, day: str | None = None, resume: bool = True, profile: bool = False) -> str:
     """
     Prepare and transform Bremen state data. Export them into geoparquet
+    Parameters
+    ----------
+    day : str, optional
+        Raw snapshot to prepare (YYYYMMDD), 404 when there is none. The
+        default is the latest one.
+    resume : bool, optional
+        Skip the source directories already joined by a previous run of the
+        same day, false rewrites the snapshot from scratch. The default is True.
+    profile : bool, optional
+        Profile the run, its id is returned in the X-Profile-Run-Id header. The default is False.
+
     Returns
     -------
     str
         suuccess or error.
 
     """
-    raw_dir = os.path.join(settings.raw_dir, "day=20240801")
-    file_map = {}
-    try:
-        for root, _, filenames in os.walk(raw_dir):
-            sub_dir = os.path.basename(root)
-            shp_files = [
-                os.path.join(root, name)
-                for name in filenames
-                if os.path.splitext(name)[1].lower() == ".shp"
-            ]
-
-            if shp_files:
-                file_map[sub_dir] = shp_files
-
-        transform_handler.transform(file_map)
-    except Exception as e:
-        return f"Error: {str(e)}"
+    day = snapshot_day(settings.raw_dir, day, "raw snapshot", "call /cadastral/download first")
+    with profiler.run("prepare", profile or settings.profiling) as run:
+        if run is not None:
+            response.headers["X-Profile-Run-Id"] = run.run_id
+        try:
+            file_map = raw_file_map(day)
+            checkpoint = get_run_ledger().run(f"transform/{day}", resume)
+            get_transform_handler().transform(file_map, day, checkpoint)
+            from syte_pipeline.worker import finalize_prepare
+
+            finalize_prepare(settings, day, get_metrics_handler(), get_tile_renderer())
+        except Exception as e:
+            LOG.error(f"Error: {e}")
+            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            return f"Error: {str(e)}"
     return "OK"
 
 
 @v1.post("/cadastral/analytics")
-def prepare_analytics() -> str:
+def prepare_analytics(
+    response: Response,
+    day: str | None = None,
+    mode: Literal["full", "changes"] = "full",
+    parallel: bool = False,
+    workers: int | None = None,
+    resume: bool = True,
+    profile: bool = False,
+) -> str:
     """
     Create an analytical table and perform upsert of the data into the table: buildings and parcels.
+    Parameters
+    ----------
+    day : str, optional
+        Prepared snapshot to load (YYYYMMDD), 404 when there is none. The
+        default is the latest one.
+    mode : str, optional
+        full upserts every row; changes diffs the snapshot against the last
+        loaded one and only sends inserted, updated and deleted rows. It falls
+        back to full when the last loaded snapshot is gone. The default is full.
+    parallel : bool, optional
+        Full load of the district partitions by parallel workers streaming
+        with COPY. The default is False.
+    workers : int, optional
+        Number of parallel workers. The default is the load_workers of the resource budget.
+    resume : bool, optional
+        Skip the batches and partitions already loaded by an unfinished run
+        of the same day and mode on top of the same loaded snapshot. The
+        default is True.
+    profile : bool, optional
+        Profile the run, its id is returned in the X-Profile-Run-Id header. The default is False.
+
     Returns
     -------
     str
         suuccess or error.
 
     """
-    prepared_file = os.path.join(settings.prepared_dir, "day=20240801")
-    prepared_filenames = glob.glob(f"{prepared_file}/*.parquet")
+    day = snapshot_day(settings.prepared_dir, day, "prepared snapshot", "call /cadastral/prepare first")
+    prepared_file = snapshots.partition_dir(settings.prepared_dir, day)
+    prepared_filenames = sorted(glob.glob(f"{prepared_file}/*.parquet"))
     batch_size = 10
-    batches = [
-        (prepared_filenames[i : i + batch_size])
-        for i in range(0, len(prepared_filenames), batch_size)
-    ]
-    try:
-        data_loader_handler.create_db_objects()
-        for batch in batches:
-            data_loader_handler.export_building_parcel_data_to_psql(batch)
-        logging.info("export ended")
-    except Exception as e:
-        return f"Error: {str(e)}"
+    batches = [(prepared_filenames[i : i + batch_size]) for i in range(0, len(prepared_filenames), batch_size)]
+    with profiler.run("analytics", profile or settings.profiling) as run:
+        if run is not None:
+            response.headers["X-Profile-Run-Id"] = run.run_id
+        try:
+            previous_day = snapshots.read_marker(settings.prepared_dir, "loaded_day")
+            # A run loads on top of the snapshot in postgres: resume it only on the same one.
+            checkpoint = get_run_ledger().run(f"analytics/{day}/{mode}/{previous_day or 'empty'}", resume)
+            data_loader_handler = get_data_loader_handler()
+            schema = data_loader_handler.schema
+            data_loader_handler.create_db_objects()
+            # One prepared file per district, named after it.
+            schema.ensure_partitions([os.path.splitext(os.path.basename(f))[0] for f in prepared_filenames])
+            previous_filenames = []
+            if mode == "changes" and previous_day not in (None, day):
+                previous_filenames = glob.glob(
+                    f"{snapshots.partition_dir(settings.prepared_dir, previous_day)}/*.parquet"
+                )
+            if not previous_filenames:
+                # Full reload: indexes are rebuilt once at the end instead of per row.
+                schema.drop_secondary_indexes()
+            try:
+                if previous_filenames:
+                    LOG.info(f"Loading changes between {previous_day} and {day}")
+                    checkpoint.execute(
+                        f"changes/{previous_day}",
+                        fingerprint(prepared_filenames, previous_filenames),
+                        data_loader_handler.export_snapshot_changes_to_psql,
+                        prepared_filenames,
+                        previous_filenames,
+                    )
+                elif parallel:
+                    data_loader_handler.export_partitions_in_parallel(
+                        prepared_filenames, max(1, workers or get_budget().load_workers), checkpoint
+                    )
+                else:
+                    # Same owners as the parallel load, whichever batch a duplicate falls in.
+                    owners = data_loader_handler.conflict_owners(prepared_filenames) if prepared_filenames else {}
+                    for i, batch in enumerate(batches):
+                        checkpoint.execute(
+                            f"batch/{i}",
+                            fingerprint(batch),
+                            data_loader_handler.export_building_parcel_data_to_psql,
+                            batch,
+                            owners,
+                        )
+            finally:
+                # Indexes are rebuilt even after a failure, the tables stay usable until the resume.
+                try:
+                    schema.create_secondary_indexes()
+                finally:
+                    schema.analyze()
+            checkpoint.raise_failures()
+            if checkpoint.completed:
+                snapshots.write_marker(settings.prepared_dir, "loaded_day", day)
+            else:
+                LOG.warning(f"Nothing was loaded, loaded_day stays {previous_day}")
+            checkpoint.finish()
+            logging.info("export ended")
+        except Exception as e:
+            LOG.error(f"Error: {e}")
+            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            return f"Error: {str(e)}"
     return "OK"
 
 
-def read_prepared_sql() -> str:
-    dir = join(settings.prepared_dir, "*", "*.parquet")
-    return f"read_parquet('{dir}', hive_partitioning = 1, hive_types_autocast = 0)"
+def read_prepared_sql(as_of: str | None = None) -> str:
+    """
+    Catalog view of a single prepared snapshot, the latest one taken on or
+    before ``as_of``. Run the query on a get_catalog().cursor().
+    """
+    try:
+        source = get_catalog().source(as_of)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Invalid as_of {as_of}, use YYYYMMDD") from None
+    if source is None:
+        raise HTTPException(status_code=404, detail="No prepared snapshot available")
+    return source
+
+
+def geometry_sql(column: str, lod: int = 0, precision: int | None = None) -> str:
+    """WKT expression of a geometry column at a level of detail and coordinate precision."""
+    if not 0 <= lod <= len(settings.lod_tolerances):
+        raise HTTPException(status_code=422, detail=f"lod must be between 0 and {len(settings.lod_tolerances)}")
+    expression = f"ST_GeomFromWKB({column}_lod{lod})" if lod else f"ST_GeomFromWKB({column})"
+    if precision is not None:
+        if not 0 <= precision <= 15:
+            raise HTTPException(status_code=422, detail="precision must be between 0 and 15")
+        expression = f"ST_ReducePrecision({expression}, {10.0**-precision})"
+    return f"ST_AsText({expression})"
 
 
 @v1.get("/cadastral/")
-def list_cadastral(num_results: int = 100, page: int = 0) -> list[dict]:
+def list_cadastral(
+    num_results: int = 100,
+    page: int = 0,
+    as_of: str | None = None,
+    lod: int = 0,
+    precision: int | None = None,
+) -> list[dict]:
     """
     List all the available cadastral, building and parcel order by district
     Parameters
@@ -145,24 +362,32 @@ def list_cadastral(num_results: int = 100, page: int = 0) -> list[dict]:
         DESCRIPTION. The default is 100.
     page : int, optional
         DESCRIPTION. The default is 0.
+    as_of : str, optional
+        Read the snapshot of this day (YYYYMMDD) or the one before. The default is the latest.
+    lod : int, optional
+        Level of detail of the geometry, 0 is full precision and n uses the
+        n-th entry of settings.lod_tolerances, 422 when the snapshot was
+        prepared without it. The default is 0.
+    precision : int, optional
+        Number of decimals of the WKT coordinates. The default is None (all).
 
     Returns
     -------
     list[dict]
 
     """
-    res = duckdb.sql(
-        f"""
-    INSTALL spatial;
-    LOAD spatial;
-    INSTALL parquet;
-    LOAD parquet;
-    SET memory_limit = '5GB';
-    SET threads TO 8;
-
+    from syte_pipeline.src.catalog import source_columns
+
+    source = read_prepared_sql(as_of)
+    geometry = geometry_sql("geometry", lod, precision)
+    with get_catalog().cursor() as cursor:
+        if lod and f"geometry_lod{lod}" not in source_columns(cursor, source):
+            raise HTTPException(status_code=422, detail=f"lod {lod} is not available in this snapshot")
+        rows = cursor.sql(
+            f"""
     SELECT DISTINCT
         building_identifier,
-        ST_AsText(ST_GeomFromWKB(geometry)) AS geometry,
+        {geometry} AS geometry,
         building_area,
         num_floors,
         on_parcel,
@@ -174,10 +399,10 @@ def list_cadastral(num_results: int = 100, page: int = 0) -> list[dict]:
         cadastral_identifier,
         municipal,
         district
-    FROM {read_prepared_sql()}
+    FROM {source}
     ORDER BY district LIMIT {num_results} OFFSET {num_results * page}
     """,
-    )
+        ).fetchall()
     return [
         {
             "building_identifier": building_identifier,
@@ -194,14 +419,12 @@ def list_cadastral(num_results: int = 100, page: int = 0) -> list[dict]:
             "municipal": municipal,
             "district": district,
         }
-        for building_identifier, geometry, building_area, num_floors, n_parcel, type, building_date, parcel_identifier, location_text, parcel_area, cadastral_identifier, municipal, district in res.fetchall()
+        for building_identifier, geometry, building_area, num_floors, n_parcel, type, building_date, parcel_identifier, location_text, parcel_area, cadastral_identifier, municipal, district in rows
     ]
 
 
 @v1.get("/cadastral/land_use")
-def get_district_potential_building(
-    num_results: int = 1000, page: int = 0
-) -> list[dict]:
+def get_district_potential_building(num_results: int = 1000, page: int = 0, as_of: str | None = None) -> list[dict]:
     """
     Get most popular land use per district
     Parameters
@@ -210,20 +433,24 @@ def get_district_potential_building(
         DESCRIPTION. The default is 1000.
     page : int, optional
         DESCRIPTION. The default is 0.
+    as_of : str, optional
+        Read the snapshot of this day (YYYYMMDD) or the one before. The default is the latest.
 
     Returns
     -------
     list[dict]
 
     """
-    res = duckdb.sql(
-        f"""
+    source = read_prepared_sql(as_of)
+    with get_catalog().cursor() as cursor:
+        rows = cursor.sql(
+            f"""
         WITH parcel_counts AS (
             SELECT
                 district,
                 type,
                 SUM(building_area) AS total_building_area
-            FROM {read_prepared_sql()}
+            FROM {source}
             GROUP BY district, type
         ),
         ranked_parcels AS (
@@ -243,46 +470,97 @@ def get_district_potential_building(
         ORDER BY total_building_area LIMIT {num_results} OFFSET {num_results * page}
         ;
                 """
-    )
-    rows = res.fetchall()
-    if not rows:
-        return []
+        ).fetchall()
     return [
         {
             "district": district,
             "most_popular_land_type": most_popular_land_type,
             "total_building_area": total_building_area,
         }
-        for district, most_popular_land_type, total_building_area in res.fetchall()
+        for district, most_popular_land_type, total_building_area in rows
     ]
 
 
+def plotly_js_url() -> str:
+    """Versioned URL of plotly.js, served by get_plotly_js instead of being inlined in every plot."""
+    import plotly
+
+    return f"{v1.prefix}/static/plotly-{plotly.__version__}.min.js"
+
+
+@lru_cache
+def plotly_js() -> bytes:
+    from plotly.offline import get_plotlyjs
+
+    return get_plotlyjs().encode()
+
+
+@v1.get(
+    "/static/plotly-{version}.min.js",
+    response_class=Response,
+    responses={200: {"content": {"application/javascript": {}}}},
+)
+def get_plotly_js(version: str) -> Response:
+    """
+    plotly.js bundle of the installed plotly version, cached by the browsers for a year.
+    Parameters
+    ----------
+    version : str
+        plotly version, the URL changes with it.
+
+    Returns
+    -------
+    Response
+
+    """
+    import plotly
+
+    if version != plotly.__version__:
+        raise HTTPException(status_code=404, detail=f"plotly.js {version} is not available")
+    return Response(
+        content=plotly_js(),
+        media_type="application/javascript",
+        headers={"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"plotly-{version}"'},
+    )
+
+
 @v1.get("/cadastral/district_parcel_areas", response_class=HTMLResponse)
-def district_parcel_areas():
+def district_parcel_areas(as_of: str | None = None):
     """
     Show the plot of the districts with most potential new buildings.
+    Parameters
+    ----------
+    as_of : str, optional
+        Read the snapshot of this day (YYYYMMDD) or the one before. The default is the latest.
+
     Returns
     -------
     TYPE
         DESCRIPTION.
 
     """
+    import plotly.express as px
+    from plotly.io import to_html
+
+    source = read_prepared_sql(as_of)
     try:
-        data = duckdb.sql(
-            f"""
-        INSTALL spatial;
-        LOAD spatial;
-        INSTALL parquet;
-        LOAD parquet;
-        SET memory_limit = '5GB';
-        SET threads TO 8;
-        with parcel_building_areas as (
+        with get_catalog().cursor() as cursor:
+            data = cursor.sql(
+                f"""
+        with parcels as (
+           SELECT DISTINCT ON (parcel_identifier) district, parcel_area FROM {source}
+        ),
+        buildings as (
+           SELECT DISTINCT ON (building_identifier) district, building_area FROM {source}
+        ),
+        parcel_building_areas as (
            SELECT
-               district,
-               sum(parcel_area) AS total_parcel_area,
-               SUM(building_area) as total_building_area
-           FROM {read_prepared_sql()}
-           GROUP BY district
+               p.district,
+               p.total_parcel_area,
+               b.total_building_area
+           FROM (SELECT district, sum(parcel_area) AS total_parcel_area FROM parcels GROUP BY district) p
+           JOIN (SELECT district, SUM(building_area) AS total_building_area FROM buildings GROUP BY district) b
+           USING (district)
                 )
         SELECT
             district,
@@ -291,7 +569,7 @@ def district_parcel_areas():
         ORDER BY area_ratio desc limit 10
         ;
         """
-        ).to_df()
+            ).to_df()
         fig = px.bar(
             data,
             x="district",
@@ -300,7 +578,7 @@ def district_parcel_areas():
             title="The district with more potentials for new buildings",
         )
 
-        plot_div = to_html(fig, full_html=False)
+        plot_div = to_html(fig, full_html=False, include_plotlyjs=plotly_js_url())
 
         html_content = f"""
         <html>
@@ -315,3 +593,293 @@ def district_parcel_areas():
         return HTMLResponse(content=html_content)
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Not not show the plot: {e}")
+
+
+@v1.get("/cadastral/potential")
+def get_building_potential(
+    level: Literal["cell", "parcel"] = "cell",
+    order_by: Literal["free_area", "coverage_ratio", "floor_area_ratio"] = "free_area",
+    num_results: int = 10,
+    district: str | None = None,
+    as_of: str | None = None,
+) -> list[dict]:
+    """
+    Grid cells or parcels with the most potential for new buildings: the most
+    free area, or the lowest coverage or floor-area ratio.
+    Parameters
+    ----------
+    level : str, optional
+        cell (grid of settings.metrics_cell_size metres) or parcel. The default is cell.
+    order_by : str, optional
+        Metric used for the ranking. The default is free_area.
+    num_results : int, optional
+        DESCRIPTION. The default is 10.
+    district : str, optional
+        Only rank the parcels of this district. The default is None.
+    as_of : str, optional
+        Read the snapshot of this day (YYYYMMDD) or the one before. The default is the latest.
+
+    Returns
+    -------
+    list[dict]
+
+    """
+    try:
+        day = snapshots.latest_day(settings.metrics_dir, as_of)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Invalid as_of {as_of}, use YYYYMMDD") from None
+    if day is None:
+        raise HTTPException(status_code=404, detail="No building potential metrics available")
+    name = "grid" if level == "cell" else "parcels"
+    path = join(snapshots.partition_dir(settings.metrics_dir, day), f"{name}.parquet")
+    direction = "DESC" if order_by == "free_area" else "ASC"
+    where, params = "", []
+    if district is not None:
+        if level == "cell":
+            raise HTTPException(status_code=422, detail="district only applies to level=parcel")
+        where, params = "WHERE district = ?", [district]
+    with get_catalog().cursor() as cursor:
+        res = cursor.execute(
+            f"""
+            SELECT * EXCLUDE (geometry), ST_AsText(ST_GeomFromWKB(geometry)) AS geometry
+            FROM read_parquet('{path}', hive_partitioning = false)
+            {where}
+            ORDER BY {order_by} {direction} NULLS LAST
+            LIMIT {num_results}
+            """,
+            params,
+        )
+        columns = [d[0] for d in res.description]
+        rows = res.fetchall()
+    return [dict(zip(columns, row, strict=True)) for row in rows]
+
+
+@v1.post("/cadastral/queue/prepare")
+def queue_prepare_data(response: Response, day: str | None = None) -> str:
+    """
+    Queue the transformation of a raw snapshot, one unit per source directory,
+    and its finalize unit, which publishes the snapshot once they are done.
+    The units write into a staging directory, the prepared snapshot being
+    served is only replaced by the finalize unit.
+    Parameters
+    ----------
+    day : str, optional
+        Raw snapshot to prepare (YYYYMMDD), 404 when there is none. The
+        default is the latest one.
+
+    Returns
+    -------
+    str
+        suuccess or error.
+
+    """
+    day = snapshot_day(settings.raw_dir, day, "raw snapshot", "call /cadastral/download first")
+    run = f"{day}/{snapshots.new_generation()}"
+    staging_dir = join(settings.staging_dir, run.replace("/", "-"))
+    try:
+        units = {
+            f"{run}/{sub_dir}": {"files": files, "output_dir": staging_dir}
+            for sub_dir, files in raw_file_map(day).items()
+        }
+        if not units:
+            raise HTTPException(status_code=404, detail=f"No source directory in the raw snapshot {day}")
+        work_queue = get_work_queue()
+        work_queue.enqueue("transform", units)
+        work_queue.enqueue("finalize", {run: {"day": day, "prefix": f"{run}/", "staging_dir": staging_dir}})
+    except HTTPException:
+        raise
+    except Exception as e:
+        LOG.error(f"Error: {e}")
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return f"Error: {str(e)}"
+    return "OK"
+
+
+@v1.post("/cadastral/queue/analytics")
+def queue_prepare_analytics(response: Response, day: str | None = None) -> str:
+    """
+    Queue the load of a prepared snapshot, one unit per district partition,
+    for the syte_worker processes, and its load_finalize unit, which rebuilds
+    the indexes and records the snapshot as loaded once they all succeeded.
+    Parameters
+    ----------
+    day : str, optional
+        Prepared snapshot to load (YYYYMMDD), 404 when there is none. The
+        default is the latest one.
+
+    Returns
+    -------
+    str
+        suuccess or error.
+
+    """
+    day = snapshot_day(settings.prepared_dir, day, "prepared snapshot", "call /cadastral/prepare first")
+    prepared_filenames = sorted(glob.glob(f"{snapshots.partition_dir(settings.prepared_dir, day)}/*.parquet"))
+    districts = {os.path.splitext(os.path.basename(f))[0]: f for f in prepared_filenames}
+    try:
+        data_loader_handler = get_data_loader_handler()
+        data_loader_handler.create_db_objects()
+        data_loader_handler.schema.ensure_partitions(list(districts))
+        # Same owners as the parallel load, whichever worker loads a partition first.
+        owners = data_loader_handler.conflict_owners(prepared_filenames) if prepared_filenames else {}
+        run = f"{day}/{snapshots.new_generation()}"
+        work_queue = get_work_queue()
+        work_queue.enqueue(
+            "load",
+            {
+                f"{run}/{district}": {
+                    "file": f,
+                    "owners": [
+                        [table, identifier, owner] for (table, identifier), owner in owners.items() if owner != f
+                    ],
+                }
+                for district, f in districts.items()
+            },
+        )
+        work_queue.enqueue("load_finalize", {run: {"day": day, "prefix": f"{run}/"}})
+    except Exception as e:
+        LOG.error(f"Error: {e}")
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return f"Error: {str(e)}"
+    return "OK"
+
+
+@v1.get("/cadastral/queue/{name}")
+def get_queue_stats(name: Literal["transform", "finalize", "load", "load_finalize"]) -> dict:
+    """
+    Progress of a work queue.
+    Parameters
+    ----------
+    name : str
+        transform, finalize, load or load_finalize.
+
+    Returns
+    -------
+    dict
+        Number of units per status and the error of the failed ones.
+
+    """
+    work_queue = get_work_queue()
+    return {"units": work_queue.stats(name), "failures": work_queue.failures(name)}
+
+
+@v1.get(
+    "/cadastral/tiles/{z}/{x}/{y}.mvt",
+    response_class=Response,
+    responses={200: {"content": {"application/vnd.mapbox-vector-tile": {}}}},
+)
+def get_tile(z: int, x: int, y: int) -> Response:
+    """
+    Mapbox Vector Tile with a buildings and a parcels layer, from the latest snapshot.
+    Parameters
+    ----------
+    z : int
+        Zoom level.
+    x : int
+        Tile column.
+    y : int
+        Tile row (XYZ scheme, 0 at the top).
+
+    Returns
+    -------
+    Response
+
+    """
+    from syte_pipeline.src.tiles import MAX_ZOOM
+
+    if not (0 <= z <= MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z):
+        raise HTTPException(status_code=404, detail=f"No tile {z}/{x}/{y}")
+    data = get_tile_renderer().tile(z, x, y)
+    if data is None:
+        raise HTTPException(status_code=404, detail="No prepared snapshot available")
+    return Response(content=data, media_type="application/vnd.mapbox-vector-tile")
+
+
+@v1.get("/admin/resources")
+def get_resources() -> dict:
+    """
+    Effective resource budget: the detected (or overridden) CPU and memory
+    limits and their split between the pipeline and the queries.
+
+    Returns
+    -------
+    dict
+
+    """
+    return get_budget().to_dict()
+
+
+@v1.get("/admin/runs")
+def get_run(run: str) -> dict:
+    """
+    Units recorded by a pipeline run.
+    Parameters
+    ----------
+    run : str
+        download/<day>, transform/<day> or analytics/<day>/<mode>/<loaded day>,
+        the units of a successful analytics run are forgotten.
+
+    Returns
+    -------
+    dict
+        Unit to its status, attempts, last error and duration in seconds.
+
+    """
+    units = get_run_ledger().units(run)
+    if not units:
+        raise HTTPException(status_code=404, detail=f"No run {run}")
+    return units
+
+
+@v1.get("/admin/profiles")
+def list_profiles() -> list[dict]:
+    """
+    List the profiled runs still kept in memory, newest first.
+    Returns
+    -------
+    list[dict]
+
+    """
+    return profiler.list_runs()
+
+
+@v1.get("/admin/profiles/{run_id}", response_class=HTMLResponse)
+def get_profile(run_id: str, stage: str | None = None):
+    """
+    Show the profile of a run: stage timings, peak memory and profiler output.
+    Parameters
+    ----------
+    run_id : str
+        Value of the X-Profile-Run-Id header of the profiled call.
+    stage : str, optional
+        Show the flame graph of a single stage. The default is None.
+
+    Returns
+    -------
+    HTMLResponse
+
+    """
+    run = profiler.get(run_id)
+    if run is None or (stage is not None and stage not in run.stages):
+        raise HTTPException(status_code=404, detail=f"No profile for run {run_id}")
+    return HTMLResponse(content=run.to_html(stage))
+
+
+@v1.get("/admin/profiles/{run_id}/stats")
+def get_profile_stats(run_id: str) -> dict:
+    """
+    Raw statistics of a profiled run.
+    Parameters
+    ----------
+    run_id : str
+        Value of the X-Profile-Run-Id header of the profiled call.
+
+    Returns
+    -------
+    dict
+
+    """
+    run = profiler.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"No profile for run {run_id}")
+    return run.raw_stats()
@@ -1,4 +1,5 @@
 from os.path import dirname, join
+from typing import Optional
 
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -21,14 +22,63 @@ class DBCredentials(BaseSettings):
     password: str
     model_config = SettingsConfigDict(env_prefix="syte_db_")
 
+    @property
+    def conninfo(self) -> str:
+        return f"user={self.user} host={self.host} password={self.password} port={self.port}"
 
-class Settings(BaseSettings):
 
+class Settings(BaseSettings):
     local_dir: str = Field(
         default=join(SYTE_LOCAL_DIR, "syte_data"),
         description="For any other value set env variable 'SYTE_LOCAL_DIR'",
     )
     telemetry_dsn: str = "http://project2_secret_token@uptrace:14317/2"
+    profiling: bool = Field(
+        default=False,
+        description="Profile every pipeline run, not only the ones called with ?profile=true",
+    )
+    profiler: str = Field(default="cprofile", description="cprofile or pyinstrument")
+    profile_history: int = Field(default=10, description="Number of profiled runs kept in memory")
+    load_workers: Optional[int] = Field(
+        default=None,
+        description="Parallel postgres loaders, tune against the postgres CPU count. Default one per pipeline thread",
+    )
+    cpu_limit: Optional[float] = Field(
+        default=None, description="CPUs of the process, overrides the cgroup limit (or the host CPU count)"
+    )
+    memory_limit_mb: Optional[int] = Field(
+        default=None, description="Memory of the process in MB, overrides the cgroup limit (or the host memory)"
+    )
+    pipeline_share: float = Field(
+        default=0.5, description="Share of the CPU and memory budget of the pipeline, the rest goes to the queries"
+    )
+    memory_headroom: float = Field(
+        default=0.25, description="Share of the memory not given to DuckDB (Python, geopandas, page cache)"
+    )
+    snapshot_retention: int = Field(default=3, description="Number of day= snapshots kept")
+    snapshot_max_age_days: Optional[int] = Field(
+        default=None, description="Snapshots older than this are deleted, the latest one is always kept"
+    )
+    tile_prerender_max_zoom: int = Field(
+        default=12, description="Vector tiles up to this zoom are rendered at the end of prepare"
+    )
+    tile_cache_size: int = Field(default=2048, description="Vector tiles kept in memory")
+    lod_tolerances: list[float] = Field(
+        default=[0.00001, 0.0001, 0.001],
+        description="Simplification tolerances in degrees of the geometry_lod<n> columns (lod=1, 2...)",
+    )
+    compression_min_size: int = Field(
+        default=1024, description="Responses from this size in bytes are compressed (zstd or gzip)"
+    )
+    http_cache_max_age: int = Field(
+        default=60, description="Cache-Control max-age in seconds of the dataset endpoints, revalidated by ETag"
+    )
+    metrics_cell_size: float = Field(default=250.0, description="Side in metres of the building potential grid")
+    queue_backend: str = Field(
+        default="sqlite", description="Work queue of the workers: sqlite (one machine) or postgres"
+    )
+    queue_lease_seconds: int = Field(default=600, description="Lease of a unit of work, renewed by heartbeats")
+    queue_max_attempts: int = Field(default=3, description="Attempts before a unit of work is failed")
 
     model_config = SettingsConfigDict(env_prefix="syte_pipeline_")
 
@@ -40,3 +90,33 @@ class Settings(BaseSettings):
     @property
     def prepared_dir(self) -> str:
         return join(self.local_dir, "prepared")
+
+    @property
+    def staging_dir(self) -> str:
+        """Snapshots written by the workers, moved into prepared once complete"""
+        return join(self.local_dir, "staging")
+
+    @property
+    def metrics_dir(self) -> str:
+        """Building potential metrics, one day= partition per prepared snapshot"""
+        return join(self.local_dir, "metrics")
+
+    @property
+    def queue_path(self) -> str:
+        """sqlite file of the work queue"""
+        return join(self.local_dir, "work_queue.sqlite")
+
+    @property
+    def catalog_dir(self) -> str:
+        """DuckDB catalogs of the prepared snapshots, one file per generation"""
+        return join(self.local_dir, "catalog")
+
+    @property
+    def ledger_path(self) -> str:
+        """sqlite file of the run ledger, checkpoints of the pipeline runs"""
+        return join(self.local_dir, "run_ledger.sqlite")
+
+    @property
+    def tiles_dir(self) -> str:
+        """Disk cache of the vector tiles"""
+        return join(self.local_dir, "tiles")
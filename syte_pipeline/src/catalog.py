@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent DuckDB catalog of the prepared snapshots.
+
+The catalog file holds one view per snapshot (prepared_<day>) and
+prepared_latest, each reading an explicit list of parquet files, so queries
+neither list directories nor glob. It is rebuilt at the end of a prepare, as
+<catalog_dir>/<generation>.duckdb, before the generation is published. The API
+queries the DuckDB instance of the query workload (see resources), with the
+object cache enabled: the parquet footers and schemas are read once per
+process, not once per request. The catalog of the current generation is
+attached to it read-only, a new generation attaches its own file and the
+previous one is detached once its last cursor is closed.
+"""
+
+from syte_pipeline.src import snapshots
+from syte_pipeline.src.resources import duckdb_instance
+from contextlib import contextmanager
+from os.path import join
+from typing import Iterator, Optional
+import glob
+import logging
+import os
+import re
+import threading
+import duckdb
+
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
+
+LATEST_VIEW = "prepared_latest"
+
+# Catalog files attached to the query instance, shared by the Catalogs of the
+# process (DuckDB attaches a file once): alias to the number of Catalogs serving
+# it plus their open cursors, it is detached when none is left.
+_attached: dict[str, int] = {}
+_attached_lock = threading.Lock()
+
+
+def view_name(day: str) -> str:
+    return f"prepared_{day}"
+
+
+def parquet_source(files: list[str]) -> str:
+    """read_parquet over explicit files; the day column comes from the day= directory."""
+    listing = ", ".join(f"'{f}'" for f in files)
+    return f"read_parquet([{listing}], hive_partitioning = 1, hive_types_autocast = 0)"
+
+
+def source_columns(cursor: duckdb.DuckDBPyConnection, source: str) -> list[str]:
+    """Columns of a table expression, from the parquet schemas only."""
+    return cursor.sql(f"SELECT * FROM {source} LIMIT 0").columns
+
+
+def catalog_path(catalog_dir: str, generation: str) -> str:
+    return join(catalog_dir, f"{generation}.duckdb")
+
+
+def build_catalog(prepared_dir: str, catalog_dir: str) -> str:
+    """
+    Write the catalog of every prepared snapshot for a new generation and
+    remove the catalogs older than the published one. Publish it with
+    snapshots.bump_generation.
+    Parameters
+    ----------
+    prepared_dir : str
+        Directory of the prepared snapshots.
+    catalog_dir : str
+        Directory of the catalog files.
+
+    Returns
+    -------
+    str
+        The generation of the catalog.
+
+    """
+    generation = snapshots.new_generation()
+    path = catalog_path(catalog_dir, generation)
+    os.makedirs(catalog_dir, exist_ok=True)
+    tmp = f"{path}.tmp"
+    days = []
+    con = duckdb.connect(tmp)
+    try:
+        con.sql("CREATE TABLE snapshots (day VARCHAR PRIMARY KEY, view VARCHAR, files VARCHAR[])")
+        for day in snapshots.list_days(prepared_dir):
+            files = sorted(glob.glob(join(snapshots.partition_dir(prepared_dir, day), "*.parquet")))
+            if not files:
+                continue
+            con.sql(f"CREATE VIEW {view_name(day)} AS SELECT * FROM {parquet_source(files)}")
+            con.execute("INSERT INTO snapshots VALUES (?, ?, ?)", [day, view_name(day), files])
+            days.append(day)
+            latest_files = files
+        if days:
+            # Views of an attached catalog only resolve other views with USE, read the files directly.
+            con.sql(f"CREATE VIEW {LATEST_VIEW} AS SELECT * FROM {parquet_source(latest_files)}")
+    finally:
+        con.close()
+    os.replace(tmp, path)
+    remove_old_catalogs(catalog_dir, snapshots.generation(prepared_dir), generation)
+    LOG.info(f"Catalog {path} written with {len(days)} snapshots")
+    return generation
+
+
+def remove_old_catalogs(catalog_dir: str, published: str, keep: str) -> list[str]:
+    """
+    Remove the catalogs of the generations older than the published one. The
+    published catalog is read until the next generation is bumped, and other
+    builders may be writing (.tmp) or about to publish a newer one: those are kept.
+    Parameters
+    ----------
+    catalog_dir : str
+        Directory of the catalog files.
+    published : str
+        Generation currently published.
+    keep : str
+        Generation just built, not published yet.
+
+    Returns
+    -------
+    list[str]
+        The removed generations.
+
+    """
+    removed = []
+    for name in os.listdir(catalog_dir):
+        generation, ext = os.path.splitext(name)
+        if ext != ".duckdb" or generation in (published, keep) or generation > published:
+            continue
+        try:
+            # Open connections keep reading their file, removing it is safe.
+            os.remove(join(catalog_dir, name))
+        except FileNotFoundError:
+            continue
+        removed.append(generation)
+    return removed
+
+
+class Catalog:
+    """
+    Current catalog attached to the query instance, one cursor per query.
+    """
+
+    def __init__(self, catalog_dir: str, prepared_dir: str):
+        """
+
+        Parameters
+        ----------
+        catalog_dir : str
+            Directory of the catalog files written by build_catalog.
+        prepared_dir : str
+            Directory of the prepared snapshots, its generation marker tells
+            which catalog is current.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.catalog_dir = catalog_dir
+        self.prepared_dir = prepared_dir
+        self._con: Optional[duckdb.DuckDBPyConnection] = None
+        self._generation: Optional[str] = None
+        # Database name of the attached catalog, None without a catalog file.
+        self._alias: Optional[str] = None
+        self._days: list[str] = []
+        self._lock = threading.Lock()
+
+    def _connection(self) -> duckdb.DuckDBPyConnection:
+        if self._con is None:
+            con = duckdb_instance("query")
+            try:
+                con.sql("SET enable_object_cache = true")
+            except duckdb.Error as e:
+                LOG.debug(f"Object cache not enabled: {e}")
+            self._con = con
+        return self._con
+
+    def _refresh(self) -> None:
+        generation = snapshots.generation(self.prepared_dir)
+        if self._con is not None and generation == self._generation:
+            return
+        con = self._connection()
+        path = catalog_path(self.catalog_dir, generation)
+        alias = None
+        days = []
+        if os.path.exists(path):
+            alias = "catalog_" + re.sub(r"\W", "_", generation)
+            self._acquire(alias, path)
+            days = [row[0] for row in con.sql(f"SELECT day FROM {alias}.snapshots ORDER BY day").fetchall()]
+        else:
+            LOG.warning(f"No catalog at {path}, the snapshots are read from their directories.")
+        # The previous catalog stays attached until its last cursor is closed.
+        self._release(self._alias)
+        self._alias, self._generation, self._days = alias, generation, days
+
+    def _acquire(self, alias: str, path: Optional[str] = None) -> None:
+        with _attached_lock:
+            if alias not in _attached:
+                self._con.sql(f"ATTACH '{path}' AS {alias} (READ_ONLY)")
+                _attached[alias] = 0
+            _attached[alias] += 1
+
+    def _release(self, alias: Optional[str]) -> None:
+        if alias is None:
+            return
+        with _attached_lock:
+            _attached[alias] -= 1
+            if _attached[alias] == 0:
+                del _attached[alias]
+                self._con.sql(f"DETACH {alias}")
+                LOG.debug(f"Detached the catalog {alias}")
+
+    @contextmanager
+    def cursor(self) -> Iterator[duckdb.DuckDBPyConnection]:
+        """Cursor on the current catalog, closed when the block exits."""
+        with self._lock:
+            self._refresh()
+            alias = self._alias
+            if alias is not None:
+                self._acquire(alias)
+            cursor = self._con.cursor()
+        try:
+            if alias is not None:
+                cursor.sql(f"USE {alias}")
+            yield cursor
+        finally:
+            cursor.close()
+            self._release(alias)
+
+    def source(self, as_of: Optional[str] = None) -> Optional[str]:
+        """
+        Table expression of the latest snapshot taken on or before ``as_of``:
+        its view when the catalog has it, a read_parquet of its files otherwise.
+        Parameters
+        ----------
+        as_of : str, optional
+            YYYYMMDD or YYYY-MM-DD. The default is None (the latest snapshot).
+
+        Returns
+        -------
+        str or None
+            None when there is no matching snapshot.
+
+        Raises
+        ------
+        ValueError
+            When ``as_of`` is not a day.
+
+        """
+        with self._lock:
+            self._refresh()
+            days = self._days
+        if days:
+            if as_of is None:
+                return LATEST_VIEW
+            limit = snapshots.normalize_day(as_of)
+            matching = [day for day in days if day <= limit]
+            if matching:
+                return view_name(matching[-1])
+        day = snapshots.latest_day(self.prepared_dir, as_of)
+        if day is None:
+            return None
+        files = sorted(glob.glob(join(snapshots.partition_dir(self.prepared_dir, day), "*.parquet")))
+        return parquet_source(files) if files else None
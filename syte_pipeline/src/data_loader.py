@@ -5,10 +5,19 @@ Created on Fri Aug 02 18:40:21 2024
 
 @author: johnomole
 """
+
 from syte_pipeline.settings import Settings
+from syte_pipeline.src.profiling import stage, submit
+from syte_pipeline.src.ledger import Checkpoint, fingerprint
+from syte_pipeline.src.resources import duckdb_cursor
+from syte_pipeline.src.schema import SchemaManager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator, Optional
 import os
+import queue
+import threading
 import psycopg
-import duckdb
 import logging
 from opentelemetry import trace
 
@@ -19,10 +28,144 @@ logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
 LOG = logging.getLogger(__name__)
 LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
 
-conn = duckdb.connect()
 settings = Settings()
 
 
+BUILDING_COLUMNS = [
+    "building_identifier",
+    "geometry",
+    "building_area",
+    "num_floors",
+    "on_parcel",
+    "type",
+    "building_date",
+    "district",
+]
+PARCEL_COLUMNS = [
+    "parcel_identifier",
+    "parcel_geometry",
+    "parcel_area",
+    "location_text",
+    "cadastral_identifier",
+    "district",
+    "municipal",
+]
+
+# COPY goes into per-connection staging tables which are merged with an upsert.
+STAGING_TABLES = {
+    "buildings": """
+        CREATE TEMP TABLE IF NOT EXISTS buildings_staging (
+            identifier VARCHAR,
+            geometry TEXT,
+            area FLOAT,
+            num_floors INTEGER,
+            on_parcel VARCHAR,
+            type VARCHAR,
+            building_date date,
+            district VARCHAR
+        ) ON COMMIT DELETE ROWS;
+    """,
+    "parcels": """
+        CREATE TEMP TABLE IF NOT EXISTS parcels_staging (
+            identifier VARCHAR,
+            geometry TEXT,
+            area FLOAT,
+            location_text VARCHAR,
+            cadastral_identifier VARCHAR,
+            district VARCHAR,
+            municipal VARCHAR
+        ) ON COMMIT DELETE ROWS;
+    """,
+}
+# The primary key includes the district: an identifier which moved to another
+# district would otherwise keep its row there, next to the new one.
+DELETE_MOVED = {
+    table: f"""
+        DELETE FROM {table} t
+        USING unnest(%s::varchar[], %s::varchar[]) AS n(identifier, district)
+        WHERE t.identifier = n.identifier AND t.district <> n.district;
+    """
+    for table in ("buildings", "parcels")
+}
+MERGE_STAGING = {
+    "buildings": """
+        DELETE FROM buildings t
+        USING buildings_staging s
+        WHERE t.identifier = s.identifier AND t.district <> s.district;
+
+        INSERT INTO buildings (identifier, geometry, area, num_floors, on_parcel, type, building_date, district)
+        SELECT identifier, ST_Multi(ST_GeomFromText(geometry, 4326)), area, num_floors, on_parcel, type,
+               building_date, district
+        FROM buildings_staging
+        ON CONFLICT (identifier, district)
+        DO UPDATE SET
+            geometry = EXCLUDED.geometry,
+            area = EXCLUDED.area,
+            num_floors = EXCLUDED.num_floors,
+            on_parcel = EXCLUDED.on_parcel,
+            type = EXCLUDED.type,
+            building_date = EXCLUDED.building_date,
+            fast_api_sync = current_timestamp;
+    """,
+    "parcels": """
+        DELETE FROM parcels t
+        USING parcels_staging s
+        WHERE t.identifier = s.identifier AND t.district <> s.district;
+
+        INSERT INTO parcels (identifier, geometry, area, location_text,
+                                cadastral_identifier, district, municipal)
+        SELECT identifier, ST_Multi(ST_GeomFromText(geometry, 4326)), area, location_text,
+               cadastral_identifier, district, municipal
+        FROM parcels_staging
+        ON CONFLICT (identifier, district)
+        DO UPDATE SET
+            geometry = EXCLUDED.geometry,
+            area = EXCLUDED.area,
+            location_text = EXCLUDED.location_text,
+            cadastral_identifier = EXCLUDED.cadastral_identifier,
+            municipal = EXCLUDED.municipal,
+            fast_api_sync = current_timestamp;
+    """,
+}
+
+
+class ConnectionPool:
+    """
+    At most ``size`` postgres connections, opened on first use and handed out
+    to one worker at a time.
+    """
+
+    def __init__(self, db_config: str, size: int):
+        self.db_config = db_config
+        self._idle: queue.Queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._all: list = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg.Connection]:
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = psycopg.connect(self.db_config)
+                with self._lock:
+                    self._all.append(conn)
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._idle.put(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+
+
 class DataLoader:
     """
     Creation, Loading and interraction between the db and file systems
@@ -42,6 +185,7 @@ class DataLoader:
 
         """
         self.db_config = default_db
+        self.schema = SchemaManager(default_db)
 
     def get_pg_conn(self) -> tuple:
 
@@ -51,50 +195,24 @@ class DataLoader:
 
     def create_db_objects(self) -> None:
         """
-
-        Parameters
-        ----------
-        default_db : str
-
+        Create the postgis extension and the partitioned tables.
 
         Returns
         -------
         None
 
         """
-        conn, cur = self.get_pg_conn()
         try:
-            cur.execute(
-                """
-                CREATE EXTENSION IF NOT EXISTS postgis;
-
-                CREATE TABLE IF NOT EXISTS buildings (
-                    identifier VARCHAR PRIMARY KEY,
-                    geometry GEOMETRY(MULTIPOLYGON, 4326),
-                    area FLOAT,
-                    num_floors INTEGER,
-                    on_parcel VARCHAR,
-                    type VARCHAR,
-                    building_date date,
-                    fast_api_sync timestamp without time zone default (now() at time zone 'utc')
-                );
-
-                CREATE TABLE IF NOT EXISTS parcels (
-                    identifier VARCHAR PRIMARY KEY,
-                    geometry GEOMETRY(MULTIPOLYGON, 4326),
-                    area FLOAT,
-                    location_text VARCHAR,
-                    cadastral_identifier VARCHAR,
-                    district VARCHAR,
-                    municipal VARCHAR,
-                    fast_api_sync timestamp without time zone default (now() at time zone 'utc')
-                );
+            self.schema.create_tables()
+        except Exception as e:
+            LOG.error(f"Error creating the db objects: {e}")
+            raise
 
-            """
-            )
-            conn.commit()
-        except BaseException:
-            conn.rollback()
+    @staticmethod
+    def _delete_moved(cur: psycopg.Cursor, table: str, rows: list[tuple], columns: list) -> None:
+        """Delete the rows of these identifiers left in another district, see DELETE_MOVED."""
+        district = columns.index("district")
+        cur.execute(DELETE_MOVED[table], ([row[0] for row in rows], [row[district] for row in rows]))
 
     def insert_data_into_buildings(self, building_data: list[tuple]) -> None:
         """
@@ -109,13 +227,13 @@ class DataLoader:
         None
 
         """
+        conn, cur = self.get_pg_conn()
         try:
-            conn, cur = self.get_pg_conn()
-
             insert_building_query = """
-                INSERT INTO buildings (identifier, geometry, area, num_floors, on_parcel, type, building_date)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (identifier)
+                INSERT INTO buildings (identifier, geometry, area, num_floors, on_parcel, type, building_date,
+                                        district)
+                VALUES (%s, ST_Multi(ST_GeomFromText(%s, 4326)), %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (identifier, district)
                 DO UPDATE SET
                     geometry = EXCLUDED.geometry,
                     area = EXCLUDED.area,
@@ -127,14 +245,17 @@ class DataLoader:
             """
 
             if building_data:
-                cur.executemany(insert_building_query, building_data)
-                LOG.info(f"Inserting {len(building_data)} rows into buildings.")
-                conn.commit()
+                with stage("postgres_write"):
+                    self._delete_moved(cur, "buildings", building_data, BUILDING_COLUMNS)
+                    cur.executemany(insert_building_query, building_data)
+                    LOG.info(f"Inserting {len(building_data)} rows into buildings.")
+                    conn.commit()
                 LOG.info("Buildings data successfully committed.")
 
         except Exception as e:
             LOG.error(f"Error inserting buildings data: {e}")
             conn.rollback()
+            raise
         finally:
             cur.close()
             conn.close()
@@ -152,42 +273,46 @@ class DataLoader:
         None
 
         """
+        conn, cur = self.get_pg_conn()
         try:
-            conn, cur = self.get_pg_conn()
-
             insert_parcel_query = """
                 INSERT INTO parcels (identifier, geometry, area, location_text, 
                                         cadastral_identifier, district, municipal)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (identifier)
+                VALUES (%s, ST_Multi(ST_GeomFromText(%s, 4326)), %s, %s, %s, %s, %s)
+                ON CONFLICT (identifier, district)
                 DO UPDATE SET
                     geometry = EXCLUDED.geometry,
                     area = EXCLUDED.area,
                     location_text = EXCLUDED.location_text,
                     cadastral_identifier = EXCLUDED.cadastral_identifier,
-                    district = EXCLUDED.district,
                     municipal = EXCLUDED.municipal,
                     fast_api_sync = current_timestamp;
             """
 
             if parcel_data:
-                cur.executemany(insert_parcel_query, parcel_data)
-                LOG.info(f"Inserting {len(parcel_data)} rows into parcels.")
-                conn.commit()
+                with stage("postgres_write"):
+                    self._delete_moved(cur, "parcels", parcel_data, PARCEL_COLUMNS)
+                    cur.executemany(insert_parcel_query, parcel_data)
+                    LOG.info(f"Inserting {len(parcel_data)} rows into parcels.")
+                    conn.commit()
                 LOG.info("Parcels data successfully committed.")
         except Exception as e:
             LOG.error(f"Error inserting parcels data: {e}")
             conn.rollback()
+            raise
         finally:
             cur.close()
             conn.close()
 
-    def export_building_parcel_data_to_psql(self, _file_dir: list) -> None:
+    def export_building_parcel_data_to_psql(self, _file_dir: list, owners: Optional[dict] = None) -> None:
         """
 
         Parameters
         ----------
         _file_dir : list
+        owners : dict, optional
+            Result of conflict_owners over the whole snapshot, rows owned by a
+            file of another batch are skipped. The default is None.
 
         Returns
         -------
@@ -198,50 +323,286 @@ class DataLoader:
         try:
             LOG.info(f"Processing file: {_file_dir}")
 
-            data = duckdb.sql(
-                f"""
-                INSTALL spatial;
-                LOAD spatial;
-                INSTALL parquet;
-                LOAD parquet;
-                SET memory_limit = '25GB';
-                SET threads TO 8;
-
-                SELECT
-                    building_identifier,
-                    ST_AsText(ST_GeomFromWKB(geometry)) AS geometry,
-                    building_area,
-                    num_floors,
-                    on_parcel,
-                    type,
-                    building_date,
-                    parcel_identifier,
-                    location_text,
-                    parcel_area,
-                    cadastral_identifier,
-                    district,
-                    municipal
-                FROM read_parquet({_file_dir});
-                """
-            ).fetchall()
+            # A parcel is repeated for every building it contains: select
+            # buildings and parcels separately so each is upserted once.
+            with stage("duckdb_read"), duckdb_cursor("pipeline") as cursor:
+                building_data = cursor.sql(f"{self._rows_sql(_file_dir, BUILDING_COLUMNS)};").fetchall()
+                parcel_data = cursor.sql(f"{self._rows_sql(_file_dir, PARCEL_COLUMNS)};").fetchall()
+            if owners:
+                building_data = self._owned_rows(building_data, "buildings", owners, _file_dir)
+                parcel_data = self._owned_rows(parcel_data, "parcels", owners, _file_dir)
 
             LOG.info("Data successfully fetched from parquet.")
 
-            if not data:
+            if not building_data:
                 LOG.warning("No data fetched from DuckDB.")
                 return
 
-            building_data = [
-                (row[0], row[1], row[2], row[3], row[4], row[5], row[6]) for row in data
-            ]
-            parcel_data = [
-                (row[7], row[1], row[9], row[8], row[10], row[11], row[12])
-                for row in data
-            ]
-
             self.insert_data_into_buildings(building_data)
 
             self.insert_data_into_parcels(parcel_data)
 
         except Exception as e:
             LOG.error(f"An error occurred: {e}")
+            raise
+
+    @staticmethod
+    def _rows_sql(_file_dir: list, columns: list) -> str:
+        """
+        One row per identifier (first column), geometries as WKT. A duplicated
+        identifier is taken from the first file in sorted order, then the
+        first row of that file.
+        """
+        key = columns[0]
+        selected = ", ".join(
+            f"ST_AsText(ST_GeomFromWKB({column}))" if column.endswith("geometry") else column for column in columns
+        )
+        return f"""
+            SELECT DISTINCT ON ({key}) {selected}
+            FROM read_parquet({_file_dir}, filename = true, file_row_number = true)
+            ORDER BY {key}, filename, file_row_number
+        """
+
+    @staticmethod
+    def _owned_rows(rows: list[tuple], table: str, owners: dict, _file_dir: list) -> list[tuple]:
+        """Rows of ``table`` not owned by a file outside of ``_file_dir``, see conflict_owners."""
+        return [row for row in rows if owners.get((table, row[0]), _file_dir[0]) in _file_dir]
+
+    @staticmethod
+    def _hashed_rows_sql(_file_dir: list, columns: list) -> str:
+        """
+        One row per identifier (first column) with an md5 over its attributes
+        and WKB, the duplicates resolved as in _rows_sql.
+        """
+        key = columns[0]
+        hashed = ", ".join(f"hex({column})" if column.endswith("geometry") else column for column in columns[1:])
+        return f"""
+            SELECT DISTINCT ON ({key})
+                {", ".join(columns)},
+                md5(CAST(ROW({hashed}) AS VARCHAR)) AS row_hash
+            FROM read_parquet({_file_dir}, filename = true, file_row_number = true)
+            ORDER BY {key}, filename, file_row_number
+        """
+
+    def diff_snapshots(self, _file_dir: list, _previous_file_dir: list, columns: list) -> tuple[list[tuple], list[str]]:
+        """
+        Compare two prepared snapshots in DuckDB.
+        Parameters
+        ----------
+        _file_dir : list
+            Parquet files of the new snapshot.
+        _previous_file_dir : list
+            Parquet files of the snapshot currently loaded in postgres.
+        columns : list
+            BUILDING_COLUMNS or PARCEL_COLUMNS, the identifier first.
+
+        Returns
+        -------
+        tuple[list[tuple], list[str]]
+            Rows inserted or updated since the previous snapshot, ready for
+            upsert, and identifiers that disappeared from the source or moved
+            to another district (partition) and must be deleted first.
+
+        """
+        key = columns[0]
+        selected = ", ".join(
+            f"ST_AsText(ST_GeomFromWKB(c.{column}))" if column.endswith("geometry") else f"c.{column}"
+            for column in columns
+        )
+        ctes = f"""
+            WITH cur AS ({self._hashed_rows_sql(_file_dir, columns)}),
+            prev AS ({self._hashed_rows_sql(_previous_file_dir, columns)})
+        """
+        with stage("duckdb_diff"), duckdb_cursor("pipeline") as cursor:
+            changed = cursor.sql(
+                f"""
+                {ctes}
+                SELECT {selected}
+                FROM cur c
+                LEFT JOIN prev p ON c.{key} = p.{key}
+                WHERE p.row_hash IS DISTINCT FROM c.row_hash;
+                """
+            ).fetchall()
+            deleted = cursor.sql(
+                f"""
+                {ctes}
+                SELECT p.{key}
+                FROM prev p
+                LEFT JOIN cur c ON c.{key} = p.{key}
+                WHERE c.{key} IS NULL OR c.district IS DISTINCT FROM p.district;
+                """
+            ).fetchall()
+        return changed, [row[0] for row in deleted]
+
+    def delete_rows(self, table: str, identifiers: list[str]) -> None:
+        """
+
+        Parameters
+        ----------
+        table : str
+            buildings or parcels.
+        identifiers : list[str]
+            identifiers of the rows to delete.
+
+        Returns
+        -------
+        None
+
+        """
+        if table not in ("buildings", "parcels"):
+            raise ValueError(f"Unknown table {table}")
+        if not identifiers:
+            return
+        conn, cur = self.get_pg_conn()
+        try:
+            with stage("postgres_write"):
+                cur.execute(f"DELETE FROM {table} WHERE identifier = ANY(%s)", (identifiers,))
+                LOG.info(f"Deleting {len(identifiers)} rows from {table}.")
+                conn.commit()
+        except Exception as e:
+            LOG.error(f"Error deleting {table} data: {e}")
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+
+    def export_snapshot_changes_to_psql(self, _file_dir: list, _previous_file_dir: list) -> None:
+        """
+        Only send the rows that changed between the previous and the new
+        snapshot: upsert inserted and updated rows, delete the removed ones.
+        Parameters
+        ----------
+        _file_dir : list
+            Parquet files of the new snapshot.
+        _previous_file_dir : list
+            Parquet files of the snapshot currently loaded in postgres.
+
+        Returns
+        -------
+        None
+
+        """
+        for table, columns, insert in (
+            ("buildings", BUILDING_COLUMNS, self.insert_data_into_buildings),
+            ("parcels", PARCEL_COLUMNS, self.insert_data_into_parcels),
+        ):
+            changed, deleted = self.diff_snapshots(_file_dir, _previous_file_dir, columns)
+            LOG.info(f"{table}: {len(changed)} inserted or updated, {len(deleted)} deleted.")
+            self.delete_rows(table, deleted)
+            insert(changed)
+
+    def conflict_owners(self, _file_dir: list) -> dict:
+        """
+        Identifiers present in more than one partition, mapped to the partition
+        that loads them: the first file in sorted order, as in _rows_sql, so
+        that the serial, parallel and queued loads give the same result however
+        files are batched or workers are scheduled.
+        Parameters
+        ----------
+        _file_dir : list
+            Parquet files of the snapshot, one per district.
+
+        Returns
+        -------
+        dict
+            (table, identifier) to the file owning it.
+
+        """
+        owners = {}
+        for table, key in (("buildings", "building_identifier"), ("parcels", "parcel_identifier")):
+            with duckdb_cursor("pipeline") as cursor:
+                rows = cursor.sql(
+                    f"""
+                    SELECT {key}, min(filename)
+                    FROM read_parquet({_file_dir}, filename = true)
+                    GROUP BY {key}
+                    HAVING count(DISTINCT filename) > 1;
+                    """
+                ).fetchall()
+            owners.update({(table, identifier): owner for identifier, owner in rows})
+        if owners:
+            LOG.warning(f"{len(owners)} identifiers appear in several partitions.")
+        return owners
+
+    def copy_partition_to_psql(self, partition: str, owners: dict, pool: ConnectionPool) -> None:
+        """
+        Stream one district partition into postgres with COPY and upsert it.
+        Parameters
+        ----------
+        partition : str
+            Parquet file of the district.
+        owners : dict
+            Result of conflict_owners, rows owned by another partition are skipped.
+        pool : ConnectionPool
+            Connections shared by the workers.
+
+        Returns
+        -------
+        None
+
+        """
+        for table, columns in (("buildings", BUILDING_COLUMNS), ("parcels", PARCEL_COLUMNS)):
+            with stage("duckdb_read"), duckdb_cursor("pipeline") as cursor:
+                rows = cursor.sql(self._rows_sql([partition], columns)).fetchall()
+            rows = self._owned_rows(rows, table, owners, [partition])
+            if not rows:
+                continue
+            with stage("postgres_write"), pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(STAGING_TABLES[table])
+                    with cur.copy(f"COPY {table}_staging FROM STDIN") as copy:
+                        for row in rows:
+                            copy.write_row(row)
+                    cur.execute(MERGE_STAGING[table])
+                conn.commit()
+            LOG.info(f"Copied {len(rows)} rows of {partition} into {table}.")
+
+    def export_partitions_in_parallel(
+        self, _file_dir: list, workers: int, checkpoint: Optional[Checkpoint] = None
+    ) -> None:
+        """
+        Load district partitions with ``workers`` threads, each holding its own
+        postgres connection, so that the load scales with the database cores.
+        Parameters
+        ----------
+        _file_dir : list
+            Parquet files of the snapshot, one per district.
+        workers : int
+            Number of parallel workers and postgres connections.
+        checkpoint : Checkpoint, optional
+            Partitions already loaded by this run are skipped, the others are
+            recorded. The default is None.
+
+        Returns
+        -------
+        None
+
+        """
+        _file_dir = sorted(_file_dir)
+        owners = self.conflict_owners(_file_dir)
+        pool = ConnectionPool(self.db_config, workers)
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {}
+                for partition in _file_dir:
+                    args = (self.copy_partition_to_psql, partition, owners, pool)
+                    if checkpoint is not None:
+                        # execute skips the partitions loaded by a previous attempt of the run.
+                        unit = f"partition/{os.path.basename(partition)}"
+                        args = (checkpoint.execute, unit, fingerprint(partition), *args)
+                    futures[partition] = submit(executor, *args)
+                for partition, future in futures.items():
+                    try:
+                        if future.result() is False:
+                            failed.append(partition)
+                    except Exception as e:
+                        LOG.error(f"Error loading partition {partition}: {e}")
+                        failed.append(partition)
+        finally:
+            pool.close()
+        if checkpoint is not None:
+            checkpoint.raise_failures()
+        if failed:
+            raise RuntimeError(f"{len(failed)} partitions failed to load: {failed}")
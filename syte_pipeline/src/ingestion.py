@@ -5,26 +5,26 @@ Created on Fri Aug 02 18:40:21 2024
 
 @author: johnomole
 """
+
 from syte_pipeline.settings import Settings
-from typing import Set
+from syte_pipeline.src.profiling import stage
+from syte_pipeline.src import snapshots
+from typing import Optional, Set
 import requests
 import os
 import zipfile
 import io
-import duckdb
 import logging
 
 logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
 LOG = logging.getLogger(__name__)
 LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
 
-conn = duckdb.connect()
 settings = Settings()
 
 
 class Extraction:
-
-    def extract_shapefiles__zip(self, url: str)-> io.BytesIO:
+    def extract_shapefiles__zip(self, url: str) -> io.BytesIO:
         """
         Download the ZIP file from a URL.
         Parameters
@@ -38,14 +38,15 @@ class Extraction:
             BytesIO object containing the ZIP file content.
 
         """
-        response = requests.get(url, stream=True, timeout=300)
-        response.raise_for_status()
-        return io.BytesIO(response.content)
+        with stage("download"):
+            response = requests.get(url, stream=True, timeout=300)
+            response.raise_for_status()
+            return io.BytesIO(response.content)
 
     def extract_specific_files(
         self,
         url: str,
-        download_dir: str = os.path.join(settings.raw_dir, "day=20240801"),
+        download_dir: Optional[str] = None,
         file_prefix: Set[str] = {"Flurstueck", "GebaeudeBauwerk"},
     ) -> None:
         """
@@ -55,29 +56,33 @@ class Extraction:
         url : str
             URL pointing to the ZIP file.
         download_dir : str, optional
-            Directory where files will be extracted. The default is os.path.join(settings.raw_dir, "day=20240801").
+            Directory where files will be extracted. The default is the partition of today in settings.raw_dir.
         file_prefix : Set[str], optional
             Set of filenames (without extension) to extract. The default is {"Flurstueck", "GebaeudeBauwerk"}.
         Returns
         -------
         None
+        Raises
+        ------
+        Exception
+            When the download or the extraction fails.
         """
+        if download_dir is None:
+            download_dir = snapshots.partition_dir(settings.raw_dir, snapshots.today())
         try:
             zip_file_like = self.extract_shapefiles__zip(url)
-            with zipfile.ZipFile(zip_file_like, "r") as zip_ref:
+            with stage("unzip"), zipfile.ZipFile(zip_file_like, "r") as zip_ref:
                 for file_info in zip_ref.infolist():
-                    file_name, file_ext = os.path.splitext(
-                        os.path.basename(file_info.filename)
-                    )
+                    file_name, file_ext = os.path.splitext(os.path.basename(file_info.filename))
 
                     if file_name in file_prefix:
                         try:
                             zip_ref.extract(file_info, download_dir)
-                            print(
-                                f"Extracted: {file_info.filename} into {download_dir}"
-                            )
+                            print(f"Extracted: {file_info.filename} into {download_dir}")
                         except Exception as e:
                             print(f"Error extracting {file_info.filename}: {e}")
+                            raise
 
         except Exception as e:
             print(f"Error processing ZIP file from URL {url}: {e}")
+            raise
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run ledger: checkpoints of the pipeline runs.
+
+A run (e.g. the prepare of a day) is split into units: an archive extracted, a
+source directory joined, a batch of district files loaded. Each completed unit
+is recorded with the fingerprint of its inputs; a re-run of the same run skips
+the units already completed with an unchanged fingerprint and resumes at the
+first incomplete one. Failures are recorded per unit and reported at the end
+of the run instead of being swallowed.
+"""
+
+from contextlib import contextmanager
+from typing import Callable, Iterator
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
+
+
+def fingerprint(*parts) -> str:
+    """
+    Fingerprint of the inputs of a unit. Existing paths contribute their size
+    and modification time (every file below a directory), anything else its
+    string value.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        paths = part if isinstance(part, (list, tuple)) else [part]
+        for path in sorted(str(p) for p in paths):
+            digest.update(path.encode())
+            files = [path]
+            if os.path.isdir(path):
+                files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+            for file in files:
+                if os.path.isfile(file):
+                    stat = os.stat(file)
+                    digest.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+class UnitsFailed(RuntimeError):
+    """Raised at the end of a run when some of its units failed."""
+
+    def __init__(self, run: str, failures: dict[str, str]):
+        self.run = run
+        self.failures = failures
+        details = "; ".join(f"{unit}: {error}" for unit, error in failures.items())
+        super().__init__(f"{len(failures)} units of {run} failed: {details}")
+
+
+class RunLedger:
+    """
+    Completed and failed units of the runs, in a sqlite file.
+    """
+
+    def __init__(self, path: str):
+        """
+
+        Parameters
+        ----------
+        path : str
+            sqlite file of the ledger.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS run_units (
+                    run TEXT NOT NULL,
+                    unit TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    duration REAL,
+                    updated_at REAL,
+                    PRIMARY KEY (run, unit)
+                )
+                """
+            )
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _set(self, run: str, unit: str, fingerprint: str, status: str, error=None, duration=None) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                """
+                INSERT INTO run_units (run, unit, fingerprint, status, attempts, error, duration, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (run, unit) DO UPDATE SET
+                    fingerprint = excluded.fingerprint,
+                    status = excluded.status,
+                    attempts = run_units.attempts + excluded.attempts,
+                    error = excluded.error,
+                    duration = excluded.duration,
+                    updated_at = excluded.updated_at
+                """,
+                (run, unit, fingerprint, status, int(status == "running"), error, duration, time.time()),
+            )
+        finally:
+            conn.close()
+
+    def completed(self, run: str, unit: str, fingerprint: str) -> bool:
+        """True if the unit completed with the same fingerprint."""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT fingerprint, status FROM run_units WHERE run = ? AND unit = ?", (run, unit)
+            ).fetchone()
+        finally:
+            conn.close()
+        return row is not None and row == (fingerprint, "completed")
+
+    def units(self, run: str) -> dict[str, dict]:
+        """Unit to its status, attempts, last error and duration."""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT unit, status, attempts, error, duration FROM run_units WHERE run = ? ORDER BY unit",
+                (run,),
+            ).fetchall()
+        finally:
+            conn.close()
+        return {
+            unit: {"status": status, "attempts": attempts, "error": error, "duration": duration}
+            for unit, status, attempts, error, duration in rows
+        }
+
+    def reset(self, run: str) -> None:
+        """Forget the units of a run, the next one starts over."""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM run_units WHERE run = ?", (run,))
+        finally:
+            conn.close()
+
+    def run(self, run: str, resume: bool = True) -> "Checkpoint":
+        """
+        Checkpoint of a run.
+        Parameters
+        ----------
+        run : str
+            Name of the run, e.g. transform/20240801.
+        resume : bool, optional
+            Skip the units already completed. False forgets them and starts
+            over. The default is True.
+
+        Returns
+        -------
+        Checkpoint
+
+        """
+        if not resume:
+            self.reset(run)
+        return Checkpoint(self, run)
+
+
+class Checkpoint:
+    """
+    Units of one run: skip the completed ones, record the others.
+    """
+
+    def __init__(self, ledger: RunLedger, run: str):
+        self.ledger = ledger
+        self.run = run
+        self.failures: dict[str, str] = {}
+        self.skipped: list[str] = []
+        # Units executed, not skipped, by this checkpoint.
+        self.completed: list[str] = []
+        self._lock = threading.Lock()
+
+    @property
+    def fresh(self) -> bool:
+        """True when no unit of the run was recorded yet."""
+        return not self.ledger.units(self.run)
+
+    def pending(self, unit: str, fingerprint: str) -> bool:
+        """False when the unit already completed with this fingerprint."""
+        if self.ledger.completed(self.run, unit, fingerprint):
+            with self._lock:
+                self.skipped.append(unit)
+            LOG.info(f"{self.run}: {unit} already completed, skipped.")
+            return False
+        return True
+
+    @contextmanager
+    def record(self, unit: str, fingerprint: str) -> Iterator[None]:
+        """Record the unit as running, then completed or failed; exceptions propagate."""
+        self.ledger._set(self.run, unit, fingerprint, "running")
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.ledger._set(self.run, unit, fingerprint, "failed", f"{type(e).__name__}: {e}")
+            with self._lock:
+                self.failures[unit] = f"{type(e).__name__}: {e}"
+            LOG.error(f"{self.run}: {unit} failed: {e}")
+            raise
+        self.ledger._set(self.run, unit, fingerprint, "completed", duration=time.perf_counter() - start)
+        with self._lock:
+            self.completed.append(unit)
+
+    def execute(self, unit: str, fingerprint: str, fn: Callable, *args, **kwargs) -> bool:
+        """
+        Run ``fn`` as a unit unless it already completed. A failure is recorded
+        and the run goes on with the next units.
+        Returns
+        -------
+        bool
+            False if the unit failed.
+
+        """
+        if not self.pending(unit, fingerprint):
+            return True
+        try:
+            with self.record(unit, fingerprint):
+                fn(*args, **kwargs)
+        except Exception:
+            return False
+        return True
+
+    def raise_failures(self) -> None:
+        """Raise UnitsFailed if a unit of this run failed."""
+        if self.failures:
+            raise UnitsFailed(self.run, dict(self.failures))
+
+    def finish(self) -> None:
+        """
+        Forget the units once the run succeeded: only an unfinished run is
+        resumed, the next run of the same name starts over.
+        """
+        self.raise_failures()
+        self.ledger.reset(self.run)
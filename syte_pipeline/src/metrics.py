@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Building potential metrics of the parcels, precomputed per snapshot.
+
+Per parcel: built footprint, coverage ratio, free area and floor-area ratio.
+The parcels are also aggregated on a fixed grid in the source projection
+(EPSG:25832), so the API can answer top-N questions without touching the
+prepared data.
+"""
+
+from syte_pipeline.src.profiling import stage
+from syte_pipeline.src.resources import duckdb_cursor
+from os.path import join
+import logging
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyproj
+import shapely
+
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
+
+GRID_CRS = "EPSG:25832"
+
+
+class PotentialMetrics:
+    """
+    Compute the parcel and grid metrics of a prepared snapshot.
+    """
+
+    def __init__(self, cell_size: float = 250.0):
+        """
+
+        Parameters
+        ----------
+        cell_size : float, optional
+            Side of the grid cells in metres. The default is 250.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.cell_size = cell_size
+        self._to_grid = pyproj.Transformer.from_crs("EPSG:4326", GRID_CRS, always_xy=True)
+        self._from_grid = pyproj.Transformer.from_crs(GRID_CRS, "EPSG:4326", always_xy=True)
+
+    @staticmethod
+    def read_snapshot(prepared_dir: str) -> pd.DataFrame:
+        """One row per (parcel, building) of the snapshot."""
+        files = join(prepared_dir, "*.parquet")
+        with duckdb_cursor("pipeline") as cursor:
+            return cursor.sql(
+                f"""
+                SELECT DISTINCT ON (parcel_identifier, building_identifier)
+                    parcel_identifier,
+                    parcel_geometry,
+                    parcel_area,
+                    district,
+                    building_area,
+                    num_floors
+                FROM read_parquet('{files}')
+                """
+            ).df()
+
+    def parcel_metrics(self, df: pd.DataFrame) -> gpd.GeoDataFrame:
+        """
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Result of read_snapshot.
+
+        Returns
+        -------
+        gpd.GeoDataFrame
+            One row per parcel, geometry is the parcel centroid.
+
+        """
+        floors = np.nan_to_num(df["num_floors"].to_numpy(dtype=float), nan=1.0)
+        df = df.assign(
+            building_area=df["building_area"].fillna(0.0),
+            floor_area=df["building_area"].fillna(0.0).to_numpy() * np.maximum(floors, 1.0),
+        )
+        parcels = df.groupby("parcel_identifier", sort=False).agg(
+            parcel_geometry=("parcel_geometry", "first"),
+            parcel_area=("parcel_area", "first"),
+            district=("district", "first"),
+            footprint_area=("building_area", "sum"),
+            floor_area=("floor_area", "sum"),
+            building_count=("building_area", "size"),
+        )
+        area = parcels["parcel_area"].to_numpy(dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            parcels["coverage_ratio"] = np.where(area > 0, parcels["footprint_area"] / area, np.nan)
+            parcels["floor_area_ratio"] = np.where(area > 0, parcels["floor_area"] / area, np.nan)
+        parcels["free_area"] = np.maximum(area - parcels["footprint_area"].to_numpy(), 0.0)
+
+        wkb = np.array([bytes(value) for value in parcels.pop("parcel_geometry")], dtype=object)
+        centroids = shapely.centroid(shapely.from_wkb(wkb))
+        x, y = self._to_grid.transform(shapely.get_x(centroids), shapely.get_y(centroids))
+        parcels["cell_x"] = np.floor(x / self.cell_size).astype("int64")
+        parcels["cell_y"] = np.floor(y / self.cell_size).astype("int64")
+        return gpd.GeoDataFrame(parcels.reset_index(), geometry=centroids, crs="EPSG:4326")
+
+    def grid_metrics(self, parcels: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """
+        Parameters
+        ----------
+        parcels : gpd.GeoDataFrame
+            Result of parcel_metrics.
+
+        Returns
+        -------
+        gpd.GeoDataFrame
+            One row per grid cell, geometry is the cell polygon.
+
+        """
+        cells = (
+            parcels.groupby(["cell_x", "cell_y"])
+            .agg(
+                parcel_count=("parcel_identifier", "size"),
+                parcel_area=("parcel_area", "sum"),
+                footprint_area=("footprint_area", "sum"),
+                floor_area=("floor_area", "sum"),
+                free_area=("free_area", "sum"),
+            )
+            .reset_index()
+        )
+        area = cells["parcel_area"].to_numpy(dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cells["coverage_ratio"] = np.where(area > 0, cells["footprint_area"] / area, np.nan)
+            cells["floor_area_ratio"] = np.where(area > 0, cells["floor_area"] / area, np.nan)
+        cells["cell_id"] = cells["cell_x"].astype(str) + "_" + cells["cell_y"].astype(str)
+
+        minx = cells["cell_x"].to_numpy() * self.cell_size
+        miny = cells["cell_y"].to_numpy() * self.cell_size
+        boxes = shapely.box(minx, miny, minx + self.cell_size, miny + self.cell_size)
+        boxes = shapely.transform(boxes, lambda c: np.column_stack(self._from_grid.transform(c[:, 0], c[:, 1])))
+        return gpd.GeoDataFrame(cells, geometry=boxes, crs="EPSG:4326")
+
+    def compute(self, prepared_dir: str, output_dir: str) -> None:
+        """
+        Write parcels.parquet and grid.parquet of a snapshot into ``output_dir``.
+        Parameters
+        ----------
+        prepared_dir : str
+            Partition of the prepared snapshot.
+        output_dir : str
+            Partition of the metrics snapshot.
+
+        Returns
+        -------
+        None
+
+        """
+        with stage("metrics"):
+            df = self.read_snapshot(prepared_dir)
+            if df.empty:
+                LOG.warning(f"No data in {prepared_dir}, metrics skipped.")
+                return
+            parcels = self.parcel_metrics(df)
+            grid = self.grid_metrics(parcels)
+            parcels["cell_id"] = parcels["cell_x"].astype(str) + "_" + parcels["cell_y"].astype(str)
+            os.makedirs(output_dir, exist_ok=True)
+            parcels.drop(columns=["cell_x", "cell_y"]).to_parquet(
+                join(output_dir, "parcels.parquet"), engine="pyarrow", index=False
+            )
+            grid.drop(columns=["cell_x", "cell_y"]).to_parquet(
+                join(output_dir, "grid.parquet"), engine="pyarrow", index=False
+            )
+        LOG.info(f"Saved metrics of {len(parcels)} parcels and {len(grid)} cells to {output_dir}")
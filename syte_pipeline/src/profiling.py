@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in per-stage profiling of the pipeline runs.
+
+A run is opened by the endpoint with ``Profiler.run`` and the pipeline code
+marks its stages with ``stage("gdal_read")``. When no run is active ``stage``
+only reads a context variable, so the hooks cost nothing in normal operation.
+
+Peak memory comes from tracemalloc, which traces the whole process: the peak
+of a stage also counts what stages running at the same time on other threads
+allocated, it is an upper bound for stages of a parallel step.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+import contextvars
+import cProfile
+import functools
+import html
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+import uuid
+
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
+
+BACKENDS = ("cprofile", "pyinstrument")
+
+_active_run: contextvars.ContextVar = contextvars.ContextVar("profile_run", default=None)
+_local = threading.local()
+# Stages measuring memory right now, on any thread: the tracemalloc peak is
+# only reset when the first one starts, not under a stage running elsewhere.
+_measuring = 0
+_measuring_lock = threading.Lock()
+
+
+def submit(executor, fn, *args):
+    """
+    Submit ``fn`` to an executor so that it sees the profiling run of the caller.
+    Parameters
+    ----------
+    executor : concurrent.futures.Executor
+        Pool the work is sent to.
+    fn : callable
+        Function to run.
+
+    Returns
+    -------
+    concurrent.futures.Future
+
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class _Segment:
+    """One uninterrupted stretch of a stage on one thread."""
+
+    def __init__(self, backend: str):
+        self.backend = backend
+        self.profiler = None
+
+    def start(self) -> None:
+        try:
+            if self.backend == "pyinstrument":
+                import pyinstrument
+
+                self.profiler = pyinstrument.Profiler(async_mode="disabled")
+                self.profiler.start()
+            else:
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+        except (ImportError, ValueError, RuntimeError) as e:
+            # Another profiler is active (cProfile is process wide on 3.12+)
+            # or pyinstrument is missing: keep timings and memory only.
+            LOG.debug(f"Stage profiler not started: {e}")
+            self.profiler = None
+
+    def stop(self):
+        if self.profiler is None:
+            return None
+        if self.backend == "pyinstrument":
+            return self.profiler.stop()
+        self.profiler.disable()
+        return self.profiler
+
+
+class _Frame:
+    """A stage currently executing on this thread."""
+
+    def __init__(self, name: str, backend: str):
+        self.name = name
+        self.backend = backend
+        self.segments = []
+        self.peak_memory = 0
+        self._segment = None
+
+    def start(self) -> None:
+        global _measuring
+        with _measuring_lock:
+            if _measuring == 0:
+                tracemalloc.reset_peak()
+            _measuring += 1
+        self._segment = _Segment(self.backend)
+        self._segment.start()
+
+    def pause(self) -> None:
+        global _measuring
+        self.peak_memory = max(self.peak_memory, tracemalloc.get_traced_memory()[1])
+        with _measuring_lock:
+            _measuring -= 1
+        result = self._segment.stop()
+        if result is not None:
+            self.segments.append(result)
+
+    def resume(self, child_peak: int) -> None:
+        self.peak_memory = max(self.peak_memory, child_peak)
+        self.start()
+
+
+def cprofile_flame_graph(stats: pstats.Stats, title: str, min_share: float = 0.005, max_depth: int = 40) -> str:
+    """
+    Flame graph of cProfile statistics as an HTML page, drawn as an icicle:
+    callees below their caller, as wide as the cumulative time spent in them
+    from that caller. cProfile only records caller-callee pairs, so below a
+    function reached along several paths the split between them is approximate.
+    Parameters
+    ----------
+    stats : pstats.Stats
+        Statistics of the stage.
+    title : str
+        Title of the page.
+    min_share : float, optional
+        Calls below this share of the total time are not drawn. The default is 0.005.
+    max_depth : int, optional
+        Deepest level drawn. The default is 40.
+
+    Returns
+    -------
+    str
+
+    """
+    children = {}
+    roots = []
+    for func, (_, _, _, cumulative, callers) in stats.stats.items():
+        if not callers:
+            roots.append((func, cumulative))
+        for caller, caller_stats in callers.items():
+            children.setdefault(caller, []).append((func, caller_stats[3]))
+    total = sum(seconds for _, seconds in roots) or 1.0
+
+    def label(func: tuple) -> str:
+        filename, line, name = func
+        return f"{name} {os.path.basename(filename)}:{line}" if line else name
+
+    def node(func: tuple, seconds: float, parent_seconds: float, path: frozenset, depth: int) -> str:
+        below = ""
+        if depth < max_depth:
+            below = "".join(
+                node(child, child_seconds, seconds, path | {child}, depth + 1)
+                for child, child_seconds in sorted(children.get(func, []), key=lambda c: -c[1])
+                if child not in path and child_seconds >= min_share * total
+            )
+        text = html.escape(f"{label(func)} ({seconds:.3f}s)")
+        width = min(100.0, 100 * seconds / (parent_seconds or 1.0))
+        return (
+            f'<div style="display:inline-block;vertical-align:top;width:{width:.2f}%">'
+            f'<div title="{text}" style="overflow:hidden;white-space:nowrap;height:18px;'
+            f'border:1px solid #fff;background:hsl({(depth * 23) % 60},80%,65%)">{text}</div>'
+            f'<div style="white-space:nowrap">{below}</div></div>'
+        )
+
+    graph = "".join(
+        node(func, seconds, total, frozenset([func]), 1)
+        for func, seconds in sorted(roots, key=lambda r: -r[1])
+        if seconds >= min_share * total
+    )
+    return f"""
+    <html>
+        <head>
+            <title>{html.escape(title)}</title>
+        </head>
+        <body>
+            <h1>{html.escape(title)} ({total:.3f}s)</h1>
+            <div style="width:100%;white-space:nowrap;font:11px monospace">{graph}</div>
+        </body>
+    </html>
+    """
+
+
+class StageStats:
+    """Accumulated measurements of one stage across all its calls."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.peak_memory = 0
+        self.segments = []
+
+    def add(self, seconds: float, peak_memory: int, segments: list) -> None:
+        self.calls += 1
+        self.seconds += seconds
+        self.peak_memory = max(self.peak_memory, peak_memory)
+        self.segments.extend(segments)
+
+    def text(self, backend: str, limit: int = 40) -> str:
+        if not self.segments:
+            return ""
+        if backend == "pyinstrument":
+            from pyinstrument.renderers import ConsoleRenderer
+
+            return ConsoleRenderer(unicode=False, color=False).render(self._session())
+        stream = io.StringIO()
+        stats = pstats.Stats(*self.segments, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+        return stream.getvalue()
+
+    def flame_graph(self) -> Optional[str]:
+        """Full HTML page of the flame graph of the stage, None without a profile."""
+        if not self.segments:
+            return None
+        if hasattr(self.segments[0], "root_frame"):
+            from pyinstrument.renderers import HTMLRenderer
+
+            return HTMLRenderer().render(self._session())
+        return cprofile_flame_graph(pstats.Stats(*self.segments), self.name)
+
+    def _session(self):
+        from pyinstrument.session import Session
+
+        return functools.reduce(Session.combine, self.segments)
+
+
+class ProfileRun:
+    """Profiles of all stages of one pipeline endpoint call."""
+
+    def __init__(self, endpoint: str, backend: str):
+        self.run_id = uuid.uuid4().hex
+        self.endpoint = endpoint
+        self.backend = backend
+        self.started_at = datetime.now(timezone.utc)
+        self.seconds = 0.0
+        self.peak_memory = 0
+        self.stages: OrderedDict[str, StageStats] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, peak_memory: int, segments: list) -> None:
+        with self._lock:
+            stats = self.stages.setdefault(name, StageStats(name))
+            stats.add(seconds, peak_memory, segments)
+
+    def raw_stats(self) -> dict:
+        return {
+            "run_id": self.run_id,
+            "endpoint": self.endpoint,
+            "backend": self.backend,
+            "started_at": self.started_at.isoformat(),
+            "seconds": self.seconds,
+            "peak_memory": self.peak_memory,
+            "stages": [
+                {
+                    "name": s.name,
+                    "calls": s.calls,
+                    "seconds": s.seconds,
+                    "peak_memory": s.peak_memory,
+                    "stats": s.text(self.backend),
+                }
+                for s in self.stages.values()
+            ],
+        }
+
+    def to_html(self, stage: Optional[str] = None) -> str:
+        """
+        Render the run as HTML.
+        Parameters
+        ----------
+        stage : str, optional
+            Return the flame graph of this stage instead.
+
+        Returns
+        -------
+        str
+
+        """
+        if stage is not None:
+            stats = self.stages[stage]
+            flame = stats.flame_graph()
+            if flame is not None:
+                return flame
+            return f"<html><body><pre>{html.escape(stats.text(self.backend))}</pre></body></html>"
+
+        # Stage wall time as an icicle: one bar per stage, width relative to the run.
+        total = sum(s.seconds for s in self.stages.values()) or 1.0
+        bars = "".join(
+            f'<div title="{html.escape(s.name)}" style="display:inline-block;overflow:hidden;'
+            f"white-space:nowrap;height:24px;background:hsl({(i * 67) % 360},70%,70%);"
+            f'width:{100 * s.seconds / total:.2f}%">{html.escape(s.name)}</div>'
+            for i, s in enumerate(self.stages.values())
+        )
+        sections = "".join(
+            f"<h2>{html.escape(s.name)}</h2>"
+            f"<p>calls: {s.calls}, seconds: {s.seconds:.3f}, peak memory: {s.peak_memory / 2**20:.1f} MiB"
+            f' &middot; <a href="?stage={html.escape(s.name)}">detail</a></p>'
+            f"<pre>{html.escape(s.text(self.backend))}</pre>"
+            for s in self.stages.values()
+        )
+        return f"""
+        <html>
+            <head>
+                <title>Profile {self.run_id}</title>
+            </head>
+            <body>
+                <h1>{html.escape(self.endpoint)} ({self.seconds:.3f}s, peak {self.peak_memory / 2**20:.1f} MiB)</h1>
+                <div style="width:100%;font-family:monospace">{bars}</div>
+                <p>Peak memory is traced for the whole process: stages running in parallel
+                count each other's allocations.</p>
+                {sections}
+            </body>
+        </html>
+        """
+
+
+class Profiler:
+    """
+    Keep the last ``history`` profiled runs in memory.
+    """
+
+    def __init__(self, history: int = 10, backend: str = "cprofile"):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown profiler backend {backend!r}, use one of {BACKENDS}")
+        self.history = history
+        self.backend = backend
+        self._runs: OrderedDict[str, ProfileRun] = OrderedDict()
+        self._lock = threading.Lock()
+        self._tracing = 0
+        # tracemalloc was started by the profiler, not by someone else.
+        self._started_tracing = False
+
+    @contextmanager
+    def run(self, endpoint: str, enabled: bool) -> Iterator[Optional[ProfileRun]]:
+        """
+        Profile the stages executed inside the block when ``enabled``.
+        Parameters
+        ----------
+        endpoint : str
+            Name shown in the report.
+        enabled : bool
+            When False nothing is measured and None is yielded.
+
+        Yields
+        ------
+        ProfileRun or None
+
+        """
+        if not enabled:
+            yield None
+            return
+
+        run = ProfileRun(endpoint, self.backend)
+        with self._lock:
+            if self._tracing == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            self._tracing += 1
+        token = _active_run.set(run)
+        started = time.perf_counter()
+        try:
+            yield run
+        finally:
+            _active_run.reset(token)
+            run.seconds = time.perf_counter() - started
+            run.peak_memory = max((s.peak_memory for s in run.stages.values()), default=0)
+            with self._lock:
+                self._tracing -= 1
+                if self._tracing == 0 and self._started_tracing:
+                    tracemalloc.stop()
+                    self._started_tracing = False
+                self._runs[run.run_id] = run
+                while len(self._runs) > self.history:
+                    self._runs.popitem(last=False)
+            LOG.info(f"Profile {run.run_id} of {endpoint} stored ({run.seconds:.3f}s)")
+
+    def get(self, run_id: str) -> Optional[ProfileRun]:
+        with self._lock:
+            return self._runs.get(run_id)
+
+    def list_runs(self) -> list[dict]:
+        with self._lock:
+            runs = list(self._runs.values())
+        return [
+            {
+                "run_id": run.run_id,
+                "endpoint": run.endpoint,
+                "started_at": run.started_at.isoformat(),
+                "seconds": run.seconds,
+            }
+            for run in reversed(runs)
+        ]
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Mark a pipeline stage. Wall time, tracemalloc peak and the profiler output
+    are added to the active run; without an active run this is a no-op.
+    Nested stages pause the enclosing one so that each is measured on its own.
+    """
+    run = _active_run.get()
+    if run is None:
+        yield
+        return
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    if parent is not None:
+        parent.pause()
+
+    frame = _Frame(name, run.backend)
+    stack.append(frame)
+    started = time.perf_counter()
+    frame.start()
+    try:
+        yield
+    finally:
+        frame.pause()
+        stack.pop()
+        run.record(name, time.perf_counter() - started, frame.peak_memory, frame.segments)
+        if parent is not None:
+            parent.resume(frame.peak_memory)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resource governor: CPU and memory budget of the process.
+
+The limits come from the cgroup of the container (v2 ``cpu.max`` and
+``memory.max``, v1 CFS quota and ``memory.limit_in_bytes`` as a fallback),
+else from the host. They are split between the pipeline workload (DuckDB reads
+of the loads, Postgres loaders) and the query workload (the DuckDB catalog of
+the API, the tiles). memory_limit and threads are settings of a DuckDB
+instance, not of a connection: each workload shares one instance per process,
+capped at its threads and memory, and its threads query it through cursors, so
+that the process stays within the container limits.
+"""
+
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import Iterator, Literal, Optional
+import logging
+import math
+import os
+import threading
+
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# cgroup v1 reports "no limit" as a huge page-aligned number.
+UNLIMITED_V1 = 1 << 60
+
+Workload = Literal["pipeline", "query"]
+
+_instances: dict = {}
+_instances_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class Limits:
+    cpus: float
+    memory_mb: int
+    source: str
+
+
+@dataclass(frozen=True)
+class Budget:
+    cpus: float
+    memory_mb: int
+    source: str
+    pipeline_threads: int
+    pipeline_memory_mb: int
+    query_threads: int
+    query_memory_mb: int
+    download_workers: int
+    load_workers: int
+
+    def duckdb_settings(self, workload: Workload) -> str:
+        """SET statements applying the budget of a workload to a DuckDB connection."""
+        if workload == "pipeline":
+            threads, memory = self.pipeline_threads, self.pipeline_memory_mb
+        else:
+            threads, memory = self.query_threads, self.query_memory_mb
+        return f"SET memory_limit = '{memory}MB'; SET threads TO {threads};"
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_dirs(root: str = CGROUP_ROOT) -> list[str]:
+    """Cgroup directory of this process, then the root (private cgroup namespace)."""
+    dirs = []
+    membership = _read("/proc/self/cgroup") or ""
+    for line in membership.splitlines():
+        hierarchy, _, path = line.partition("::")
+        if hierarchy == "0" and path not in ("", "/"):
+            dirs.append(os.path.join(root, path.lstrip("/")))
+    dirs.append(root)
+    return dirs
+
+
+def cgroup_cpus(root: str = CGROUP_ROOT) -> Optional[float]:
+    """CPU quota in cores, None without a limit."""
+    for directory in cgroup_dirs(root):
+        value = _read(os.path.join(directory, "cpu.max"))
+        if value is not None:
+            quota, _, period = value.partition(" ")
+            if quota == "max":
+                return None
+            return int(quota) / int(period or 100000)
+    quota = _read(os.path.join(root, "cpu", "cpu.cfs_quota_us"))
+    period = _read(os.path.join(root, "cpu", "cpu.cfs_period_us"))
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def cgroup_memory(root: str = CGROUP_ROOT) -> Optional[int]:
+    """Memory limit in bytes, None without a limit."""
+    for directory in cgroup_dirs(root):
+        value = _read(os.path.join(directory, "memory.max"))
+        if value is not None:
+            return None if value == "max" else int(value)
+    value = _read(os.path.join(root, "memory", "memory.limit_in_bytes"))
+    if value is not None and int(value) < UNLIMITED_V1:
+        return int(value)
+    return None
+
+
+def host_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def host_memory() -> int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def detect_limits(root: str = CGROUP_ROOT) -> Limits:
+    """
+    CPU and memory available to the process.
+    Parameters
+    ----------
+    root : str, optional
+        Mount point of the cgroup filesystem. The default is /sys/fs/cgroup.
+
+    Returns
+    -------
+    Limits
+        source is cgroup when a limit was found, host otherwise.
+
+    """
+    cpus, memory = cgroup_cpus(root), cgroup_memory(root)
+    source = "cgroup" if cpus is not None or memory is not None else "host"
+    cpus = min(cpus, host_cpus()) if cpus is not None else host_cpus()
+    memory = min(memory, host_memory()) if memory is not None else host_memory()
+    return Limits(cpus=cpus, memory_mb=memory // (1024 * 1024), source=source)
+
+
+def plan_budget(
+    limits: Limits,
+    pipeline_share: float = 0.5,
+    memory_headroom: float = 0.25,
+    load_workers: Optional[int] = None,
+) -> Budget:
+    """
+    Split the limits between the pipeline and the query workloads.
+    Parameters
+    ----------
+    limits : Limits
+        Result of detect_limits, or the overrides of the settings.
+    pipeline_share : float, optional
+        Share of the CPU and memory of the pipeline, the rest goes to the
+        queries. The default is 0.5.
+    memory_headroom : float, optional
+        Share of the memory left to Python, geopandas and the page cache. The default is 0.25.
+    load_workers : int, optional
+        Postgres loaders. The default is None (one per pipeline thread).
+
+    Returns
+    -------
+    Budget
+
+    """
+    share = min(max(pipeline_share, 0.0), 1.0)
+    cores = max(1, math.floor(limits.cpus))
+    memory = int(limits.memory_mb * (1 - memory_headroom))
+    pipeline_threads = max(1, round(cores * share))
+    query_threads = max(1, cores - pipeline_threads) if share < 1 else 1
+    return Budget(
+        cpus=limits.cpus,
+        memory_mb=limits.memory_mb,
+        source=limits.source,
+        pipeline_threads=pipeline_threads,
+        pipeline_memory_mb=max(64, int(memory * share)),
+        query_threads=query_threads,
+        query_memory_mb=max(64, int(memory * (1 - share))),
+        # Downloads wait on the network, not the CPU.
+        download_workers=max(2, 2 * cores),
+        load_workers=load_workers or pipeline_threads,
+    )
+
+
+@lru_cache
+def get_budget() -> Budget:
+    """Budget of the process, computed once from the limits and the settings overrides."""
+    from syte_pipeline.settings import Settings
+
+    settings = Settings()
+    limits = detect_limits()
+    if settings.cpu_limit is not None or settings.memory_limit_mb is not None:
+        limits = Limits(
+            cpus=settings.cpu_limit if settings.cpu_limit is not None else limits.cpus,
+            memory_mb=settings.memory_limit_mb if settings.memory_limit_mb is not None else limits.memory_mb,
+            source="settings",
+        )
+    budget = plan_budget(limits, settings.pipeline_share, settings.memory_headroom, settings.load_workers)
+    LOG.info(f"Resource budget: {budget}")
+    return budget
+
+
+def duckdb_instance(workload: Workload):
+    """
+    In-memory DuckDB instance of a workload, created once per process with
+    spatial and parquet loaded and capped at the budget of the workload.
+    Parameters
+    ----------
+    workload : Workload
+        pipeline or query.
+
+    Returns
+    -------
+    duckdb.DuckDBPyConnection
+        Shared by the threads of the process: query it through cursors.
+
+    """
+    import duckdb
+
+    with _instances_lock:
+        if workload not in _instances:
+            con = duckdb.connect()
+            con.sql(
+                f"INSTALL spatial; LOAD spatial; INSTALL parquet; LOAD parquet; "
+                f"{get_budget().duckdb_settings(workload)}"
+            )
+            _instances[workload] = con
+        return _instances[workload]
+
+
+@contextmanager
+def duckdb_cursor(workload: Workload) -> Iterator:
+    """Cursor on the instance of a workload, closed when the block exits."""
+    cursor = duckdb_instance(workload).cursor()
+    try:
+        yield cursor
+    finally:
+        cursor.close()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PostGIS schema of the analytical tables.
+
+buildings and parcels are list-partitioned by district, so queries on a
+district only read its partition. Secondary indexes (GiST on the geometries,
+btree on the join columns) are dropped before a full reload and rebuilt
+concurrently, partition by partition, once the rows are in. Tables of the
+previous, unpartitioned, schema are migrated by create_tables.
+"""
+
+from psycopg import sql
+import hashlib
+import logging
+import os
+import re
+import psycopg
+
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
+
+TABLES = {
+    "buildings": """
+        CREATE TABLE IF NOT EXISTS buildings (
+            identifier VARCHAR NOT NULL,
+            geometry GEOMETRY(MULTIPOLYGON, 4326),
+            area FLOAT,
+            num_floors INTEGER,
+            on_parcel VARCHAR,
+            type VARCHAR,
+            building_date date,
+            district VARCHAR NOT NULL,
+            fast_api_sync timestamp without time zone default (now() at time zone 'utc'),
+            PRIMARY KEY (identifier, district)
+        ) PARTITION BY LIST (district);
+    """,
+    "parcels": """
+        CREATE TABLE IF NOT EXISTS parcels (
+            identifier VARCHAR NOT NULL,
+            geometry GEOMETRY(MULTIPOLYGON, 4326),
+            area FLOAT,
+            location_text VARCHAR,
+            cadastral_identifier VARCHAR,
+            district VARCHAR NOT NULL,
+            municipal VARCHAR,
+            fast_api_sync timestamp without time zone default (now() at time zone 'utc'),
+            PRIMARY KEY (identifier, district)
+        ) PARTITION BY LIST (district);
+    """,
+}
+
+# name: (table, method, columns). district needs no index as it is the partition
+# key, identifier lookups use the primary key.
+SECONDARY_INDEXES = {
+    "buildings_geometry_idx": ("buildings", "gist", ["geometry"]),
+    "buildings_on_parcel_idx": ("buildings", "btree", ["on_parcel"]),
+    "parcels_geometry_idx": ("parcels", "gist", ["geometry"]),
+    "parcels_cadastral_identifier_idx": ("parcels", "btree", ["cadastral_identifier"]),
+}
+
+
+def partition_name(table: str, district: str) -> str:
+    """Stable partition name, unique per district and shorter than 63 characters."""
+    digest = hashlib.md5(district.encode()).hexdigest()[:8]
+    slug = re.sub(r"[^a-z0-9]+", "_", district.lower()).strip("_")[:20]
+    return f"{table}_p_{digest}_{slug}".rstrip("_")
+
+
+class SchemaManager:
+    """
+    Create the partitioned tables and manage their indexes.
+    """
+
+    def __init__(self, db_config: str):
+        """
+
+        Parameters
+        ----------
+        db_config : str
+            postgres connection string.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.db_config = db_config
+
+    def create_tables(self) -> None:
+        """
+        Create the partitioned tables with a default partition. Tables left by
+        a previous, unpartitioned, schema are renamed to <table>_unpartitioned
+        and their rows copied into the partitions of their districts, in the
+        same transaction: when a row can't be migrated nothing is changed and
+        the error is raised.
+        """
+        with psycopg.connect(self.db_config) as conn:
+            conn.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
+            legacy = []
+            for table in TABLES:
+                kind = conn.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,)).fetchone()
+                if kind is not None and kind[0] == "r":
+                    LOG.warning(f"Table {table} is not partitioned, migrating it.")
+                    legacy.append(table)
+                    conn.execute(
+                        sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                            sql.Identifier(table), sql.Identifier(f"{table}_unpartitioned")
+                        )
+                    )
+                    conn.execute(
+                        sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(
+                            sql.Identifier(f"{table}_unpartitioned"),
+                            sql.Identifier(f"{table}_pkey"),
+                            sql.Identifier(f"{table}_unpartitioned_pkey"),
+                        )
+                    )
+            for table, ddl in TABLES.items():
+                conn.execute(ddl)
+                conn.execute(
+                    sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT").format(
+                        sql.Identifier(f"{table}_default"), sql.Identifier(table)
+                    )
+                )
+            # Parcels first, the previous buildings table has no district: a
+            # building takes the one of the parcel it stands on.
+            for table in sorted(legacy, key=lambda table: table != "parcels"):
+                self._migrate(conn, table)
+
+    @staticmethod
+    def _columns(conn: psycopg.Connection, table: str) -> list[str]:
+        rows = conn.execute(
+            """
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s
+            ORDER BY ordinal_position
+            """,
+            (table,),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def _migrate(self, conn: psycopg.Connection, table: str) -> None:
+        """Copy <table>_unpartitioned into the partitions of its districts and drop it."""
+        legacy = f"{table}_unpartitioned"
+        legacy_columns = self._columns(conn, legacy)
+        columns = [c for c in self._columns(conn, table) if c in legacy_columns and c != "district"]
+        if "district" in legacy_columns:
+            district = sql.SQL("t.district")
+        elif table == "buildings" and "on_parcel" in legacy_columns:
+            district = sql.SQL("(SELECT p.district FROM parcels p WHERE p.identifier = t.on_parcel LIMIT 1)")
+        else:
+            district = sql.SQL("NULL")
+        source = sql.SQL("SELECT {}, {} AS district FROM {} t").format(
+            sql.SQL(", ").join(sql.Identifier("t", c) for c in columns), district, sql.Identifier(legacy)
+        )
+        missing = conn.execute(sql.SQL("SELECT count(*) FROM ({}) s WHERE district IS NULL").format(source)).fetchone()[
+            0
+        ]
+        if missing:
+            raise RuntimeError(
+                f"{missing} rows of {legacy} have no district and can't be partitioned, fix or drop them and retry"
+            )
+        for (name,) in conn.execute(sql.SQL("SELECT DISTINCT district FROM ({}) s").format(source)).fetchall():
+            self._create_partition(conn, table, name)
+        copied = conn.execute(
+            sql.SQL("INSERT INTO {} ({}, district) {}").format(
+                sql.Identifier(table), sql.SQL(", ").join(sql.Identifier(c) for c in columns), source
+            )
+        ).rowcount
+        conn.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(legacy)))
+        LOG.info(f"Migrated {copied} rows of {legacy} into {table}.")
+
+    @staticmethod
+    def _create_partition(conn: psycopg.Connection, table: str, district: str) -> None:
+        conn.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES IN ({})").format(
+                sql.Identifier(partition_name(table, district)),
+                sql.Identifier(table),
+                sql.Literal(district),
+            )
+        )
+
+    def ensure_partitions(self, districts: list[str]) -> None:
+        """
+        Create the partitions of the given districts. Must run before their rows
+        are loaded, a district already present in the default partition can't
+        get its own partition.
+        Parameters
+        ----------
+        districts : list[str]
+            Districts of the snapshot about to be loaded.
+
+        Raises
+        ------
+        RuntimeError
+            When a partition could not be created, after trying the others:
+            the load must not go on, the rows would land in the default partition.
+
+        Returns
+        -------
+        None
+
+        """
+        failures = []
+        with psycopg.connect(self.db_config, autocommit=True) as conn:
+            for table in TABLES:
+                for district in districts:
+                    try:
+                        self._create_partition(conn, table, district)
+                    except psycopg.Error as e:
+                        LOG.error(f"Could not create the {table} partition of {district}: {e}")
+                        failures.append(f"{table}/{district}: {e}")
+        if failures:
+            raise RuntimeError(f"{len(failures)} partitions could not be created: {'; '.join(failures)}")
+
+    def partitions(self, conn: psycopg.Connection, table: str) -> list[str]:
+        rows = conn.execute(
+            """
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+            ORDER BY c.relname
+            """,
+            (table,),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def drop_secondary_indexes(self) -> None:
+        """Drop every non primary key index, before a full reload."""
+        with psycopg.connect(self.db_config, autocommit=True) as conn:
+            for name in SECONDARY_INDEXES:
+                conn.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(name)))
+        LOG.info("Secondary indexes dropped.")
+
+    def create_secondary_indexes(self) -> None:
+        """
+        Build the secondary indexes without blocking writers: an invalid index
+        is created on the parent only, each partition is indexed concurrently
+        and attached, which makes the parent index valid. A partition whose
+        index fails doesn't stop the others, a RuntimeError lists the failures
+        at the end.
+        """
+        failures = []
+        with psycopg.connect(self.db_config, autocommit=True) as conn:
+            for name, (table, method, columns) in SECONDARY_INDEXES.items():
+                column_list = sql.SQL(", ").join(sql.Identifier(c) for c in columns)
+                conn.execute(
+                    sql.SQL("CREATE INDEX IF NOT EXISTS {} ON ONLY {} USING {} ({})").format(
+                        sql.Identifier(name), sql.Identifier(table), sql.SQL(method), column_list
+                    )
+                )
+                for partition in self.partitions(conn, table):
+                    child = f"{partition}_{name.removeprefix(table + '_')}"[:63]
+                    try:
+                        self._drop_invalid_index(conn, child)
+                        conn.execute(
+                            sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} USING {} ({})").format(
+                                sql.Identifier(child), sql.Identifier(partition), sql.SQL(method), column_list
+                            )
+                        )
+                        conn.execute(
+                            sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(
+                                sql.Identifier(name), sql.Identifier(child)
+                            )
+                        )
+                    except psycopg.Error as e:
+                        LOG.error(f"Could not build index {child}: {e}")
+                        failures.append(f"{child}: {e}")
+        if failures:
+            raise RuntimeError(f"{len(failures)} indexes could not be built: {'; '.join(failures)}")
+        LOG.info("Secondary indexes built.")
+
+    @staticmethod
+    def _drop_invalid_index(conn: psycopg.Connection, name: str) -> None:
+        """A failed concurrent build leaves an invalid index behind, drop it before retrying."""
+        invalid = conn.execute(
+            """
+            SELECT 1 FROM pg_index
+            WHERE indexrelid = to_regclass(%s) AND NOT indisvalid
+            """,
+            (name,),
+        ).fetchone()
+        if invalid:
+            conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name)))
+
+    def analyze(self) -> None:
+        """Refresh the planner statistics after a load."""
+        with psycopg.connect(self.db_config, autocommit=True) as conn:
+            for table in TABLES:
+                conn.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+        LOG.info("Tables analyzed.")
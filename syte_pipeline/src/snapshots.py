@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Daily snapshots of the raw and prepared datasets.
+
+Every run writes its data below ``<base>/day=YYYYMMDD``; readers resolve the
+snapshot they need and only read that partition.
+"""
+
+from datetime import datetime, timedelta, timezone
+from os.path import join
+from typing import Optional
+import logging
+import os
+import re
+import shutil
+import uuid
+
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
+
+DAY_FORMAT = "%Y%m%d"
+_PARTITION = re.compile(r"^day=(\d{8})$")
+
+
+def today() -> str:
+    """Day of a new snapshot, in UTC."""
+    return datetime.now(timezone.utc).strftime(DAY_FORMAT)
+
+
+def normalize_day(day: str) -> str:
+    """
+    Accept YYYYMMDD or YYYY-MM-DD.
+    Parameters
+    ----------
+    day : str
+
+    Returns
+    -------
+    str
+        The day as YYYYMMDD.
+
+    """
+    value = day.replace("-", "")
+    datetime.strptime(value, DAY_FORMAT)
+    return value
+
+
+def partition_dir(base: str, day: str) -> str:
+    return join(base, f"day={day}")
+
+
+def list_days(base: str) -> list[str]:
+    """Days with a snapshot below ``base``, oldest first."""
+    if not os.path.isdir(base):
+        return []
+    days = []
+    for name in os.listdir(base):
+        match = _PARTITION.match(name)
+        if match and os.path.isdir(join(base, name)):
+            days.append(match.group(1))
+    return sorted(days)
+
+
+def latest_day(base: str, as_of: Optional[str] = None) -> Optional[str]:
+    """
+    Most recent snapshot, or the most recent one taken on or before ``as_of``.
+    Parameters
+    ----------
+    base : str
+        Directory holding the day= partitions.
+    as_of : str, optional
+        YYYYMMDD or YYYY-MM-DD. The default is None.
+
+    Returns
+    -------
+    str or None
+        None when there is no matching snapshot.
+
+    """
+    days = list_days(base)
+    if as_of is not None:
+        limit = normalize_day(as_of)
+        days = [day for day in days if day <= limit]
+    return days[-1] if days else None
+
+
+def apply_retention(base: str, keep: int, max_age_days: Optional[int] = None) -> list[str]:
+    """
+    Delete old snapshots. The ``keep`` most recent ones are retained, minus those
+    older than ``max_age_days``; the latest snapshot is never deleted.
+    Parameters
+    ----------
+    base : str
+        Directory holding the day= partitions.
+    keep : int
+        Number of snapshots to keep.
+    max_age_days : int, optional
+        Maximum age of a snapshot. The default is None (no limit).
+
+    Returns
+    -------
+    list[str]
+        The deleted days.
+
+    """
+    days = list_days(base)
+    if not days:
+        return []
+    retained = set(days[-max(keep, 1) :])
+    if max_age_days is not None:
+        oldest = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).strftime(DAY_FORMAT)
+        retained = {day for day in retained if day >= oldest}
+    retained.add(days[-1])
+
+    removed = []
+    for day in days:
+        if day not in retained:
+            shutil.rmtree(partition_dir(base, day), ignore_errors=True)
+            LOG.info(f"Removed snapshot {partition_dir(base, day)}")
+            removed.append(day)
+    return removed
+
+
+def replace_partition(base: str, day: str, source: str) -> None:
+    """
+    Move the directory ``source`` into place as the snapshot of ``day``,
+    replacing the previous one. ``source`` must be on the same filesystem.
+    """
+    target = partition_dir(base, day)
+    os.makedirs(base, exist_ok=True)
+    previous = f"{source}.previous"
+    if os.path.exists(target):
+        os.replace(target, previous)
+    os.replace(source, target)
+    shutil.rmtree(previous, ignore_errors=True)
+    LOG.info(f"Snapshot {target} replaced by {source}")
+
+
+def read_marker(base: str, name: str) -> Optional[str]:
+    """Value stored with ``write_marker``, None if it was never written."""
+    try:
+        with open(join(base, f"_{name}")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_marker(base: str, name: str, value: str) -> None:
+    """Atomically store a small value (e.g. the last loaded day) next to the snapshots."""
+    os.makedirs(base, exist_ok=True)
+    path = join(base, f"_{name}")
+    with open(f"{path}.tmp", "w") as f:
+        f.write(value)
+    os.replace(f"{path}.tmp", path)
+
+
+def generation(base: str) -> str:
+    """Token changing every time the datasets below ``base`` are rewritten."""
+    return read_marker(base, "generation") or "0"
+
+
+def new_generation() -> str:
+    """Unique, time ordered, generation token."""
+    return f"{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+
+
+def bump_generation(base: str, token: Optional[str] = None) -> str:
+    """
+    Mark the datasets below ``base`` as rewritten, caches keyed by the generation are invalidated.
+    ``token`` lets a cache be built for the new generation before it is published.
+    """
+    token = token or new_generation()
+    write_marker(base, "generation", token)
+    return token
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mapbox Vector Tiles of the buildings and parcels of the latest prepared snapshot.
+
+Tiles are cached on disk and in memory under the dataset generation, so a new
+prepare invalidates them without any explicit purge.
+"""
+
+from syte_pipeline.src import snapshots
+from syte_pipeline.src.catalog import Catalog, source_columns
+from syte_pipeline.src.profiling import stage
+from collections import OrderedDict
+from os.path import join
+from typing import Optional
+import logging
+import math
+import os
+import shutil
+import threading
+import mapbox_vector_tile
+import numpy as np
+import shapely
+
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
+
+EXTENT = 4096
+MAX_ZOOM = 22
+EARTH_RADIUS = 6378137.0
+ORIGIN = math.pi * EARTH_RADIUS
+
+LAYERS = {
+    "buildings": """
+        SELECT DISTINCT ON (building_identifier)
+            {geometry} AS geometry,
+            building_identifier AS identifier,
+            type,
+            num_floors,
+            building_area AS area
+        FROM {source}
+        WHERE ST_Intersects(ST_GeomFromWKB({geometry}), ST_MakeEnvelope({bounds}))
+    """,
+    "parcels": """
+        SELECT DISTINCT ON (parcel_identifier)
+            {parcel_geometry} AS geometry,
+            parcel_identifier AS identifier,
+            district,
+            location_text,
+            parcel_area AS area
+        FROM {source}
+        WHERE ST_Intersects(ST_GeomFromWKB({parcel_geometry}), ST_MakeEnvelope({bounds}))
+    """,
+}
+
+
+def to_web_mercator(coords: np.ndarray) -> np.ndarray:
+    """EPSG:4326 lon/lat coordinates to EPSG:3857 metres."""
+    lon, lat = coords[:, 0], np.clip(coords[:, 1], -85.051129, 85.051129)
+    x = np.radians(lon) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * EARTH_RADIUS
+    return np.column_stack([x, y])
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """Bounds of a tile in EPSG:3857 (minx, miny, maxx, maxy)."""
+    size = 2 * ORIGIN / 2**z
+    return (-ORIGIN + x * size, ORIGIN - (y + 1) * size, -ORIGIN + (x + 1) * size, ORIGIN - y * size)
+
+
+def tile_lonlat_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """Bounds of a tile in EPSG:4326 (west, south, east, north)."""
+    n = 2**z
+
+    def lat(row: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+
+def tiles_covering(west: float, south: float, east: float, north: float, z: int) -> list[tuple[int, int, int]]:
+    n = 2**z
+
+    def column(lon: float) -> int:
+        return min(n - 1, max(0, int((lon + 180) / 360 * n)))
+
+    def row(lat: float) -> int:
+        lat = max(-85.051129, min(85.051129, lat))
+        value = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n
+        return min(n - 1, max(0, int(value)))
+
+    return [(z, x, y) for x in range(column(west), column(east) + 1) for y in range(row(north), row(south) + 1)]
+
+
+class TileRenderer:
+    """
+    Render and cache the vector tiles.
+    """
+
+    def __init__(
+        self,
+        catalog: Catalog,
+        cache_dir: str,
+        memory_tiles: int = 2048,
+        lod_tolerances: Optional[list[float]] = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        catalog : Catalog
+            Catalog of the prepared snapshots, the tiles are rendered on its cursors.
+        cache_dir : str
+            Tiles are stored in cache_dir/<generation>/z/x/y.mvt.
+        memory_tiles : int, optional
+            Number of tiles kept in memory. The default is 2048.
+        lod_tolerances : list[float], optional
+            Tolerances of the geometry_lod<n> columns of the prepared data.
+            The default is None (full geometries only).
+
+        Returns
+        -------
+        None.
+
+        """
+        self.catalog = catalog
+        self.prepared_dir = catalog.prepared_dir
+        self.cache_dir = cache_dir
+        self.memory_tiles = memory_tiles
+        self.lod_tolerances = lod_tolerances or []
+        self._memory: OrderedDict[tuple, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _source(self) -> Optional[str]:
+        return self.catalog.source()
+
+    def level_of_detail(self, z: int) -> int:
+        """Coarsest simplified geometry still finer than a pixel of the tile, 0 for the full geometry."""
+        pixel = 360 / (2**z * EXTENT)
+        levels = [level for level, tolerance in enumerate(self.lod_tolerances, start=1) if tolerance <= pixel]
+        return max(levels, default=0)
+
+    def _tile_path(self, generation: str, z: int, x: int, y: int) -> str:
+        return join(self.cache_dir, generation, str(z), str(x), f"{y}.mvt")
+
+    def tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """
+        Tile of the current generation, from memory, disk or rendered.
+        Parameters
+        ----------
+        z, x, y : int
+            Tile coordinates (XYZ scheme).
+
+        Returns
+        -------
+        bytes or None
+            The encoded tile, None when no prepared snapshot exists.
+
+        """
+        generation = snapshots.generation(self.prepared_dir)
+        key = (generation, z, x, y)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        path = self._tile_path(generation, z, x, y)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+        else:
+            source = self._source()
+            if source is None:
+                return None
+            data = self.render(source, z, x, y)
+            self._store(path, data)
+
+        with self._lock:
+            self._memory[key] = data
+            while len(self._memory) > self.memory_tiles:
+                self._memory.popitem(last=False)
+        return data
+
+    @staticmethod
+    def _store(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def render(self, source: str, z: int, x: int, y: int) -> bytes:
+        """
+        Encode the buildings and parcels intersecting a tile.
+        Parameters
+        ----------
+        source : str
+            DuckDB table expression of the prepared snapshot.
+        z, x, y : int
+            Tile coordinates (XYZ scheme).
+
+        Returns
+        -------
+        bytes
+
+        """
+        bounds = tile_bounds(z, x, y)
+        lonlat = ", ".join(str(v) for v in tile_lonlat_bounds(z, x, y))
+        # One pixel of the tile grid, coordinates are simplified at that resolution.
+        resolution = (bounds[2] - bounds[0]) / EXTENT
+        buffer = 64 * resolution
+        lod = self.level_of_detail(z)
+        suffix = f"_lod{lod}" if lod else ""
+        layers = []
+        with stage("tile_render"), self.catalog.cursor() as cursor:
+            # Snapshots prepared with other tolerances have no such level, simplify the full geometries.
+            if suffix and f"geometry{suffix}" not in source_columns(cursor, source):
+                suffix = ""
+            for name, query in LAYERS.items():
+                relation = cursor.sql(
+                    query.format(
+                        source=source,
+                        bounds=lonlat,
+                        geometry=f"geometry{suffix}",
+                        parcel_geometry=f"parcel_geometry{suffix}",
+                    )
+                )
+                names = relation.columns[1:]
+                rows = relation.fetchall()
+                if not rows:
+                    continue
+                geometries = shapely.transform(shapely.from_wkb([row[0] for row in rows]), to_web_mercator)
+                geometries = shapely.clip_by_rect(
+                    geometries,
+                    bounds[0] - buffer,
+                    bounds[1] - buffer,
+                    bounds[2] + buffer,
+                    bounds[3] + buffer,
+                )
+                # A shape smaller than a pixel collapses once quantized to the tile grid,
+                # low zooms would be empty: it is kept as a point instead.
+                minx, miny, maxx, maxy = shapely.bounds(geometries).T
+                tiny = np.fmax(maxx - minx, maxy - miny) < resolution
+                geometries = np.where(
+                    tiny,
+                    shapely.centroid(geometries),
+                    shapely.simplify(geometries, resolution, preserve_topology=True),
+                )
+                features = [
+                    {
+                        "geometry": geometry,
+                        "properties": {k: v for k, v in zip(names, row[1:], strict=True) if v is not None},
+                    }
+                    for geometry, row in zip(geometries, rows, strict=True)
+                    if not shapely.is_empty(geometry)
+                ]
+                layers.append({"name": name, "features": features})
+        return mapbox_vector_tile.encode(layers, default_options={"quantize_bounds": bounds, "extents": EXTENT})
+
+    def prerender(self, max_zoom: int, min_zoom: int = 0) -> int:
+        """
+        Render the tiles covering the latest snapshot up to ``max_zoom`` into
+        the disk cache and drop the caches of previous generations.
+        Parameters
+        ----------
+        max_zoom : int
+            Highest zoom level rendered.
+        min_zoom : int, optional
+            Lowest zoom level rendered. The default is 0.
+
+        Returns
+        -------
+        int
+            Number of rendered tiles.
+
+        """
+        source = self._source()
+        if source is None:
+            return 0
+        generation = snapshots.generation(self.prepared_dir)
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name != generation:
+                    shutil.rmtree(join(self.cache_dir, name), ignore_errors=True)
+
+        with self.catalog.cursor() as cursor:
+            extent = cursor.sql(
+                f"""
+                SELECT
+                    min(ST_XMin(g)), min(ST_YMin(g)), max(ST_XMax(g)), max(ST_YMax(g))
+                FROM (SELECT ST_GeomFromWKB(parcel_geometry) AS g FROM {source})
+                """
+            ).fetchone()
+        if extent is None or extent[0] is None:
+            return 0
+
+        rendered = 0
+        for z in range(min_zoom, min(max_zoom, MAX_ZOOM) + 1):
+            for _, x, y in tiles_covering(*extent, z):
+                path = self._tile_path(generation, z, x, y)
+                if not os.path.exists(path):
+                    self._store(path, self.render(source, z, x, y))
+                    rendered += 1
+        LOG.info(f"Pre-rendered {rendered} tiles up to zoom {max_zoom} for generation {generation}")
+        return rendered
@@ -5,12 +5,17 @@ Created on Fri Aug 02 18:40:21 2024
 
 @author: johnomole
 """
+
 from syte_pipeline.settings import Settings
+from syte_pipeline.src.profiling import stage
+from syte_pipeline.src.ledger import Checkpoint, RunLedger, fingerprint
+from syte_pipeline.src import snapshots
+from typing import Optional
 import os
-import duckdb
 import shutil
 import logging
 import geopandas as gpd
+import shapely
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +23,6 @@ logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
 LOG = logging.getLogger(__name__)
 LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
 
-conn = duckdb.connect()
 settings = Settings()
 
 
@@ -37,8 +41,10 @@ class Transformer:
             GeoDataFrame containing the data.
 
         """
-        gpd_df = gpd.read_file(filename)
-        df_wg4326 = self.convert_crs(gpd_df)
+        with stage("gdal_read"):
+            gpd_df = gpd.read_file(filename)
+        with stage("reproject"):
+            df_wg4326 = self.convert_crs(gpd_df)
         return df_wg4326
 
     @staticmethod
@@ -60,9 +66,7 @@ class Transformer:
         df_wg4326 = df.to_crs(epsg=4326)
         return df_wg4326
 
-    def spatial_join(
-        self, df_building: gpd.GeoDataFrame, df_parcel: gpd.GeoDataFrame
-    ) -> gpd.GeoDataFrame:
+    def spatial_join(self, df_building: gpd.GeoDataFrame, df_parcel: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         """
         Perform a spatial join between building and parcel GeoDataFrames.
         Parameters
@@ -78,10 +82,11 @@ class Transformer:
             A GeoDataFrame resulting from the spatial join with renamed columns.
 
         """
+        # sjoin drops the right geometry, keep the parcel geometry as a column.
+        df_parcel = df_parcel.assign(geometry_right=df_parcel.geometry)
         try:
-            gdf_join_df = gpd.sjoin(
-                df_building, df_parcel, how="inner", predicate="within"
-            )
+            with stage("geos_join"):
+                gdf_join_df = gpd.sjoin(df_building, df_parcel, how="inner", predicate="within")
         except Exception as e:
             LOG.error(f" Error during spatial join: {e}")
             raise
@@ -91,6 +96,7 @@ class Transformer:
                     "OID_left",
                     "OID_right",
                     "geometry",
+                    "geometry_right",
                     "area_left",
                     "ANZAHLGS",
                     "IDFLURST",
@@ -111,7 +117,7 @@ class Transformer:
                     "ANZAHLGS": "num_floors",
                     "IDFLURST": "on_parcel",
                     "OID_right": "parcel_identifier",
-                    "geometry": "geometry",
+                    "geometry_right": "parcel_geometry",
                     "FLAECHE": "parcel_area",
                     "LAGEBEZTXT_right": "location_text",
                     "FLSTKENNZ": "cadastral_identifier",
@@ -122,37 +128,109 @@ class Transformer:
                 }
             )
         except KeyError as e:
-            print(f"Column error during renaming: {e}")
+            LOG.error(f"Column error during renaming: {e}")
             raise
         except Exception as e:
-            print(f"Unexpected error: {e}")
+            LOG.error(f"Unexpected error: {e}")
             raise
         return df
 
-    def transform(self, file_map) -> None:
-        output_dir = os.path.join(settings.prepared_dir, "day=20240801")
-        if os.path.exists(output_dir):
+    def transform(self, file_map: dict, day: Optional[str] = None, checkpoint: Optional[Checkpoint] = None) -> None:
+        """
+        Join buildings and parcels of every source directory and write them
+        into the prepared snapshot of ``day``.
+        Parameters
+        ----------
+        file_map : dict
+            Source directory name to the shapefiles it contains.
+        day : str, optional
+            Snapshot day (YYYYMMDD). The default is today.
+        checkpoint : Checkpoint, optional
+            Directories already joined by this run are skipped. The snapshot is
+            rewritten from scratch only by a fresh run. The default is None (a
+            fresh run).
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        UnitsFailed
+            When some directories failed, once the others are written.
+
+        """
+        day = day or snapshots.today()
+        output_dir = snapshots.partition_dir(settings.prepared_dir, day)
+        if checkpoint is None:
+            checkpoint = RunLedger(settings.ledger_path).run(f"transform/{day}", resume=False)
+        if checkpoint.fresh and os.path.exists(output_dir):
             shutil.rmtree(output_dir)
         os.makedirs(output_dir, exist_ok=True)
-        for k, file_paths in file_map.items():
-            dfs = {}
-            for file_path in file_paths:
-                file_name = os.path.splitext(os.path.basename(file_path))[0]
-                if file_name in ["GebaeudeBauwerk", "Flurstueck"]:
-                    try:
-                        dfs[file_name] = self.read_shapefiles_file(file_path)
-                    except Exception as e:
-                        LOG.error(f"Error reading shapefile {file_path}: {e}")
-                    continue
-
-            df_building = dfs.get("GebaeudeBauwerk")
-            df_parcel = dfs.get("Flurstueck")
-            if df_building is not None and df_parcel is not None:
-                try:
-                    df_spatial = self.spatial_join(df_building, df_parcel)
-                    self.to_parquet(df_spatial, output_dir)
-                except Exception as e:
-                    LOG.error(f"Error during spatial join or parquet conversion: {e}")
+        for k, file_paths in sorted(file_map.items()):
+            checkpoint.execute(
+                f"directory/{k}", fingerprint(file_paths), self.transform_directory, file_paths, output_dir
+            )
+        checkpoint.raise_failures()
+
+    def transform_directory(self, file_paths: list, output_dir: str) -> None:
+        """
+        Join the buildings and parcels of one source directory and write one
+        parquet file per district. This is the unit of work of the pipeline workers.
+        Parameters
+        ----------
+        file_paths : list
+            Shapefiles of the directory.
+        output_dir : str
+            Directory of the prepared snapshot.
+
+        Returns
+        -------
+        None
+
+        """
+        dfs = {}
+        for file_path in file_paths:
+            file_name = os.path.splitext(os.path.basename(file_path))[0]
+            if file_name in ["GebaeudeBauwerk", "Flurstueck"]:
+                dfs[file_name] = self.read_shapefiles_file(file_path)
+
+        df_building = dfs.get("GebaeudeBauwerk")
+        df_parcel = dfs.get("Flurstueck")
+        if df_building is not None and df_parcel is not None:
+            df_spatial = self.spatial_join(df_building, df_parcel)
+            os.makedirs(output_dir, exist_ok=True)
+            self.to_parquet(df_spatial, output_dir)
+
+    @staticmethod
+    def add_levels_of_detail(df: gpd.GeoDataFrame, tolerances: list[float]) -> gpd.GeoDataFrame:
+        """
+        Add simplified copies of the geometry columns, <column>_lod1 for the
+        first tolerance and so on. Simplification preserves the topology and
+        the coordinates are snapped to a grid of a tenth of the tolerance.
+        Parameters
+        ----------
+        df : gpd.GeoDataFrame
+            Output of spatial_join.
+        tolerances : list[float]
+            Simplification tolerances in degrees, increasing.
+
+        Returns
+        -------
+        gpd.GeoDataFrame
+
+        """
+        levels = {}
+        for column in ("geometry", "parcel_geometry"):
+            if column not in df:
+                continue
+            geometries = df[column].values
+            for level, tolerance in enumerate(tolerances, start=1):
+                simplified = shapely.simplify(geometries, tolerance, preserve_topology=True)
+                levels[f"{column}_lod{level}"] = gpd.GeoSeries(
+                    shapely.set_precision(simplified, tolerance / 10), index=df.index, crs=df.crs
+                )
+        return df.assign(**levels)
 
     def to_parquet(self, df_spatial: gpd.GeoDataFrame, output_dir: str) -> None:
         """
@@ -171,12 +249,15 @@ class Transformer:
         """
 
         try:
+            with stage("simplify"):
+                df_spatial = self.add_levels_of_detail(df_spatial, settings.lod_tolerances)
             for district, group in df_spatial.groupby("district"):
-
                 output_file = os.path.join(output_dir, f"{district}.parquet")
 
-                group.to_parquet(output_file, engine="pyarrow", index=False)
+                with stage("parquet_write"):
+                    group.to_parquet(output_file, engine="pyarrow", index=False)
 
                 LOG.info(f"Saved partition for district {district} to {output_file}")
         except Exception as e:
             LOG.error(f"Error saving parquet files: {e}")
+            raise
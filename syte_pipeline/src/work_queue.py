@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lease-based work queue shared by any number of pipeline workers.
+
+A unit of work (a source directory to transform, a district partition to load)
+is leased by one worker for ``lease_seconds``. The worker extends the lease with
+heartbeats while it runs; when it dies the lease expires and another worker
+picks the unit up again, up to ``max_attempts`` times. A handler raising
+Deferred releases its unit without using an attempt, e.g. a step that waits for
+the other units of its run.
+
+Backends: postgres (``SELECT ... FOR UPDATE SKIP LOCKED``) for several nodes,
+sqlite for a single machine and the tests.
+"""
+
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Callable, Optional
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)-10s %(message)s")
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.environ.get("LOG_LEVEL", logging.DEBUG))
+
+STATUSES = ("pending", "leased", "done", "failed")
+
+
+class Deferred(Exception):
+    """Raised by a handler whose unit cannot run yet, it is released for a later lease."""
+
+
+@dataclass
+class WorkItem:
+    id: int
+    queue: str
+    key: str
+    payload: dict
+    attempts: int
+    lease_token: str
+
+
+class WorkQueue(ABC):
+    """
+    Common interface of the backends.
+    """
+
+    def __init__(self, lease_seconds: float = 300, max_attempts: int = 3):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    @abstractmethod
+    def enqueue(self, queue: str, units: dict[str, dict]) -> int:
+        """
+        Add units, or reset them to pending if their key is already queued.
+        Parameters
+        ----------
+        queue : str
+            Name of the queue, e.g. transform or load.
+        units : dict[str, dict]
+            Unique key of each unit to its JSON serializable payload.
+
+        Returns
+        -------
+        int
+            Number of queued units.
+
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def lease(self, queue: str, worker: str) -> Optional[WorkItem]:
+        """Lease the oldest available unit of ``queue``, None when there is none."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def heartbeat(self, item: WorkItem) -> bool:
+        """Extend the lease, False when it was lost (expired and leased by someone else)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def complete(self, item: WorkItem) -> bool:
+        """Mark the unit done, False when the lease was lost."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def fail(self, item: WorkItem, error: str) -> bool:
+        """Release the unit for a retry, or mark it failed after max_attempts."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def release(self, item: WorkItem) -> bool:
+        """Release the unit without counting the attempt."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire(self, queue: str) -> int:
+        """
+        Mark the units whose lease expired on their last attempt as failed,
+        they would stay leased forever. lease does it before each lease, a
+        step waiting on units of a queue it doesn't lease calls it itself.
+        Returns the number of failed units.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def stats(self, queue: str, prefix: str = "") -> dict[str, int]:
+        """Number of units per status, of the units whose key starts with ``prefix``."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def failures(self, queue: str) -> dict[str, str]:
+        """Key of the failed units to their last error."""
+        raise NotImplementedError
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """
+    Queue in a sqlite file: workers of one machine share it, ``BEGIN IMMEDIATE``
+    serializes the leases.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 300, max_attempts: int = 3):
+        super().__init__(lease_seconds, max_attempts)
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS work_units (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    queue TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease_token TEXT,
+                    lease_expires_at REAL,
+                    last_error TEXT,
+                    updated_at REAL,
+                    UNIQUE (queue, key)
+                )
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _write(self, query: str, params: tuple) -> int:
+        conn = self._connect()
+        try:
+            return conn.execute(query, params).rowcount
+        finally:
+            conn.close()
+
+    def enqueue(self, queue: str, units: dict[str, dict]) -> int:
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                """
+                INSERT INTO work_units (queue, key, payload, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (queue, key) DO UPDATE SET
+                    payload = excluded.payload,
+                    status = 'pending',
+                    attempts = 0,
+                    worker = NULL,
+                    lease_token = NULL,
+                    last_error = NULL,
+                    updated_at = excluded.updated_at
+                """,
+                [(queue, key, json.dumps(payload), time.time()) for key, payload in units.items()],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return len(units)
+
+    EXPIRE = """
+        UPDATE work_units SET status = 'failed', last_error = 'lease expired', lease_token = NULL
+        WHERE queue = ? AND status = 'leased' AND lease_expires_at < ? AND attempts >= ?
+    """
+
+    def lease(self, queue: str, worker: str) -> Optional[WorkItem]:
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(self.EXPIRE, (queue, now, self.max_attempts))
+            row = conn.execute(
+                """
+                SELECT id, key, payload, attempts FROM work_units
+                WHERE queue = ? AND attempts < ?
+                    AND (status = 'pending' OR (status = 'leased' AND lease_expires_at < ?))
+                ORDER BY id LIMIT 1
+                """,
+                (queue, self.max_attempts, now),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    """
+                    UPDATE work_units SET status = 'leased', attempts = attempts + 1, worker = ?,
+                        lease_token = ?, lease_expires_at = ?, updated_at = ?
+                    WHERE id = ?
+                    """,
+                    (worker, token, now + self.lease_seconds, now, row[0]),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return WorkItem(row[0], queue, row[1], json.loads(row[2]), row[3] + 1, token)
+
+    def heartbeat(self, item: WorkItem) -> bool:
+        now = time.time()
+        return 1 == self._write(
+            """
+            UPDATE work_units SET lease_expires_at = ?, updated_at = ?
+            WHERE id = ? AND lease_token = ? AND status = 'leased'
+            """,
+            (now + self.lease_seconds, now, item.id, item.lease_token),
+        )
+
+    def complete(self, item: WorkItem) -> bool:
+        return 1 == self._write(
+            """
+            UPDATE work_units SET status = 'done', lease_token = NULL, updated_at = ?
+            WHERE id = ? AND lease_token = ? AND status = 'leased'
+            """,
+            (time.time(), item.id, item.lease_token),
+        )
+
+    def fail(self, item: WorkItem, error: str) -> bool:
+        return 1 == self._write(
+            """
+            UPDATE work_units SET
+                status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                last_error = ?, lease_token = NULL, updated_at = ?
+            WHERE id = ? AND lease_token = ? AND status = 'leased'
+            """,
+            (self.max_attempts, error, time.time(), item.id, item.lease_token),
+        )
+
+    def release(self, item: WorkItem) -> bool:
+        return 1 == self._write(
+            """
+            UPDATE work_units SET status = 'pending', attempts = attempts - 1, lease_token = NULL, updated_at = ?
+            WHERE id = ? AND lease_token = ? AND status = 'leased'
+            """,
+            (time.time(), item.id, item.lease_token),
+        )
+
+    def expire(self, queue: str) -> int:
+        return self._write(self.EXPIRE, (queue, time.time(), self.max_attempts))
+
+    def stats(self, queue: str, prefix: str = "") -> dict[str, int]:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT status, count(*) FROM work_units WHERE queue = ? AND substr(key, 1, ?) = ? GROUP BY status",
+                (queue, len(prefix), prefix),
+            ).fetchall()
+        finally:
+            conn.close()
+        return {status: 0 for status in STATUSES} | dict(rows)
+
+    def failures(self, queue: str) -> dict[str, str]:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT key, last_error FROM work_units WHERE queue = ? AND status = 'failed'", (queue,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return dict(rows)
+
+
+class PostgresWorkQueue(WorkQueue):
+    """
+    Queue in a postgres table, for workers on several nodes. Concurrent leases
+    skip the rows locked by each other instead of waiting. Payloads carry
+    local paths (raw, staging and prepared files): the nodes must mount the
+    same shared filesystem at the same path, SYTE_LOCAL_DIR included.
+    """
+
+    def __init__(self, db_config: str, lease_seconds: float = 300, max_attempts: int = 3):
+        super().__init__(lease_seconds, max_attempts)
+        self.db_config = db_config
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS work_units (
+                    id BIGSERIAL PRIMARY KEY,
+                    queue VARCHAR NOT NULL,
+                    key VARCHAR NOT NULL,
+                    payload JSONB NOT NULL,
+                    status VARCHAR NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker VARCHAR,
+                    lease_token VARCHAR,
+                    lease_expires_at timestamp with time zone,
+                    last_error VARCHAR,
+                    updated_at timestamp with time zone default now(),
+                    UNIQUE (queue, key)
+                );
+                CREATE INDEX IF NOT EXISTS work_units_available_idx
+                    ON work_units (queue, status, id);
+                """
+            )
+
+    def _connect(self):
+        import psycopg
+
+        return psycopg.connect(self.db_config, autocommit=True)
+
+    def _write(self, query: str, params: tuple) -> int:
+        with self._connect() as conn:
+            return conn.execute(query, params).rowcount
+
+    def enqueue(self, queue: str, units: dict[str, dict]) -> int:
+        with self._connect() as conn, conn.transaction():
+            conn.cursor().executemany(
+                """
+                INSERT INTO work_units (queue, key, payload) VALUES (%s, %s, %s)
+                ON CONFLICT (queue, key) DO UPDATE SET
+                    payload = EXCLUDED.payload,
+                    status = 'pending',
+                    attempts = 0,
+                    worker = NULL,
+                    lease_token = NULL,
+                    last_error = NULL,
+                    updated_at = now()
+                """,
+                [(queue, key, json.dumps(payload)) for key, payload in units.items()],
+            )
+        return len(units)
+
+    EXPIRE = """
+        UPDATE work_units SET status = 'failed', last_error = 'lease expired', lease_token = NULL
+        WHERE queue = %s AND status = 'leased' AND lease_expires_at < now() AND attempts >= %s
+    """
+
+    def lease(self, queue: str, worker: str) -> Optional[WorkItem]:
+        token = uuid.uuid4().hex
+        with self._connect() as conn, conn.transaction():
+            conn.execute(self.EXPIRE, (queue, self.max_attempts))
+            row = conn.execute(
+                """
+                UPDATE work_units SET status = 'leased', attempts = attempts + 1, worker = %s,
+                    lease_token = %s, lease_expires_at = now() + make_interval(secs => %s),
+                    updated_at = now()
+                WHERE id = (
+                    SELECT id FROM work_units
+                    WHERE queue = %s AND attempts < %s
+                        AND (status = 'pending' OR (status = 'leased' AND lease_expires_at < now()))
+                    ORDER BY id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, key, payload, attempts
+                """,
+                (worker, token, self.lease_seconds, queue, self.max_attempts),
+            ).fetchone()
+        if row is None:
+            return None
+        return WorkItem(row[0], queue, row[1], row[2], row[3], token)
+
+    def heartbeat(self, item: WorkItem) -> bool:
+        return 1 == self._write(
+            """
+            UPDATE work_units SET lease_expires_at = now() + make_interval(secs => %s), updated_at = now()
+            WHERE id = %s AND lease_token = %s AND status = 'leased'
+            """,
+            (self.lease_seconds, item.id, item.lease_token),
+        )
+
+    def complete(self, item: WorkItem) -> bool:
+        return 1 == self._write(
+            """
+            UPDATE work_units SET status = 'done', lease_token = NULL, updated_at = now()
+            WHERE id = %s AND lease_token = %s AND status = 'leased'
+            """,
+            (item.id, item.lease_token),
+        )
+
+    def fail(self, item: WorkItem, error: str) -> bool:
+        return 1 == self._write(
+            """
+            UPDATE work_units SET
+                status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+                last_error = %s, lease_token = NULL, updated_at = now()
+            WHERE id = %s AND lease_token = %s AND status = 'leased'
+            """,
+            (self.max_attempts, error, item.id, item.lease_token),
+        )
+
+    def release(self, item: WorkItem) -> bool:
+        return 1 == self._write(
+            """
+            UPDATE work_units SET status = 'pending', attempts = attempts - 1, lease_token = NULL, updated_at = now()
+            WHERE id = %s AND lease_token = %s AND status = 'leased'
+            """,
+            (item.id, item.lease_token),
+        )
+
+    def expire(self, queue: str) -> int:
+        return self._write(self.EXPIRE, (queue, self.max_attempts))
+
+    def stats(self, queue: str, prefix: str = "") -> dict[str, int]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT status, count(*) FROM work_units WHERE queue = %s AND starts_with(key, %s) GROUP BY status",
+                (queue, prefix),
+            ).fetchall()
+        return {status: 0 for status in STATUSES} | dict(rows)
+
+    def failures(self, queue: str) -> dict[str, str]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT key, last_error FROM work_units WHERE queue = %s AND status = 'failed'", (queue,)
+            ).fetchall()
+        return dict(rows)
+
+
+class Worker:
+    """
+    Lease units from the queues and run the handler registered for each queue,
+    sending heartbeats while the handler runs.
+    """
+
+    def __init__(
+        self,
+        work_queue: WorkQueue,
+        handlers: dict[str, Callable[[dict], None]],
+        worker_id: Optional[str] = None,
+        heartbeat_seconds: Optional[float] = None,
+        defer_seconds: float = 5,
+    ):
+        """
+
+        Parameters
+        ----------
+        work_queue : WorkQueue
+            Backend shared with the other workers.
+        handlers : dict[str, Callable[[dict], None]]
+            Queue name to the function processing the payload of its units.
+        worker_id : str, optional
+            Name recorded on the leased units. The default is <host>-<pid>.
+        heartbeat_seconds : float, optional
+            Interval of the heartbeats. The default is a third of the lease.
+        defer_seconds : float, optional
+            Wait after a deferred unit before the next lease. The default is 5.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.work_queue = work_queue
+        self.handlers = handlers
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.heartbeat_seconds = heartbeat_seconds or work_queue.lease_seconds / 3
+        self.defer_seconds = defer_seconds
+
+    def process(self, item: WorkItem) -> Optional[bool]:
+        """Run the handler of one leased unit, True when it succeeded, None when it was deferred."""
+        done = threading.Event()
+
+        def beat() -> None:
+            while not done.wait(self.heartbeat_seconds):
+                if not self.work_queue.heartbeat(item):
+                    LOG.warning(f"Lease of {item.queue}/{item.key} lost")
+                    return
+
+        heart = threading.Thread(target=beat, daemon=True)
+        heart.start()
+        deferred = False
+        try:
+            self.handlers[item.queue](item.payload)
+        except Deferred as e:
+            LOG.info(f"Unit {item.queue}/{item.key} deferred: {e}")
+            deferred = True
+        except Exception as e:
+            LOG.error(f"Unit {item.queue}/{item.key} failed (attempt {item.attempts}): {e}")
+            self.work_queue.fail(item, str(e))
+            return False
+        finally:
+            done.set()
+            heart.join()
+        if deferred:
+            self.work_queue.release(item)
+            time.sleep(self.defer_seconds)
+            return None
+        self.work_queue.complete(item)
+        LOG.info(f"Unit {item.queue}/{item.key} done")
+        return True
+
+    def run(self, forever: bool = False, poll_seconds: float = 5) -> int:
+        """
+        Process units until every queue is empty, or forever.
+        Parameters
+        ----------
+        forever : bool, optional
+            Keep polling once the queues are empty. The default is False.
+        poll_seconds : float, optional
+            Wait between polls of empty queues. The default is 5.
+
+        Returns
+        -------
+        int
+            Number of processed units, done or failed; deferred units are not counted.
+
+        """
+        processed = 0
+        while True:
+            item = None
+            for queue in self.handlers:
+                item = self.work_queue.lease(queue, self.worker_id)
+                if item is not None:
+                    break
+            if item is not None:
+                if self.process(item) is not None:
+                    processed += 1
+            elif forever:
+                time.sleep(poll_seconds)
+            else:
+                return processed
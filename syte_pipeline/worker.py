@@ -0,0 +1,179 @@
+"""
+Pipeline worker: processes the units queued by /api/v1/cadastral/queue/*.
+
+Run any number of them, on one or several nodes (postgres queue backend, the
+payloads carry local paths: every node mounts the same shared filesystem at the
+same SYTE_LOCAL_DIR):
+
+    syte_worker --queue transform --queue finalize --queue load --queue load_finalize --forever
+
+The transform units of a run write into a staging directory; its finalize unit
+waits for them, moves the snapshot into place and publishes it once. The
+load_finalize unit of a load run waits for its load units, rebuilds the
+indexes, analyzes the tables and records the loaded snapshot.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+
+from syte_pipeline.settings import DBCredentials, Settings
+from syte_pipeline.src import snapshots
+from syte_pipeline.src.work_queue import Deferred, PostgresWorkQueue, SQLiteWorkQueue, Worker, WorkQueue
+
+logger = logging.getLogger(__name__)
+
+QUEUES = ("transform", "finalize", "load", "load_finalize")
+
+
+def get_work_queue(settings: Settings) -> WorkQueue:
+    if settings.queue_backend == "postgres":
+        return PostgresWorkQueue(DBCredentials().conninfo, settings.queue_lease_seconds, settings.queue_max_attempts)
+    if settings.queue_backend == "sqlite":
+        return SQLiteWorkQueue(settings.queue_path, settings.queue_lease_seconds, settings.queue_max_attempts)
+    raise ValueError(f"Unknown queue backend {settings.queue_backend}")
+
+
+def get_tile_renderer(settings: Settings, catalog=None):
+    from syte_pipeline.src.catalog import Catalog
+    from syte_pipeline.src.tiles import TileRenderer
+
+    return TileRenderer(
+        catalog or Catalog(settings.catalog_dir, settings.prepared_dir),
+        settings.tiles_dir,
+        settings.tile_cache_size,
+        settings.lod_tolerances,
+    )
+
+
+def finalize_prepare(settings: Settings, day: str, metrics, tile_renderer) -> str:
+    """
+    Publish a prepared snapshot: compute its metrics, apply the retention,
+    build the catalog, bump the generation and pre-render the tiles.
+    Parameters
+    ----------
+    settings : Settings
+    day : str
+        Prepared snapshot (YYYYMMDD).
+    metrics : PotentialMetrics
+    tile_renderer : TileRenderer
+
+    Returns
+    -------
+    str
+        The new generation.
+
+    """
+    from syte_pipeline.src.catalog import build_catalog
+
+    metrics.compute(
+        snapshots.partition_dir(settings.prepared_dir, day),
+        snapshots.partition_dir(settings.metrics_dir, day),
+    )
+    for base in (settings.raw_dir, settings.prepared_dir, settings.metrics_dir):
+        snapshots.apply_retention(base, settings.snapshot_retention, settings.snapshot_max_age_days)
+    generation = build_catalog(settings.prepared_dir, settings.catalog_dir)
+    snapshots.bump_generation(settings.prepared_dir, generation)
+    tile_renderer.prerender(settings.tile_prerender_max_zoom)
+    return generation
+
+
+def wait_for_units(work_queue: WorkQueue, queue: str, prefix: str) -> dict:
+    """
+    Units of a run once none is pending or leased, raises Deferred before.
+    Units whose lease expired on their last attempt are failed first: the step
+    may run on a worker which never leases ``queue`` and would wait on them forever.
+    """
+    work_queue.expire(queue)
+    units = work_queue.stats(queue, prefix)
+    if units["pending"] or units["leased"]:
+        raise Deferred(f"{units['pending'] + units['leased']} {queue} units left")
+    return units
+
+
+def transform_handler(settings: Settings):
+    from syte_pipeline.src.transformation import Transformer
+
+    transformer = Transformer()
+
+    def handle(payload: dict) -> None:
+        transformer.transform_directory(payload["files"], payload["output_dir"])
+
+    return handle
+
+
+def finalize_handler(settings: Settings):
+    from syte_pipeline.src.metrics import PotentialMetrics
+
+    work_queue = get_work_queue(settings)
+    metrics = PotentialMetrics(settings.metrics_cell_size)
+    tile_renderer = get_tile_renderer(settings)
+
+    def handle(payload: dict) -> None:
+        units = wait_for_units(work_queue, "transform", payload["prefix"])
+        if units["failed"]:
+            shutil.rmtree(payload["staging_dir"], ignore_errors=True)
+            raise RuntimeError(f"{units['failed']} transform units failed, {payload['day']} is not published")
+        # A retry after a failed publication finds the snapshot already in place.
+        if os.path.exists(payload["staging_dir"]):
+            snapshots.replace_partition(settings.prepared_dir, payload["day"], payload["staging_dir"])
+        finalize_prepare(settings, payload["day"], metrics, tile_renderer)
+
+    return handle
+
+
+def load_handler(settings: Settings):
+    from syte_pipeline.src.data_loader import ConnectionPool, DataLoader
+
+    data_loader = DataLoader(DBCredentials().conninfo)
+    pool = ConnectionPool(data_loader.db_config, 1)
+
+    def handle(payload: dict) -> None:
+        # Identifiers of this partition loaded from another one, see DataLoader.conflict_owners.
+        owners = {(table, identifier): owner for table, identifier, owner in payload["owners"]}
+        data_loader.copy_partition_to_psql(payload["file"], owners, pool)
+
+    return handle
+
+
+def load_finalize_handler(settings: Settings):
+    from syte_pipeline.src.schema import SchemaManager
+
+    work_queue = get_work_queue(settings)
+    schema = SchemaManager(DBCredentials().conninfo)
+
+    def handle(payload: dict) -> None:
+        units = wait_for_units(work_queue, "load", payload["prefix"])
+        schema.create_secondary_indexes()
+        schema.analyze()
+        if units["failed"]:
+            raise RuntimeError(f"{units['failed']} load units failed, {payload['day']} is not recorded as loaded")
+        # Read by the changes mode of /cadastral/analytics as the snapshot to diff against.
+        snapshots.write_marker(settings.prepared_dir, "loaded_day", payload["day"])
+
+    return handle
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queue", action="append", choices=QUEUES, help="Queues to serve, default all")
+    parser.add_argument("--forever", action="store_true", help="Keep polling once the queues are empty")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+    settings = Settings()
+    factories = {
+        "transform": transform_handler,
+        "finalize": finalize_handler,
+        "load": load_handler,
+        "load_finalize": load_finalize_handler,
+    }
+    handlers = {queue: factories[queue](settings) for queue in args.queue or QUEUES}
+    processed = Worker(get_work_queue(settings), handlers).run(forever=args.forever)
+    logger.info(f"Processed {processed} units")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import asyncio
+
+from syte_pipeline.loadtest import Sample, percentile, run_load, summarize
+
+
+class FakeResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+    async def aread(self) -> bytes:
+        return b""
+
+
+class FakeClient:
+    """Answers 500 on /fail and 200 on anything else."""
+
+    async def get(self, path: str) -> FakeResponse:
+        await asyncio.sleep(0.001)
+        return FakeResponse(500 if path == "/fail" else 200)
+
+
+def test_percentile_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([3.0], 99) == 3.0
+
+
+def test_summarize_counts_errors():
+    samples = [
+        Sample("a", 0.010, 200),
+        Sample("a", 0.020, 200),
+        Sample("a", 0.030, 503),
+        Sample("b", 0.005, None, "ReadTimeout: timed out"),
+    ]
+    report = summarize(samples, elapsed=2.0)
+    assert report["a"]["requests"] == 3
+    assert report["a"]["errors"] == 1
+    assert report["a"]["throughput"] == 1.5
+    assert report["a"]["statuses"] == {"200": 2, "503": 1}
+    assert report["a"]["latency_ms"]["p50"] == 20.0
+    assert report["b"]["error_rate"] == 1.0
+    assert report["b"]["statuses"] == {"ReadTimeout": 1}
+
+
+def test_run_load_hits_every_endpoint():
+    endpoints = {"ok": "/ok", "fail": "/fail"}
+    samples, elapsed = asyncio.run(run_load(FakeClient(), endpoints, clients=4, duration=0.05))
+    report = summarize(samples, elapsed)
+    assert set(report) == {"ok", "fail"}
+    assert report["ok"]["errors"] == 0
+    assert report["fail"]["error_rate"] == 1.0
@@ -0,0 +1,54 @@
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from syte_pipeline.middleware import CacheCompressionMiddleware, matching_tags, negotiate
+
+BODY = "parcel " * 500
+calls = []
+
+
+def cadastral(request):
+    calls.append(request.url.query)
+    return PlainTextResponse(BODY)
+
+
+app = Starlette(routes=[Route("/api/v1/cadastral/", cadastral)])
+app.add_middleware(
+    CacheCompressionMiddleware,
+    generation=lambda: "g1",
+    cached_prefixes=("/api/v1/cadastral/",),
+    minimum_size=100,
+)
+client = TestClient(app)
+
+
+def test_negotiate():
+    assert negotiate("") is None
+    assert negotiate("gzip, deflate") == "gzip"
+    assert negotiate("gzip;q=0") is None
+    assert negotiate("identity") is None
+
+
+def test_matching_tags_ignore_encoding():
+    assert matching_tags('"abc-gzip", W/"def"') == {"abc", "def"}
+
+
+def test_compressed_and_not_modified():
+    response = client.get("/api/v1/cadastral/?page=1", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.text == BODY
+    etag = response.headers["ETag"]
+    assert etag.endswith('-gzip"')
+
+    calls.clear()
+    cached = client.get("/api/v1/cadastral/?page=1", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert cached.status_code == 304
+    assert calls == []
+
+    other = client.get("/api/v1/cadastral/?page=2", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert other.status_code == 200
+    assert other.text == BODY
@@ -0,0 +1,129 @@
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from syte_pipeline.app import app
+from syte_pipeline.s1 import analytic
+from syte_pipeline.src import snapshots
+from syte_pipeline.src.catalog import Catalog, build_catalog
+from syte_pipeline.src.ledger import RunLedger
+from syte_pipeline.src.resources import duckdb_cursor
+
+
+class FakeSchema:
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append(name)
+
+
+class FakeLoader:
+    def __init__(self, fail_db_objects: bool = False):
+        self.schema = FakeSchema()
+        self.fail_db_objects = fail_db_objects
+
+    def create_db_objects(self):
+        if self.fail_db_objects:
+            raise RuntimeError("postgis is missing")
+
+    def export_partitions_in_parallel(self, *args):
+        raise RuntimeError("1 partitions failed to load")
+
+
+class RecordingLoader(FakeLoader):
+    def __init__(self):
+        super().__init__()
+        self.loaded = []
+
+    def conflict_owners(self, files):
+        return {}
+
+    def export_building_parcel_data_to_psql(self, batch, owners):
+        self.loaded.append(os.path.basename(os.path.dirname(batch[0])))
+
+
+@pytest.fixture
+def prepared(tmp_path, monkeypatch):
+    monkeypatch.setattr(analytic.settings, "local_dir", str(tmp_path))
+    monkeypatch.setattr(analytic, "get_run_ledger", lambda: RunLedger(str(tmp_path / "ledger.sqlite")))
+    partition = snapshots.partition_dir(analytic.settings.prepared_dir, "20240801")
+    os.makedirs(partition)
+    open(os.path.join(partition, "Mitte.parquet"), "wb").close()
+
+
+def test_completed_load_is_not_resumed(prepared, monkeypatch):
+    partition = snapshots.partition_dir(analytic.settings.prepared_dir, "20240802")
+    os.makedirs(partition)
+    open(os.path.join(partition, "Mitte.parquet"), "wb").close()
+    loader = RecordingLoader()
+    monkeypatch.setattr(analytic, "get_data_loader_handler", lambda: loader)
+    client = TestClient(app)
+    for day in ("20240801", "20240802", "20240801"):
+        assert client.post(f"/api/v1/cadastral/analytics?day={day}").status_code == 200
+        assert snapshots.read_marker(analytic.settings.prepared_dir, "loaded_day") == day
+    # Loading 20240801 again after 20240802 reloads it instead of skipping its batches.
+    assert loader.loaded == ["day=20240801", "day=20240802", "day=20240801"]
+
+
+def test_failed_parallel_load_rebuilds_indexes(prepared, monkeypatch):
+    loader = FakeLoader()
+    monkeypatch.setattr(analytic, "get_data_loader_handler", lambda: loader)
+    response = TestClient(app).post("/api/v1/cadastral/analytics?parallel=true")
+    assert response.status_code == 500
+    assert "partitions failed" in response.json()
+    assert loader.schema.calls[-2:] == ["create_secondary_indexes", "analyze"]
+
+
+def test_failed_db_objects_is_an_error(prepared, monkeypatch):
+    monkeypatch.setattr(analytic, "get_data_loader_handler", lambda: FakeLoader(fail_db_objects=True))
+    response = TestClient(app).post("/api/v1/cadastral/analytics")
+    assert response.status_code == 500
+    assert "postgis is missing" in response.json()
+
+
+@pytest.mark.parametrize("path", ["/api/v1/cadastral/analytics", "/api/v1/cadastral/queue/analytics"])
+def test_requested_day_is_validated(prepared, monkeypatch, path):
+    monkeypatch.setattr(analytic, "get_data_loader_handler", lambda: FakeLoader(fail_db_objects=True))
+    client = TestClient(app)
+    assert client.post(f"{path}?day=garbage").status_code == 422
+    # An explicit day does not fall back to the older snapshot.
+    assert client.post(f"{path}?day=20240802").status_code == 404
+    assert client.post(f"{path}?day=2024-08-01").status_code == 500
+
+
+def test_missing_level_of_detail_is_rejected(tmp_path, monkeypatch):
+    prepared_dir, catalog_dir = str(tmp_path / "prepared"), str(tmp_path / "catalog")
+    partition = snapshots.partition_dir(prepared_dir, "20240801")
+    os.makedirs(partition)
+    with duckdb_cursor("pipeline") as cursor:
+        cursor.sql(
+            "COPY (SELECT 'b1' AS building_identifier, ST_AsWKB(ST_Point(8.8, 53.1)) AS geometry, "
+            "1.0 AS building_area, 2 AS num_floors, 'p1' AS on_parcel, 'house' AS type, "
+            "NULL AS building_date, 'p1' AS parcel_identifier, '' AS location_text, 2.0 AS parcel_area, "
+            "'c1' AS cadastral_identifier, 'Bremen' AS municipal, 'Mitte' AS district) "
+            f"TO '{partition}/Mitte.parquet' (FORMAT parquet)"
+        )
+    snapshots.bump_generation(prepared_dir, build_catalog(prepared_dir, catalog_dir))
+    monkeypatch.setattr(analytic, "get_catalog", lambda: Catalog(catalog_dir, prepared_dir))
+    client = TestClient(app)
+    assert client.get("/api/v1/cadastral/?lod=1").status_code == 422
+    response = client.get("/api/v1/cadastral/?lod=0")
+    assert response.status_code == 200
+    assert response.json()[0]["geometry"] == "POINT (8.8 53.1)"
+
+
+def test_potential_has_no_partition_column(tmp_path, monkeypatch):
+    monkeypatch.setattr(analytic.settings, "local_dir", str(tmp_path))
+    partition = snapshots.partition_dir(analytic.settings.metrics_dir, "20240801")
+    os.makedirs(partition)
+    with duckdb_cursor("pipeline") as cursor:
+        cursor.sql(
+            "COPY (SELECT '1948_23520' AS cell_id, 250.0::DOUBLE AS free_area, "
+            "ST_AsWKB(ST_Point(8.8, 53.1)) AS geometry) "
+            f"TO '{partition}/grid.parquet' (FORMAT parquet)"
+        )
+    response = TestClient(app).get("/api/v1/cadastral/potential")
+    assert response.status_code == 200
+    assert response.json() == [{"cell_id": "1948_23520", "free_area": 250.0, "geometry": "POINT (8.8 53.1)"}]
@@ -0,0 +1,49 @@
+import os
+
+import duckdb
+
+from syte_pipeline.src import snapshots
+from syte_pipeline.src import catalog as catalog_module
+from syte_pipeline.src.catalog import LATEST_VIEW, Catalog, build_catalog, view_name
+
+
+def write_snapshot(prepared_dir: str, day: str, rows: int) -> None:
+    partition = snapshots.partition_dir(prepared_dir, day)
+    os.makedirs(partition)
+    duckdb.sql(
+        f"COPY (SELECT range AS parcel_identifier, 'Mitte' AS district FROM range({rows})) "
+        f"TO '{partition}/Mitte.parquet' (FORMAT parquet)"
+    )
+
+
+def test_catalog_follows_the_generation(tmp_path):
+    prepared_dir, catalog_dir = str(tmp_path / "prepared"), str(tmp_path / "catalog")
+    write_snapshot(prepared_dir, "20240801", 3)
+    snapshots.bump_generation(prepared_dir, build_catalog(prepared_dir, catalog_dir))
+    catalog = Catalog(catalog_dir, prepared_dir)
+    assert catalog.source() == LATEST_VIEW
+    with catalog.cursor() as cursor:
+        assert cursor.sql(f"SELECT count(*), any_value(day) FROM {LATEST_VIEW}").fetchone() == (3, "20240801")
+
+    first = snapshots.generation(prepared_dir)
+    with catalog.cursor() as running:
+        write_snapshot(prepared_dir, "20240802", 5)
+        snapshots.bump_generation(prepared_dir, build_catalog(prepared_dir, catalog_dir))
+        assert catalog.source("2024-08-01") == view_name("20240801")
+        with catalog.cursor() as cursor:
+            assert cursor.sql(f"SELECT count(*) FROM {LATEST_VIEW}").fetchone() == (5,)
+        # The previous generation stays open until its last cursor is closed.
+        assert running.sql(f"SELECT count(*) FROM {LATEST_VIEW}").fetchone() == (3,)
+    assert f"catalog_{first.replace('-', '_')}" not in catalog_module._attached
+    # Catalogs of the same directory share the attached file.
+    with Catalog(catalog_dir, prepared_dir).cursor() as cursor:
+        assert cursor.sql(f"SELECT count(*) FROM {LATEST_VIEW}").fetchone() == (5,)
+
+    # The catalog published during a build is kept, older ones are removed.
+    # Catalogs being written by another builder are never removed.
+    assert os.path.exists(f"{catalog_dir}/{first}.duckdb")
+    open(f"{catalog_dir}/{first}-other.duckdb.tmp", "w").close()
+    build_catalog(prepared_dir, catalog_dir)
+    assert not os.path.exists(f"{catalog_dir}/{first}.duckdb")
+    assert os.path.exists(f"{catalog_dir}/{first}-other.duckdb.tmp")
+    assert len(os.listdir(catalog_dir)) == 3
@@ -0,0 +1,169 @@
+import datetime
+import os
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+import shapely
+
+from syte_pipeline.src.data_loader import BUILDING_COLUMNS, DataLoader
+
+
+def write_buildings(path, rows: list[tuple]) -> str:
+    """Building rows (identifier, x, area, district) and their parcels as a prepared partition."""
+    frame = pd.DataFrame(
+        [
+            {
+                "building_identifier": identifier,
+                "geometry": shapely.to_wkb(shapely.box(x, 0, x + 1, 1)),
+                "building_area": area,
+                "num_floors": 2,
+                "on_parcel": f"parcel_{identifier}",
+                "type": "residential",
+                "building_date": datetime.date(2000, 1, 1),
+                "district": district,
+                "parcel_identifier": f"parcel_{identifier}",
+                "parcel_geometry": shapely.to_wkb(shapely.box(x, 0, x + 1, 2)),
+                "parcel_area": 2 * area,
+                "location_text": "Marktplatz 1",
+                "cadastral_identifier": f"040001-{x}",
+                "municipal": "Bremen",
+            }
+            for identifier, x, area, district in rows
+        ]
+    )
+    frame.to_parquet(path)
+    return str(path)
+
+
+@pytest.fixture
+def data_loader() -> DataLoader:
+    return DataLoader("")
+
+
+@pytest.fixture
+def snapshots(tmp_path):
+    (tmp_path / "prev").mkdir()
+    (tmp_path / "cur").mkdir()
+    previous = [
+        write_buildings(tmp_path / "prev" / "BHV.parquet", [("b4", 4, 40.0, "BHV")]),
+        write_buildings(
+            tmp_path / "prev" / "HB.parquet",
+            [("b1", 1, 10.0, "HB"), ("b2", 2, 20.0, "HB"), ("b3", 3, 30.0, "HB"), ("b6", 6, 60.0, "HB")],
+        ),
+    ]
+    current = [
+        write_buildings(tmp_path / "cur" / "BHV.parquet", [("b3", 3, 30.0, "BHV"), ("b4", 4, 40.0, "BHV")]),
+        write_buildings(
+            tmp_path / "cur" / "HB.parquet",
+            [("b1", 1, 10.0, "HB"), ("b2", 2, 25.0, "HB"), ("b5", 5, 50.0, "HB")],
+        ),
+    ]
+    return current, previous
+
+
+def test_diff_snapshots(data_loader, snapshots):
+    current, previous = snapshots
+    changed, deleted = data_loader.diff_snapshots(current, previous, BUILDING_COLUMNS)
+    changed = {row[0]: row for row in changed}
+    # b2 updated, b3 moved to BHV, b5 inserted; b1 and b4 unchanged.
+    assert sorted(changed) == ["b2", "b3", "b5"]
+    assert changed["b2"][2] == 25.0
+    assert changed["b3"][-1] == "BHV"
+    assert changed["b5"][1] == "POLYGON ((6 0, 6 1, 5 1, 5 0, 6 0))"
+    # b6 removed from the source, b3 deleted from HB before it is inserted in BHV.
+    assert sorted(deleted) == ["b3", "b6"]
+
+
+def test_unchanged_snapshot_has_no_diff(data_loader, snapshots):
+    current, _ = snapshots
+    assert data_loader.diff_snapshots(current, current, BUILDING_COLUMNS) == ([], [])
+
+
+def test_duplicate_identifier_comes_from_the_first_file(data_loader, tmp_path):
+    files = [
+        write_buildings(tmp_path / "HB.parquet", [("b1", 1, 10.0, "HB")]),
+        write_buildings(tmp_path / "BHV.parquet", [("b1", 1, 11.0, "BHV"), ("b1", 1, 12.0, "BHV")]),
+    ]
+    previous = [write_buildings(tmp_path / "previous.parquet", [("b1", 1, 11.0, "BHV")])]
+    for _ in range(5):
+        assert data_loader.diff_snapshots(files, previous, BUILDING_COLUMNS) == ([], [])
+
+
+class FakePool:
+    """Records the rows copied into the staging tables."""
+
+    def __init__(self):
+        self.copied = {}
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return self
+
+    def commit(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        pass
+
+    @contextmanager
+    def copy(self, query):
+        table = query.split()[1].removesuffix("_staging")
+        yield SimpleNamespace(write_row=self.copied.setdefault(table, []).append)
+
+
+@pytest.fixture
+def duplicated(tmp_path):
+    """b1 in all three districts, b2 in two, b3 in one."""
+    return [
+        write_buildings(tmp_path / "BHV.parquet", [("b1", 1, 10.0, "BHV"), ("b2", 2, 20.0, "BHV")]),
+        write_buildings(tmp_path / "HB.parquet", [("b1", 1, 11.0, "HB"), ("b3", 3, 30.0, "HB")]),
+        write_buildings(tmp_path / "Nord.parquet", [("b1", 1, 12.0, "Nord"), ("b2", 2, 21.0, "Nord")]),
+    ]
+
+
+def test_conflict_owners(data_loader, duplicated):
+    owners = data_loader.conflict_owners(duplicated)
+    assert owners == {
+        ("buildings", "b1"): duplicated[0],
+        ("buildings", "b2"): duplicated[0],
+        ("parcels", "parcel_b1"): duplicated[0],
+        ("parcels", "parcel_b2"): duplicated[0],
+    }
+
+
+def test_copy_partition_skips_rows_owned_elsewhere(data_loader, duplicated):
+    owners = data_loader.conflict_owners(duplicated)
+    copied = {}
+    for partition in duplicated:
+        pool = FakePool()
+        data_loader.copy_partition_to_psql(partition, owners, pool)
+        copied[os.path.basename(partition)] = {
+            table: sorted(row[0] for row in rows) for table, rows in pool.copied.items()
+        }
+    assert copied == {
+        "BHV.parquet": {"buildings": ["b1", "b2"], "parcels": ["parcel_b1", "parcel_b2"]},
+        "HB.parquet": {"buildings": ["b3"], "parcels": ["parcel_b3"]},
+        "Nord.parquet": {},
+    }
+
+
+def test_batches_load_the_same_rows_as_partitions(data_loader, duplicated, monkeypatch):
+    loaded = []
+    monkeypatch.setattr(data_loader, "insert_data_into_buildings", loaded.extend)
+    monkeypatch.setattr(data_loader, "insert_data_into_parcels", lambda rows: None)
+    owners = data_loader.conflict_owners(duplicated)
+    # The duplicates of the first batch belong to it, the second batch only keeps Nord's own rows.
+    for batch in (duplicated[:1], duplicated[1:]):
+        data_loader.export_building_parcel_data_to_psql(batch, owners)
+    assert sorted((row[0], row[-1]) for row in loaded) == [("b1", "BHV"), ("b2", "BHV"), ("b3", "HB")]
@@ -0,0 +1,58 @@
+import pytest
+
+from syte_pipeline.src.ledger import RunLedger, UnitsFailed, fingerprint
+
+
+@pytest.fixture
+def ledger(tmp_path) -> RunLedger:
+    return RunLedger(str(tmp_path / "ledger.sqlite"))
+
+
+def test_resume_skips_completed_units(ledger):
+    calls = []
+    checkpoint = ledger.run("transform/20240801")
+    assert checkpoint.fresh
+    assert checkpoint.execute("directory/HB", "a", calls.append, "HB")
+    assert not checkpoint.execute("directory/BHV", "b", lambda: 1 / 0)
+    with pytest.raises(UnitsFailed, match="directory/BHV: ZeroDivisionError"):
+        checkpoint.raise_failures()
+
+    resumed = ledger.run("transform/20240801")
+    assert not resumed.fresh
+    assert resumed.execute("directory/HB", "a", calls.append, "HB")
+    assert resumed.execute("directory/BHV", "b", calls.append, "BHV")
+    resumed.raise_failures()
+    assert calls == ["HB", "BHV"]
+    assert resumed.skipped == ["directory/HB"]
+    units = ledger.units("transform/20240801")
+    assert units["directory/BHV"]["status"] == "completed"
+    assert units["directory/BHV"]["attempts"] == 2
+
+
+def test_changed_fingerprint_reruns_the_unit(ledger):
+    calls = []
+    ledger.run("analytics/20240801/full").execute("batch/0", "a", calls.append, 1)
+    ledger.run("analytics/20240801/full").execute("batch/0", "b", calls.append, 2)
+    ledger.run("analytics/20240801/full", resume=False).execute("batch/0", "b", calls.append, 3)
+    assert calls == [1, 2, 3]
+
+
+def test_fingerprint_follows_files(tmp_path):
+    path = tmp_path / "HB.parquet"
+    path.write_bytes(b"1")
+    before = fingerprint([str(path)])
+    assert fingerprint([str(path)]) == before
+    path.write_bytes(b"12")
+    assert fingerprint([str(path)]) != before
+
+
+def test_finished_run_starts_over(ledger):
+    calls = []
+    checkpoint = ledger.run("analytics/20240801/full/empty")
+    checkpoint.execute("batch/0", "a", calls.append, 1)
+    assert checkpoint.completed == ["batch/0"]
+    checkpoint.finish()
+    resumed = ledger.run("analytics/20240801/full/empty")
+    assert resumed.fresh
+    resumed.execute("batch/0", "a", calls.append, 2)
+    assert calls == [1, 2]
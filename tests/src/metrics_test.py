@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pyproj
+import pytest
+import shapely
+
+from syte_pipeline.src.metrics import GRID_CRS, PotentialMetrics
+
+TO_LONLAT = pyproj.Transformer.from_crs(GRID_CRS, "EPSG:4326", always_xy=True)
+
+
+def parcel(x: float, y: float) -> bytes:
+    """WKB of a 10 m square parcel centred on (x, y) in the grid projection."""
+    square = shapely.box(x - 5, y - 5, x + 5, y + 5)
+    return shapely.to_wkb(shapely.transform(square, lambda c: np.column_stack(TO_LONLAT.transform(c[:, 0], c[:, 1]))))
+
+
+@pytest.fixture
+def snapshot() -> pd.DataFrame:
+    """Rows of read_snapshot: one per (parcel, building), a parcel without building has no building_area."""
+    columns = ["parcel_identifier", "parcel_geometry", "parcel_area", "district", "building_area", "num_floors"]
+    return pd.DataFrame(
+        [
+            ("p1", parcel(487100, 5880100), 100.0, "Mitte", 20.0, 2),
+            ("p1", parcel(487100, 5880100), 100.0, "Mitte", 30.0, None),
+            ("p2", parcel(487200, 5880200), 200.0, "Mitte", None, None),
+            ("p3", parcel(487600, 5880100), 0.0, "Nord", 10.0, 3),
+        ],
+        columns=columns,
+    )
+
+
+def test_parcel_metrics(snapshot):
+    parcels = PotentialMetrics(cell_size=250).parcel_metrics(snapshot).set_index("parcel_identifier")
+    p1, p2, p3 = parcels.loc["p1"], parcels.loc["p2"], parcels.loc["p3"]
+    # A building without floors counts one.
+    assert (p1.footprint_area, p1.floor_area, p1.building_count) == (50.0, 70.0, 2)
+    assert p1.coverage_ratio == pytest.approx(0.5)
+    assert p1.floor_area_ratio == pytest.approx(0.7)
+    assert p1.free_area == 50.0
+    assert (p2.footprint_area, p2.coverage_ratio, p2.floor_area_ratio, p2.free_area) == (0.0, 0.0, 0.0, 200.0)
+    assert np.isnan(p3.coverage_ratio) and np.isnan(p3.floor_area_ratio)
+    assert p3.free_area == 0.0
+    assert (p1.cell_x, p1.cell_y) == (1948, 23520)
+    assert (p3.cell_x, p3.cell_y) == (1950, 23520)
+    assert p1.geometry.x == pytest.approx(TO_LONLAT.transform(487100, 5880100)[0])
+
+
+def test_grid_metrics(snapshot):
+    metrics = PotentialMetrics(cell_size=250)
+    grid = metrics.grid_metrics(metrics.parcel_metrics(snapshot)).set_index("cell_id")
+    assert sorted(grid.index) == ["1948_23520", "1950_23520"]
+    cell = grid.loc["1948_23520"]
+    assert (cell.parcel_count, cell.parcel_area, cell.footprint_area, cell.floor_area) == (2, 300.0, 50.0, 70.0)
+    assert cell.free_area == 250.0
+    assert cell.coverage_ratio == pytest.approx(50 / 300)
+    assert cell.floor_area_ratio == pytest.approx(70 / 300)
+    assert np.isnan(grid.loc["1950_23520"].coverage_ratio)
+    # The cell polygon covers the centroids of its parcels.
+    assert cell.geometry.contains(shapely.Point(TO_LONLAT.transform(487150, 5880150)))
@@ -0,0 +1,124 @@
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from syte_pipeline.src.profiling import Profiler, stage, submit
+
+
+def work() -> list:
+    return [str(i) for i in range(10_000)]
+
+
+def test_stage_is_noop_without_run():
+    profiler = Profiler()
+    with stage("gdal_read"):
+        work()
+    assert profiler.list_runs() == []
+
+
+def test_run_records_nested_stages():
+    profiler = Profiler()
+    with profiler.run("prepare", True) as run:
+        with stage("geos_join"):
+            work()
+            with stage("parquet_write"):
+                work()
+        with stage("geos_join"):
+            work()
+
+    assert list(run.stages) == ["parquet_write", "geos_join"]
+    assert run.stages["geos_join"].calls == 2
+    assert run.stages["parquet_write"].peak_memory > 0
+    assert "work" in run.stages["geos_join"].text(run.backend)
+    assert profiler.get(run.run_id) is run
+    assert run.raw_stats()["stages"][0]["name"] == "parquet_write"
+    assert "geos_join" in run.to_html()
+
+
+def test_disabled_run_yields_none():
+    profiler = Profiler()
+    with profiler.run("prepare", False) as run:
+        with stage("gdal_read"):
+            work()
+    assert run is None
+    assert profiler.list_runs() == []
+
+
+def test_stages_in_worker_threads_are_recorded():
+    profiler = Profiler()
+    with profiler.run("download", True) as run:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for _ in range(2):
+                submit(executor, _download)
+    assert run.stages["download"].calls == 2
+
+
+def _download() -> None:
+    with stage("download"):
+        work()
+
+
+def test_history_is_bounded():
+    profiler = Profiler(history=2)
+    ids = []
+    for _ in range(3):
+        with profiler.run("prepare", True) as run:
+            ids.append(run.run_id)
+    assert [r["run_id"] for r in profiler.list_runs()] == ids[:0:-1]
+    assert profiler.get(ids[0]) is None
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        Profiler(backend="perf")
+
+
+def test_cprofile_stage_has_a_flame_graph():
+    profiler = Profiler()
+    with profiler.run("prepare", True) as run:
+        with stage("geos_join"):
+            work()
+    page = run.to_html("geos_join")
+    assert "<pre>" not in page
+    assert "work profiling_test.py" in page
+
+
+def test_concurrent_stage_keeps_the_peak():
+    profiler = Profiler()
+    freed, other_done = threading.Event(), threading.Event()
+
+    def big() -> None:
+        with stage("big"):
+            data = bytearray(20 * 2**20)
+            del data
+            freed.set()
+            other_done.wait(5)
+
+    def small() -> None:
+        freed.wait(5)
+        with stage("small"):
+            work()
+        other_done.set()
+
+    with profiler.run("prepare", True) as run:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for future in [submit(executor, big), submit(executor, small)]:
+                future.result()
+    # The small stage starting on another thread must not reset the peak of the big one.
+    assert run.stages["big"].peak_memory >= 20 * 2**20
+
+
+def test_tracing_started_elsewhere_is_left_on():
+    tracemalloc.start()
+    try:
+        with Profiler().run("prepare", True):
+            with stage("geos_join"):
+                work()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    with Profiler().run("prepare", True):
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,44 @@
+from syte_pipeline.src.resources import (
+    Limits,
+    cgroup_cpus,
+    cgroup_memory,
+    detect_limits,
+    duckdb_cursor,
+    duckdb_instance,
+    get_budget,
+    plan_budget,
+)
+
+
+def test_cgroup_v2_limits(tmp_path):
+    (tmp_path / "cpu.max").write_text("250000 100000\n")
+    (tmp_path / "memory.max").write_text(f"{4 * 1024**3}\n")
+    assert cgroup_cpus(str(tmp_path)) == 2.5
+    assert cgroup_memory(str(tmp_path)) == 4 * 1024**3
+
+
+def test_unlimited_cgroup_falls_back_to_host(tmp_path):
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+    (tmp_path / "memory.max").write_text("max\n")
+    limits = detect_limits(str(tmp_path))
+    assert limits.source == "host"
+    assert limits.cpus >= 1 and limits.memory_mb > 0
+
+
+def test_plan_budget_splits_the_limits():
+    budget = plan_budget(Limits(cpus=4, memory_mb=8000, source="cgroup"), pipeline_share=0.5, memory_headroom=0.25)
+    assert (budget.pipeline_threads, budget.query_threads) == (2, 2)
+    assert budget.pipeline_memory_mb + budget.query_memory_mb == 6000
+    assert budget.load_workers == 2
+    assert budget.duckdb_settings("query") == "SET memory_limit = '3000MB'; SET threads TO 2;"
+    single = plan_budget(Limits(cpus=0.5, memory_mb=1000, source="cgroup"), load_workers=3)
+    assert (single.pipeline_threads, single.query_threads, single.load_workers) == (1, 1, 3)
+
+
+def test_workloads_share_one_capped_instance():
+    assert duckdb_instance("pipeline") is duckdb_instance("pipeline")
+    assert duckdb_instance("query") is not duckdb_instance("pipeline")
+    budget = get_budget()
+    for workload, threads in (("pipeline", budget.pipeline_threads), ("query", budget.query_threads)):
+        with duckdb_cursor(workload) as cursor:
+            assert cursor.sql("SELECT current_setting('threads')").fetchone() == (threads,)
@@ -0,0 +1,74 @@
+import psycopg
+import pytest
+
+from syte_pipeline.src import schema as schema_module
+from syte_pipeline.src.schema import SECONDARY_INDEXES, SchemaManager, partition_name
+
+
+class FakeConnection:
+    """Runs nothing, fails the statements containing ``fail``."""
+
+    def __init__(self, fail: str, partitions: dict[str, list[str]]):
+        self.fail = fail
+        self.partitions = partitions
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        query = query if isinstance(query, str) else query.as_string(None)
+        if self.fail in query:
+            raise psycopg.errors.InsufficientPrivilege(f"permission denied: {query}")
+        self.executed.append(query)
+        rows = [(name,) for name in self.partitions.get(params[0], [])] if "pg_inherits" in query else []
+        return type("Result", (), {"fetchall": lambda _: rows, "fetchone": lambda _: None})()
+
+
+@pytest.mark.parametrize(
+    "districts",
+    [
+        ["Mitte", "mitte", "MITTE"],
+        ["Neustadt/Süd", "Neustadt Süd", "Neustadt-Süd"],
+        ["Gemarkung Bremen Stadt VR 12345 Abschnitt Nord", "Gemarkung Bremen Stadt VR 12345 Abschnitt Süd"],
+    ],
+)
+def test_partition_name_is_unique(districts):
+    names = {partition_name(table, district) for table in ("buildings", "parcels") for district in districts}
+    assert len(names) == 2 * len(districts)
+
+
+@pytest.mark.parametrize("table", ["buildings", "parcels"])
+@pytest.mark.parametrize("district", ["Mitte", "Neustadt/Süd", "Ä" * 200, "x" * 200, "???"])
+def test_partition_name_fits_postgres(table, district):
+    name = partition_name(table, district)
+    assert name == partition_name(table, district)
+    assert len(name) < 63
+    assert name.replace("_", "").isalnum() and name.isascii()
+    # The names of the partition indexes are cut to 63 characters, they stay unique.
+    indexes = [index for index, (parent, _, _) in SECONDARY_INDEXES.items() if parent == table]
+    assert len({f"{name}_{index.removeprefix(table + '_')}"[:63] for index in indexes}) == len(indexes)
+
+
+def test_failed_partition_is_raised(monkeypatch):
+    conn = FakeConnection(fail=partition_name("parcels", "Nord"), partitions={})
+    monkeypatch.setattr(schema_module.psycopg, "connect", lambda *args, **kwargs: conn)
+    with pytest.raises(RuntimeError, match="1 partitions could not be created: parcels/Nord"):
+        SchemaManager("").ensure_partitions(["Mitte", "Nord"])
+    # The other partitions are still created.
+    assert sum("PARTITION OF" in query for query in conn.executed) == 3
+
+
+def test_failed_index_is_raised(monkeypatch):
+    partitions = [partition_name("buildings", "Mitte"), partition_name("buildings", "Nord")]
+    conn = FakeConnection(
+        fail=f'CONCURRENTLY IF NOT EXISTS "{partitions[1]}_geometry_idx"', partitions={"buildings": partitions}
+    )
+    monkeypatch.setattr(schema_module.psycopg, "connect", lambda *args, **kwargs: conn)
+    with pytest.raises(RuntimeError, match=f"1 indexes could not be built: {partitions[1]}_geometry_idx"):
+        SchemaManager("").create_secondary_indexes()
+    # The other indexes are still built: the on_parcel index of both partitions and the geometry one of Mitte.
+    assert sum("ATTACH PARTITION" in query for query in conn.executed) == 3
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from syte_pipeline.src import snapshots
+
+
+@pytest.fixture
+def base(tmp_path) -> str:
+    for day in ["20240701", "20240801", "20240901"]:
+        os.makedirs(snapshots.partition_dir(str(tmp_path), day))
+    os.makedirs(tmp_path / "not_a_partition")
+    return str(tmp_path)
+
+
+def test_list_days(base):
+    assert snapshots.list_days(base) == ["20240701", "20240801", "20240901"]
+
+
+@pytest.mark.parametrize(
+    "as_of,should_be",
+    [
+        (None, "20240901"),
+        ("20240815", "20240801"),
+        ("2024-08-01", "20240801"),
+        ("20240601", None),
+    ],
+)
+def test_latest_day(base, as_of, should_be):
+    assert snapshots.latest_day(base, as_of) == should_be
+
+
+def test_latest_day_invalid(base):
+    with pytest.raises(ValueError):
+        snapshots.latest_day(base, "last week")
+
+
+def test_apply_retention(base):
+    assert snapshots.apply_retention(base, keep=2) == ["20240701"]
+    assert snapshots.list_days(base) == ["20240801", "20240901"]
+
+
+def test_apply_retention_keeps_latest(base):
+    snapshots.apply_retention(base, keep=3, max_age_days=0)
+    assert snapshots.list_days(base) == ["20240901"]
+
+
+def test_markers(base):
+    assert snapshots.read_marker(base, "loaded_day") is None
+    snapshots.write_marker(base, "loaded_day", "20240801")
+    assert snapshots.read_marker(base, "loaded_day") == "20240801"
+    assert snapshots.list_days(base) == ["20240701", "20240801", "20240901"]
+
+
+def test_replace_partition(base, tmp_path_factory):
+    staging = tmp_path_factory.mktemp("staging") / "run"
+    os.makedirs(staging)
+    (staging / "Mitte.parquet").touch()
+    open(os.path.join(snapshots.partition_dir(base, "20240901"), "Old.parquet"), "w").close()
+    snapshots.replace_partition(base, "20240901", str(staging))
+    assert os.listdir(snapshots.partition_dir(base, "20240901")) == ["Mitte.parquet"]
+    assert not os.path.exists(staging)
@@ -0,0 +1,81 @@
+import os
+from types import SimpleNamespace
+
+import mapbox_vector_tile
+import pytest
+
+from syte_pipeline.loadtest import synthetic_frame
+from syte_pipeline.src import snapshots
+from syte_pipeline.src.catalog import Catalog, build_catalog
+from syte_pipeline.src.tiles import ORIGIN, TileRenderer, tile_bounds, tile_lonlat_bounds, tiles_covering
+from syte_pipeline.src.transformation import Transformer
+
+
+def test_tile_bounds():
+    assert tile_bounds(0, 0, 0) == pytest.approx((-ORIGIN, -ORIGIN, ORIGIN, ORIGIN))
+    # y grows southwards.
+    assert tile_bounds(1, 1, 0) == pytest.approx((0, 0, ORIGIN, ORIGIN))
+    assert tile_bounds(1, 0, 1) == pytest.approx((-ORIGIN, -ORIGIN, 0, 0))
+    assert tile_lonlat_bounds(1, 1, 0) == pytest.approx((0, 0, 180, 85.051129))
+
+
+def test_tiles_covering():
+    assert tiles_covering(-180, -90, 180, 90, 1) == [(1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)]
+    tiles = tiles_covering(8.80, 53.07, 8.81, 53.08, 14)
+    assert {z for z, _, _ in tiles} == {14}
+    for lon, lat in [(8.80, 53.07), (8.81, 53.08)]:
+        assert any(
+            west <= lon <= east and south <= lat <= north
+            for west, south, east, north in (tile_lonlat_bounds(*tile) for tile in tiles)
+        )
+    assert len(tiles_covering(8.80, 53.07, 8.80, 53.07, 22)) == 1
+
+
+def test_level_of_detail(tmp_path):
+    catalog = SimpleNamespace(prepared_dir=str(tmp_path))
+    assert TileRenderer(catalog, str(tmp_path)).level_of_detail(5) == 0
+    renderer = TileRenderer(catalog, str(tmp_path), lod_tolerances=[1e-6, 1e-5, 1e-4])
+    # A pixel is 360 / (2**z * 4096) degrees wide: 2.7e-3 at z5, 1.3e-6 at z16, 8.4e-8 at z20.
+    assert renderer.level_of_detail(5) == 3
+    assert renderer.level_of_detail(12) == 2
+    assert renderer.level_of_detail(16) == 1
+    assert renderer.level_of_detail(20) == 0
+
+
+def test_cache_follows_the_generation(tmp_path, monkeypatch):
+    prepared_dir = str(tmp_path / "prepared")
+    catalog = SimpleNamespace(prepared_dir=prepared_dir, source=lambda: "source")
+    renderer = TileRenderer(catalog, str(tmp_path / "tiles"), memory_tiles=1)
+    rendered = []
+    monkeypatch.setattr(renderer, "render", lambda source, z, x, y: rendered.append((z, x, y)) or b"tile")
+
+    first = snapshots.bump_generation(prepared_dir)
+    assert renderer.tile(1, 0, 0) == b"tile"
+    assert renderer.tile(1, 0, 0) == b"tile"
+    assert renderer.tile(1, 1, 0) == b"tile"
+    # Evicted from memory, read back from disk.
+    assert renderer.tile(1, 0, 0) == b"tile"
+    assert rendered == [(1, 0, 0), (1, 1, 0)]
+    assert os.path.exists(tmp_path / "tiles" / first / "1" / "0" / "0.mvt")
+
+    snapshots.bump_generation(prepared_dir)
+    assert renderer.tile(1, 0, 0) == b"tile"
+    assert rendered == [(1, 0, 0), (1, 1, 0), (1, 0, 0)]
+
+
+def test_low_zoom_tiles_are_not_empty(tmp_path):
+    prepared_dir, catalog_dir = str(tmp_path / "prepared"), str(tmp_path / "catalog")
+    partition = snapshots.partition_dir(prepared_dir, "20240801")
+    os.makedirs(partition)
+    frame = synthetic_frame(1, 4)
+    Transformer().to_parquet(frame, partition)
+    snapshots.bump_generation(prepared_dir, build_catalog(prepared_dir, catalog_dir))
+    renderer = TileRenderer(Catalog(catalog_dir, prepared_dir), str(tmp_path / "tiles"))
+    west, south, east, north = frame.total_bounds
+    for z, geometry_type in [(0, "Point"), (18, "Polygon")]:
+        tile = mapbox_vector_tile.decode(renderer.tile(*tiles_covering(west, south, west, south, z)[0]))
+        assert tile["parcels"]["features"]
+        assert {f["geometry"]["type"] for f in tile["parcels"]["features"]} == {geometry_type}
+        assert {f["properties"]["identifier"] for f in tile["buildings"]["features"]} <= set(
+            frame["building_identifier"]
+        )
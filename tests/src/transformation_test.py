@@ -0,0 +1,68 @@
+import glob
+
+import geopandas as gpd
+import pytest
+import shapely
+
+from syte_pipeline.src.data_loader import PARCEL_COLUMNS, DataLoader
+from syte_pipeline.src.resources import duckdb_cursor
+from syte_pipeline.src.transformation import Transformer
+
+PARCELS = {"P1": shapely.box(8.80, 53.07, 8.81, 53.08), "P2": shapely.box(8.81, 53.07, 8.82, 53.08)}
+
+
+@pytest.fixture
+def joined() -> gpd.GeoDataFrame:
+    parcels = gpd.GeoDataFrame(
+        {
+            "OID": list(PARCELS),
+            "area": [100.0, 200.0],
+            "FLAECHE": [100.0, 200.0],
+            "LAGEBEZTXT": ["Am Markt 1", "Am Markt 2"],
+            "FLSTKENNZ": ["040001-1", "040001-2"],
+            "GEMARKUNG": ["Mitte", "Mitte"],
+            "GEMEINDE": ["Bremen", "Bremen"],
+            "AKTUALIT": ["2024-01-01", "2024-01-01"],
+        },
+        geometry=list(PARCELS.values()),
+        crs="EPSG:4326",
+    )
+    # B1 and B2 stand on P1, B3 on P2, B4 on no parcel.
+    buildings = gpd.GeoDataFrame(
+        {
+            "OID": ["B1", "B2", "B3", "B4"],
+            "area": [10.0, 20.0, 30.0, 40.0],
+            "ANZAHLGS": [1, 2, 3, 4],
+            "IDFLURST": ["P1", "P1", "P2", None],
+            "LAGEBEZTXT": ["Am Markt 1", "Am Markt 1", "Am Markt 2", ""],
+            "AKTUALIT": ["2020-01-01", "2021-01-01", "2022-01-01", "2023-01-01"],
+            "FUNKTION": ["Wohnhaus", "Garage", "Wohnhaus", "Schuppen"],
+        },
+        geometry=[
+            shapely.box(8.801, 53.071, 8.802, 53.072),
+            shapely.box(8.805, 53.071, 8.806, 53.072),
+            shapely.box(8.811, 53.071, 8.812, 53.072),
+            shapely.box(8.90, 53.10, 8.91, 53.11),
+        ],
+        crs="EPSG:4326",
+    )
+    return Transformer().spatial_join(buildings, parcels)
+
+
+def test_spatial_join_keeps_the_parcel_geometry(joined):
+    assert sorted(joined["building_identifier"]) == ["B1", "B2", "B3"]
+    for _, row in joined.iterrows():
+        assert row["parcel_geometry"].equals(PARCELS[row["parcel_identifier"]])
+        assert row["geometry"].within(row["parcel_geometry"])
+        assert not row["geometry"].equals(row["parcel_geometry"])
+    assert joined.set_index("building_identifier").loc["B2", "num_floors"] == 2
+
+
+def test_parcel_with_several_buildings_is_loaded_once(joined, tmp_path):
+    Transformer().to_parquet(joined, str(tmp_path))
+    files = sorted(glob.glob(f"{tmp_path}/*.parquet"))
+    with duckdb_cursor("pipeline") as cursor:
+        rows = cursor.sql(DataLoader._rows_sql(files, PARCEL_COLUMNS)).fetchall()
+    assert [row[0] for row in rows] == ["P1", "P2"]
+    for row in rows:
+        assert shapely.from_wkt(row[1]).equals(PARCELS[row[0]])
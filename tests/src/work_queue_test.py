@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+from syte_pipeline.src.work_queue import Deferred, SQLiteWorkQueue, Worker, WorkQueue
+
+
+@pytest.fixture
+def work_queue(tmp_path) -> SQLiteWorkQueue:
+    work_queue = SQLiteWorkQueue(str(tmp_path / "queue.sqlite"), lease_seconds=60, max_attempts=2)
+    work_queue.enqueue("transform", {"HB": {"n": 1}, "BHV": {"n": 2}})
+    return work_queue
+
+
+def test_lease_is_exclusive(work_queue):
+    first = work_queue.lease("transform", "a")
+    second = work_queue.lease("transform", "b")
+    assert (first.key, first.payload, first.attempts) == ("HB", {"n": 1}, 1)
+    assert second.key == "BHV"
+    assert work_queue.lease("transform", "c") is None
+    assert work_queue.stats("transform")["leased"] == 2
+
+
+def test_complete(work_queue):
+    item = work_queue.lease("transform", "a")
+    assert work_queue.heartbeat(item)
+    assert work_queue.complete(item)
+    assert work_queue.stats("transform")["done"] == 1
+
+
+def test_expired_lease_is_taken_over(work_queue):
+    work_queue.lease_seconds = 0.01
+    lost = work_queue.lease("transform", "a")
+    work_queue.lease("transform", "a")
+    time.sleep(0.05)
+    item = work_queue.lease("transform", "b")
+    assert (item.key, item.attempts) == (lost.key, 2)
+    assert not work_queue.heartbeat(lost)
+    assert not work_queue.complete(lost)
+
+
+def test_retries_then_fails(work_queue):
+    for _ in range(2):
+        item = work_queue.lease("transform", "a")
+        assert item.key == "HB"
+        work_queue.fail(item, "boom")
+    assert work_queue.stats("transform")["failed"] == 1
+    assert work_queue.failures("transform") == {"HB": "boom"}
+    assert work_queue.lease("transform", "a").key == "BHV"
+
+
+def test_expire_fails_units_out_of_attempts(work_queue):
+    work_queue.lease_seconds = 0.01
+    work_queue.lease("transform", "a")
+    time.sleep(0.05)
+    work_queue.lease("transform", "a")
+    work_queue.lease("transform", "a")
+    time.sleep(0.05)
+    # HB expired on its last attempt, BHV on its first one and can still be retried.
+    assert work_queue.expire("transform") == 1
+    assert work_queue.failures("transform") == {"HB": "lease expired"}
+    assert work_queue.stats("transform")["leased"] == 1
+
+
+def test_backends_implement_the_interface():
+    with pytest.raises(TypeError):
+        WorkQueue()
+
+
+def test_enqueue_resets_units(work_queue):
+    item = work_queue.lease("transform", "a")
+    work_queue.complete(item)
+    work_queue.enqueue("transform", {"HB": {"n": 3}})
+    assert work_queue.lease("transform", "a").payload == {"n": 3}
+
+
+def test_worker(work_queue):
+    seen = []
+
+    def handler(payload: dict) -> None:
+        if payload["n"] == 2:
+            raise ValueError("broken shapefile")
+        seen.append(payload["n"])
+
+    assert Worker(work_queue, {"transform": handler}).run() == 3
+    assert seen == [1]
+    assert work_queue.stats("transform") == {"pending": 0, "leased": 0, "done": 1, "failed": 1}
+
+
+def test_deferred_unit_keeps_its_attempts(work_queue):
+    work_queue.enqueue("finalize", {"run": {"n": 0}})
+    calls = []
+
+    def finalize(payload: dict) -> None:
+        if work_queue.stats("transform", prefix="B")["done"] == 0:
+            calls.append("deferred")
+            raise Deferred("BHV is not transformed")
+        calls.append("done")
+
+    worker = Worker(work_queue, {"finalize": finalize}, defer_seconds=0)
+    for _ in range(3):
+        worker.process(work_queue.lease("finalize", "a"))
+    item = work_queue.lease("finalize", "a")
+    assert item.attempts == 1
+    assert work_queue.release(item)
+    work_queue.lease("transform", "a")
+    work_queue.complete(work_queue.lease("transform", "a"))
+    assert work_queue.stats("transform", prefix="B") == {"pending": 0, "leased": 0, "done": 1, "failed": 0}
+    assert Worker(work_queue, {"finalize": finalize}, defer_seconds=0).run() == 1
+    assert calls == ["deferred"] * 3 + ["done"]
+
+
+def test_deferred_units_are_not_counted(work_queue):
+    work_queue.enqueue("finalize", {"run": {}})
+    calls = []
+
+    def finalize(payload: dict) -> None:
+        calls.append(payload)
+        if len(calls) < 3:
+            raise Deferred("transform units left")
+
+    assert Worker(work_queue, {"finalize": finalize}, defer_seconds=0).run() == 1
+    assert len(calls) == 3
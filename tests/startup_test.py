@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+# Cumulative import time of syte_pipeline.app, in seconds.
+IMPORT_TIME_BUDGET = float(os.environ.get("SYTE_IMPORT_TIME_BUDGET", "1.5"))
+
+# Only needed by the pipeline and the queries, imported on first use.
+LAZY_MODULES = {
+    "geopandas",
+    "pandas",
+    "shapely",
+    "pyarrow",
+    "plotly",
+    "duckdb",
+    "psycopg",
+    "requests",
+    "mapbox_vector_tile",
+}
+
+
+def import_times(module: str) -> dict:
+    """Cumulative import time in microseconds of every module imported by ``module``."""
+    env = {"SYTE_LOCAL_DIR": "/tmp", **os.environ}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_app_import_does_not_load_pipeline_stack():
+    times = import_times("syte_pipeline.app")
+    loaded = {name.split(".")[0] for name in times}
+    assert not loaded & LAZY_MODULES
+
+
+def test_app_import_time_budget():
+    times = import_times("syte_pipeline.app")
+    assert times["syte_pipeline.app"] / 1e6 < IMPORT_TIME_BUDGET
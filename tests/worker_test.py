@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from syte_pipeline import worker
+from syte_pipeline.settings import Settings
+from syte_pipeline.src import snapshots
+from syte_pipeline.src.work_queue import Deferred
+
+
+class FakeSchema:
+    def __init__(self, conninfo: str):
+        self.calls = []
+
+    def create_secondary_indexes(self) -> None:
+        self.calls.append("indexes")
+
+    def analyze(self) -> None:
+        self.calls.append("analyze")
+
+
+@pytest.fixture
+def load_finalize(tmp_path, monkeypatch, request):
+    schemas = []
+
+    def schema_manager(conninfo):
+        schemas.append(FakeSchema(conninfo))
+        return schemas[-1]
+
+    monkeypatch.setattr(worker, "DBCredentials", lambda: type("Credentials", (), {"conninfo": ""})())
+    monkeypatch.setattr("syte_pipeline.src.schema.SchemaManager", schema_manager)
+    settings = Settings(local_dir=str(tmp_path), **getattr(request, "param", {}))
+    return settings, worker.get_work_queue(settings), worker.load_finalize_handler(settings), schemas[0]
+
+
+def test_load_finalize_waits_for_the_load_units(load_finalize):
+    settings, work_queue, handle, schema = load_finalize
+    work_queue.enqueue("load", {"20240801/gen/HB": {}, "20240801/gen/BHV": {}, "20240731/old/HB": {}})
+    payload = {"day": "20240801", "prefix": "20240801/gen/"}
+    with pytest.raises(Deferred):
+        handle(payload)
+    work_queue.complete(work_queue.lease("load", "test"))
+    work_queue.complete(work_queue.lease("load", "test"))
+    handle(payload)
+    assert schema.calls == ["indexes", "analyze"]
+    assert snapshots.read_marker(settings.prepared_dir, "loaded_day") == "20240801"
+
+
+def test_failed_load_is_not_recorded(load_finalize):
+    settings, work_queue, handle, schema = load_finalize
+    work_queue.enqueue("load", {"20240801/gen/HB": {}})
+    for _ in range(settings.queue_max_attempts):
+        work_queue.fail(work_queue.lease("load", "test"), "boom")
+    with pytest.raises(RuntimeError, match="1 load units failed"):
+        handle({"day": "20240801", "prefix": "20240801/gen/"})
+    assert schema.calls == ["indexes", "analyze"]
+    assert snapshots.read_marker(settings.prepared_dir, "loaded_day") is None
+
+
+@pytest.mark.parametrize("load_finalize", [{"queue_lease_seconds": 0, "queue_max_attempts": 1}], indirect=True)
+def test_expired_load_is_failed(load_finalize):
+    settings, work_queue, handle, schema = load_finalize
+    work_queue.enqueue("load", {"20240801/gen/HB": {}})
+    # The worker loading HB died: no load worker is left to notice that its lease expired.
+    work_queue.lease("load", "dead")
+    time.sleep(0.05)
+    with pytest.raises(RuntimeError, match="1 load units failed"):
+        handle({"day": "20240801", "prefix": "20240801/gen/"})
+    assert work_queue.failures("load") == {"20240801/gen/HB": "lease expired"}